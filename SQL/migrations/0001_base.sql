@@ -0,0 +1,272 @@
+-- 0001 - Esquema base (antes SQL/nuevo). Aplicar con: python backend/migrate.py
+-- Las bases creadas con el script anterior se registran sin reejecutarlo:
+--   python backend/migrate.py --baseline 0001
+
+-- 1. Configuraciones iniciales
+SET client_encoding = 'UTF8';
+SET standard_conforming_strings = 'on';
+SELECT pg_catalog.set_config('search_path', '', false);
+
+-- 2. Creación de la base de datos (opcional)
+-- DROP DATABASE IF EXISTS pry_lectura;
+-- CREATE DATABASE pry_lectura WITH TEMPLATE = template0 ENCODING = 'UTF8' LOCALE_PROVIDER = libc LOCALE = 'Spanish_Ecuador.1252';
+-- \c pry_lectura;
+
+-- 3. Tablas, secuencias y PK
+--------------------------------------------------------------------------------
+-- roles
+CREATE SEQUENCE public.roles_id_seq AS integer START WITH 1 INCREMENT BY 1 NO MINVALUE NO MAXVALUE CACHE 1;
+CREATE TABLE public.roles (
+    id integer NOT NULL DEFAULT nextval('public.roles_id_seq'::regclass),
+    nombre varchar(50) NOT NULL
+);
+ALTER SEQUENCE public.roles_id_seq OWNED BY public.roles.id;
+ALTER TABLE ONLY public.roles ADD CONSTRAINT roles_pkey PRIMARY KEY (id);
+ALTER TABLE ONLY public.roles ADD CONSTRAINT roles_nombre_key UNIQUE (nombre);
+
+-- usuarios
+CREATE SEQUENCE public.usuarios_id_seq AS integer START WITH 1 INCREMENT BY 1 NO MINVALUE NO MAXVALUE CACHE 1;
+CREATE TABLE public.usuarios (
+    id integer NOT NULL DEFAULT nextval('public.usuarios_id_seq'::regclass),
+    nombre text NOT NULL,
+    apellido text NOT NULL,
+    correo text NOT NULL,
+    contrasena text NOT NULL,
+    rol_id integer,
+    creado_en timestamp without time zone DEFAULT now(),
+    ultimo_acceso timestamp without time zone
+);
+ALTER SEQUENCE public.usuarios_id_seq OWNED BY public.usuarios.id;
+ALTER TABLE ONLY public.usuarios ADD CONSTRAINT usuarios_pkey PRIMARY KEY (id);
+ALTER TABLE ONLY public.usuarios ADD CONSTRAINT usuarios_correo_key UNIQUE (correo);
+
+-- sesiones (flujo continuo)
+CREATE SEQUENCE public.sesiones_id_seq AS integer START WITH 1 INCREMENT BY 1 NO MINVALUE NO MAXVALUE CACHE 1;
+CREATE TABLE public.sesiones (
+    id integer NOT NULL DEFAULT nextval('public.sesiones_id_seq'::regclass),
+    usuario_id integer,
+    fecha_inicio timestamp without time zone DEFAULT now(),
+    fecha_fin timestamp without time zone,
+    tipo_actividad varchar(20),          -- 'pdf' | 'video'
+    fuente varchar(255),                 -- nombre del PDF o título del video
+    total_segundos integer,
+    alertas integer DEFAULT 0,
+    kss_final integer,
+    es_fatiga boolean,
+    resumen jsonb,                       -- {fatiga_acumulada, momentos, recomendaciones}
+    actividades_completadas boolean DEFAULT false
+);
+ALTER SEQUENCE public.sesiones_id_seq OWNED BY public.sesiones.id;
+ALTER TABLE ONLY public.sesiones ADD CONSTRAINT sesiones_pkey PRIMARY KEY (id);
+
+-- mediciones (sin etapa inicial/final, métricas continuas)
+CREATE SEQUENCE public.mediciones_id_seq AS integer START WITH 1 INCREMENT BY 1 NO MINVALUE NO MAXVALUE CACHE 1;
+CREATE TABLE public.mediciones (
+    id integer NOT NULL DEFAULT nextval('public.mediciones_id_seq'::regclass),
+    sesion_id integer,
+    actividad varchar(20),               -- 'pdf' | 'video'
+    perclos numeric(5,2),
+    parpadeos integer,
+    blink_rate_min numeric(6,2),
+    ear_promedio numeric(10,4),
+    pct_incompletos numeric(5,2),
+    tiempo_cierre numeric(6,2),
+    num_bostezos integer,
+    velocidad_ocular numeric(10,4),
+    nivel_subjetivo integer,
+    nivel_fatiga integer,
+    estado_fatiga varchar(50),
+    max_sin_parpadeo integer,            -- segundos
+    alertas integer,
+    momentos_fatiga jsonb,               -- [{t,reason}]
+    fecha timestamp without time zone DEFAULT now()
+);
+ALTER SEQUENCE public.mediciones_id_seq OWNED BY public.mediciones.id;
+ALTER TABLE ONLY public.mediciones ADD CONSTRAINT mediciones_pkey PRIMARY KEY (id);
+
+-- muestras (serie temporal append-only: una fila angosta por snapshot, clave (sesion_id, t))
+-- Reemplaza a mediciones como destino de /save-fatigue; mediciones queda como histórico.
+CREATE TABLE IF NOT EXISTS public.muestras (
+    sesion_id integer NOT NULL,
+    t integer NOT NULL,                  -- segundos desde el inicio del monitoreo
+    perclos numeric(5,2),
+    parpadeos integer,
+    blink_rate_min numeric(6,2),
+    pct_incompletos numeric(5,2),
+    tiempo_cierre numeric(6,2),
+    num_bostezos integer,
+    velocidad_ocular numeric(10,4),
+    max_sin_parpadeo integer,
+    alertas integer,
+    nivel_subjetivo integer,
+    es_fatiga boolean,
+    PRIMARY KEY (sesion_id, t)
+);
+
+-- sesion_resumen (proyección por sesión: datos de la sesión + acumulado de muestras +
+-- momentos + diagnóstico). Se mantiene en la misma transacción que cada escritura
+-- (create-session, save-fatigue, end-session, diagnóstico) y es lo único que leen
+-- /sesiones/{id}, /get-user-history y /admin/all-sessions.
+-- Reconstrucción: python backend/reconstruir_resumen.py
+CREATE TABLE IF NOT EXISTS public.sesion_resumen (
+    sesion_id integer PRIMARY KEY,
+    usuario_id integer,
+    tipo_actividad varchar(20),
+    fecha_inicio timestamp without time zone,
+    fecha_fin timestamp without time zone,
+    t integer,                           -- t de la muestra más reciente (NULL sin muestras)
+    actividad varchar(20),
+    perclos numeric(5,2),
+    parpadeos integer,
+    blink_rate_min numeric(6,2),
+    pct_incompletos numeric(5,2),
+    tiempo_cierre numeric(6,2),
+    num_bostezos integer,
+    velocidad_ocular numeric(10,4),
+    max_sin_parpadeo integer,
+    alertas integer,
+    nivel_subjetivo integer,
+    es_fatiga boolean,
+    ultimo_momento_t integer,            -- último momento de fatiga copiado a alertas
+    momentos jsonb NOT NULL DEFAULT '[]'::jsonb,  -- [{t, reason}] en orden, copia de alertas
+    diagnostico_json jsonb,              -- copia de diagnosticos_ia
+    -- aporte ya sumado a usuario_resumen (NULL = sesión aún no contada)
+    rollup_segundos integer,
+    rollup_alertas integer,
+    rollup_perclos numeric(5,2),
+    actualizado_en timestamp without time zone DEFAULT now()
+);
+
+-- usuario_resumen (acumulado por usuario con sumas y conteos; se actualiza con deltas
+-- cada vez que una sesión se cierra, así /get-user-history no recorre sus sesiones)
+CREATE TABLE IF NOT EXISTS public.usuario_resumen (
+    usuario_id integer PRIMARY KEY REFERENCES public.usuarios(id) ON DELETE CASCADE,
+    sesiones integer NOT NULL DEFAULT 0,
+    segundos_total bigint NOT NULL DEFAULT 0,
+    alertas_total bigint NOT NULL DEFAULT 0,
+    perclos_suma numeric NOT NULL DEFAULT 0,
+    perclos_n integer NOT NULL DEFAULT 0,   -- sesiones con perclos (para el promedio)
+    actualizado_en timestamp without time zone DEFAULT now()
+);
+
+-- senales_crudas (señales por frame subidas en binario, ver backend/senales.py)
+-- Cada fila es un chunk comprimido tal como llegó; no se decodifica al guardar.
+CREATE TABLE IF NOT EXISTS public.senales_crudas (
+    sesion_id integer NOT NULL,
+    seq integer NOT NULL,                -- orden del chunk dentro de la sesión
+    n_frames integer NOT NULL,
+    datos bytea NOT NULL,                -- cabecera SEYE + columnas comprimidas con zlib
+    creado_en timestamp without time zone DEFAULT now(),
+    PRIMARY KEY (sesion_id, seq)
+);
+-- Los chunks ya vienen comprimidos: evitar que TOAST intente comprimirlos otra vez
+ALTER TABLE public.senales_crudas ALTER COLUMN datos SET STORAGE EXTERNAL;
+
+-- alertas puntuales (opcional pero útil para historial)
+CREATE TABLE IF NOT EXISTS public.alertas (
+    id serial PRIMARY KEY,
+    sesion_id integer REFERENCES public.sesiones(id) ON DELETE CASCADE,
+    momento_seg integer,
+    motivo text,
+    creada_en timestamp without time zone DEFAULT now()
+);
+
+-- diagnosticos_ia (se mantiene)
+CREATE SEQUENCE public.diagnosticos_ia_id_seq AS integer START WITH 1 INCREMENT BY 1 NO MINVALUE NO MAXVALUE CACHE 1;
+CREATE TABLE public.diagnosticos_ia (
+    id integer NOT NULL DEFAULT nextval('public.diagnosticos_ia_id_seq'::regclass),
+    sesion_id integer NOT NULL,
+    diagnostico_json jsonb NOT NULL,
+    fecha_creacion timestamp with time zone DEFAULT CURRENT_TIMESTAMP
+);
+ALTER SEQUENCE public.diagnosticos_ia_id_seq OWNED BY public.diagnosticos_ia.id;
+ALTER TABLE ONLY public.diagnosticos_ia ADD CONSTRAINT diagnosticos_ia_pkey PRIMARY KEY (id);
+ALTER TABLE ONLY public.diagnosticos_ia ADD CONSTRAINT diagnosticos_ia_sesion_id_key UNIQUE (sesion_id);
+
+-- diagnosticos_cola (diagnósticos IA pendientes de enviar a N8N, uno por sesión)
+CREATE TABLE IF NOT EXISTS public.diagnosticos_cola (
+    sesion_id integer PRIMARY KEY REFERENCES public.sesiones(id) ON DELETE CASCADE,
+    payload jsonb NOT NULL,               -- último snapshot enviado por /save-fatigue
+    version integer NOT NULL DEFAULT 1,   -- se incrementa en cada reencolado
+    estado varchar(20) NOT NULL DEFAULT 'pendiente',  -- 'pendiente' | 'procesando' | 'error'
+    intentos integer NOT NULL DEFAULT 0,
+    disponible_en timestamp without time zone NOT NULL DEFAULT now(),
+    actualizado_en timestamp without time zone NOT NULL DEFAULT now(),
+    ultimo_error text
+);
+
+-- 4. Foreign keys
+--------------------------------------------------------------------------------
+ALTER TABLE ONLY public.usuarios
+    ADD CONSTRAINT usuarios_rol_id_fkey FOREIGN KEY (rol_id) REFERENCES public.roles(id);
+
+ALTER TABLE ONLY public.sesiones
+    ADD CONSTRAINT sesiones_usuario_id_fkey FOREIGN KEY (usuario_id) REFERENCES public.usuarios(id) ON DELETE CASCADE;
+
+ALTER TABLE ONLY public.mediciones
+    ADD CONSTRAINT mediciones_sesion_id_fkey FOREIGN KEY (sesion_id) REFERENCES public.sesiones(id) ON DELETE CASCADE;
+
+ALTER TABLE ONLY public.muestras
+    ADD CONSTRAINT muestras_sesion_id_fkey FOREIGN KEY (sesion_id) REFERENCES public.sesiones(id) ON DELETE CASCADE;
+
+ALTER TABLE ONLY public.senales_crudas
+    ADD CONSTRAINT senales_crudas_sesion_id_fkey FOREIGN KEY (sesion_id) REFERENCES public.sesiones(id) ON DELETE CASCADE;
+
+ALTER TABLE ONLY public.sesion_resumen
+    ADD CONSTRAINT sesion_resumen_sesion_id_fkey FOREIGN KEY (sesion_id) REFERENCES public.sesiones(id) ON DELETE CASCADE;
+
+ALTER TABLE ONLY public.diagnosticos_ia
+    ADD CONSTRAINT diagnosticos_ia_sesion_id_fkey FOREIGN KEY (sesion_id) REFERENCES public.sesiones(id) ON DELETE CASCADE;
+
+-- 5. Datos iniciales
+--------------------------------------------------------------------------------
+INSERT INTO public.roles (id, nombre) VALUES (1, 'Administrador'), (2, 'Usuario')
+ON CONFLICT DO NOTHING;
+SELECT pg_catalog.setval('public.roles_id_seq', 2, true);
+
+INSERT INTO public.usuarios (nombre, apellido, correo, contrasena, rol_id)
+VALUES ('Admin', 'Principal', 'admin@admin.com', '$2b$12$5ymgdz8lADZMrCAjp68b4eBr8EAt2tVP4U0hzeqrYTQ2cu/h4rSt2', 1)
+ON CONFLICT (correo) DO NOTHING;
+SELECT pg_catalog.setval('public.usuarios_id_seq', 1, true);
+
+-- 6. Índices recomendados
+--------------------------------------------------------------------------------
+CREATE INDEX IF NOT EXISTS idx_sesiones_usuario ON public.sesiones(usuario_id);
+-- Paginación keyset de /admin/all-sessions e historial por usuario (solo sesiones cerradas)
+CREATE INDEX IF NOT EXISTS idx_sesion_resumen_cerradas_fecha ON public.sesion_resumen(fecha_inicio DESC, sesion_id DESC) WHERE fecha_fin IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_sesion_resumen_usuario_fecha ON public.sesion_resumen(usuario_id, fecha_inicio DESC) WHERE fecha_fin IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_mediciones_sesion ON public.mediciones(sesion_id);
+CREATE INDEX IF NOT EXISTS idx_alertas_sesion ON public.alertas(sesion_id);
+CREATE INDEX IF NOT EXISTS idx_diagnosticos_cola_pendientes ON public.diagnosticos_cola(disponible_en) WHERE estado = 'pendiente';
+
+-- 7. Migración de datos históricos (mediciones -> sesion_resumen / alertas)
+--------------------------------------------------------------------------------
+INSERT INTO public.sesion_resumen (
+    sesion_id, t, actividad, perclos, parpadeos, blink_rate_min, pct_incompletos, tiempo_cierre,
+    num_bostezos, velocidad_ocular, max_sin_parpadeo, alertas, nivel_subjetivo, es_fatiga, ultimo_momento_t
+)
+SELECT DISTINCT ON (m.sesion_id)
+    m.sesion_id, COALESCE(s.total_segundos, 0), m.actividad, m.perclos, m.parpadeos, m.blink_rate_min,
+    m.pct_incompletos, m.tiempo_cierre, m.num_bostezos, m.velocidad_ocular, m.max_sin_parpadeo,
+    m.alertas, m.nivel_subjetivo, m.nivel_fatiga = 1,
+    (SELECT MAX((x->>'t')::numeric)::integer FROM jsonb_array_elements(COALESCE(m.momentos_fatiga, '[]'::jsonb)) x)
+FROM public.mediciones m
+JOIN public.sesiones s ON s.id = m.sesion_id
+ORDER BY m.sesion_id, m.fecha DESC
+ON CONFLICT (sesion_id) DO NOTHING;
+
+INSERT INTO public.alertas (sesion_id, momento_seg, motivo)
+SELECT DISTINCT ON (m.sesion_id, (x->>'t')::numeric)
+    m.sesion_id, ROUND((x->>'t')::numeric)::integer, COALESCE(x->>'reason', 'Fatiga')
+FROM (
+    SELECT DISTINCT ON (sesion_id) sesion_id, momentos_fatiga
+    FROM public.mediciones
+    WHERE momentos_fatiga IS NOT NULL
+    ORDER BY sesion_id, fecha DESC
+) m
+CROSS JOIN LATERAL jsonb_array_elements(m.momentos_fatiga) x
+WHERE NOT EXISTS (SELECT 1 FROM public.alertas a WHERE a.sesion_id = m.sesion_id);
+
+-- Completar la proyección (datos de sesión, momentos y diagnóstico) y el acumulado
+-- por usuario (usuario_resumen) para todas las sesiones:
+--   python backend/reconstruir_resumen.py
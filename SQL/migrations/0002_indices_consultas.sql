@@ -0,0 +1,24 @@
+-- migrate: sin-transaccion
+-- 0002 - Índices compuestos y parciales para las consultas calientes.
+-- CONCURRENTLY para no bloquear escrituras en una base en uso (por eso sin transacción).
+-- backend/verificar_planes.py comprueba con EXPLAIN que cada consulta los use.
+
+-- /save-fatigue sin sesion_id: sesión abierta más reciente del usuario
+-- (WHERE usuario_id = ? AND fecha_fin IS NULL ORDER BY id DESC LIMIT 1)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_sesiones_abiertas_usuario
+    ON public.sesiones (usuario_id, id DESC) WHERE fecha_fin IS NULL;
+
+-- /get-user-history: página keyset por (fecha_inicio, sesion_id) de un usuario;
+-- reemplaza al índice sin desempate, que obligaba a ordenar la página
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_sesion_resumen_usuario_pagina
+    ON public.sesion_resumen (usuario_id, fecha_inicio DESC, sesion_id DESC) WHERE fecha_fin IS NOT NULL;
+DROP INDEX CONCURRENTLY IF EXISTS public.idx_sesion_resumen_usuario_fecha;
+
+-- momentos de una sesión en orden (reconstrucción de sesion_resumen.momentos)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_alertas_sesion_momento
+    ON public.alertas (sesion_id, momento_seg);
+DROP INDEX CONCURRENTLY IF EXISTS public.idx_alertas_sesion;
+
+-- cola de diagnósticos: la rama de trabajos abandonados en 'procesando' del reclamo
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_diagnosticos_cola_procesando
+    ON public.diagnosticos_cola (actualizado_en) WHERE estado = 'procesando';
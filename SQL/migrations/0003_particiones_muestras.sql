@@ -0,0 +1,153 @@
+-- 0003 - muestras particionada por mes, con retención y agregados por minuto.
+--
+-- La clave de partición es sesion_inicio (= sesiones.fecha_inicio): todas las muestras
+-- de una sesión caen en la misma partición, así que (sesion_id, t, sesion_inicio)
+-- identifica una muestra igual que antes (sesion_id, t) y una sesión está completa
+-- en crudo o completa en muestras_minuto, nunca partida entre ambas.
+--
+-- Particiones: public.crear_particiones_muestras(meses_adelante) crea el mes actual y
+-- los siguientes (el backend la llama al iniciar y cada MANTENIMIENTO_SEG).
+-- Retención: public.retener_muestras(edad) agrega a muestras_minuto y elimina las
+-- particiones de meses completos más viejos que `edad` (backend con
+-- MUESTRAS_RETENCION_MESES > 0, o python backend/retencion_muestras.py desde cron).
+
+-- La clave de partición no admite NULL
+UPDATE public.sesiones SET fecha_inicio = COALESCE(fecha_fin, NOW()) WHERE fecha_inicio IS NULL;
+ALTER TABLE public.sesiones ALTER COLUMN fecha_inicio SET NOT NULL;
+
+ALTER TABLE public.muestras RENAME TO muestras_sin_particionar;
+ALTER TABLE public.muestras_sin_particionar RENAME CONSTRAINT muestras_pkey TO muestras_sin_particionar_pkey;
+ALTER TABLE public.muestras_sin_particionar DROP CONSTRAINT muestras_sesion_id_fkey;
+
+CREATE TABLE public.muestras (
+    sesion_id integer NOT NULL,
+    t integer NOT NULL,                  -- segundos desde el inicio del monitoreo
+    sesion_inicio timestamp without time zone NOT NULL,  -- clave de partición
+    perclos numeric(5,2),
+    parpadeos integer,
+    blink_rate_min numeric(6,2),
+    pct_incompletos numeric(5,2),
+    tiempo_cierre numeric(6,2),
+    num_bostezos integer,
+    velocidad_ocular numeric(10,4),
+    max_sin_parpadeo integer,
+    alertas integer,
+    nivel_subjetivo integer,
+    es_fatiga boolean,
+    PRIMARY KEY (sesion_id, t, sesion_inicio)
+) PARTITION BY RANGE (sesion_inicio);
+
+ALTER TABLE public.muestras
+    ADD CONSTRAINT muestras_sesion_id_fkey FOREIGN KEY (sesion_id) REFERENCES public.sesiones(id) ON DELETE CASCADE;
+
+-- muestras_minuto (muestras de particiones retenidas, una fila por minuto de sesión).
+-- Tasas: promedio del minuto; contadores acumulativos: máximo; t: última muestra del minuto.
+CREATE TABLE IF NOT EXISTS public.muestras_minuto (
+    sesion_id integer NOT NULL REFERENCES public.sesiones(id) ON DELETE CASCADE,
+    minuto integer NOT NULL,             -- t / 60
+    sesion_inicio timestamp without time zone NOT NULL,
+    n integer NOT NULL,                  -- muestras crudas agregadas
+    t integer NOT NULL,
+    perclos numeric(5,2),
+    parpadeos integer,
+    blink_rate_min numeric(6,2),
+    pct_incompletos numeric(5,2),
+    tiempo_cierre numeric(6,2),
+    num_bostezos integer,
+    velocidad_ocular numeric(10,4),
+    max_sin_parpadeo integer,
+    alertas integer,
+    nivel_subjetivo integer,
+    es_fatiga boolean,
+    PRIMARY KEY (sesion_id, minuto)
+);
+
+CREATE OR REPLACE FUNCTION public.crear_particion_muestras(mes date) RETURNS text
+LANGUAGE plpgsql AS $$
+DECLARE
+    inicio date := date_trunc('month', mes)::date;
+    nombre text := 'muestras_' || to_char(inicio, 'YYYYMM');
+BEGIN
+    -- Comprobar antes de CREATE: así la llamada periódica no bloquea la tabla padre
+    IF to_regclass('public.' || nombre) IS NULL THEN
+        EXECUTE format(
+            'CREATE TABLE public.%I PARTITION OF public.muestras FOR VALUES FROM (%L) TO (%L)',
+            nombre, inicio, (inicio + INTERVAL '1 month')::date
+        );
+    END IF;
+    RETURN nombre;
+END $$;
+
+CREATE OR REPLACE FUNCTION public.crear_particiones_muestras(meses_adelante integer DEFAULT 2) RETURNS void
+LANGUAGE plpgsql AS $$
+BEGIN
+    FOR i IN 0..meses_adelante LOOP
+        PERFORM public.crear_particion_muestras((date_trunc('month', NOW()) + make_interval(months => i))::date);
+    END LOOP;
+END $$;
+
+CREATE OR REPLACE FUNCTION public.retener_muestras(edad interval) RETURNS integer
+LANGUAGE plpgsql AS $$
+DECLARE
+    particion record;
+    limite date := date_trunc('month', NOW() - edad)::date;
+    retenidas integer := 0;
+BEGIN
+    -- Un solo proceso a la vez (varios workers del backend + cron)
+    IF NOT pg_try_advisory_xact_lock(7346002) THEN
+        RETURN 0;
+    END IF;
+
+    FOR particion IN
+        SELECT c.relname, to_date(substring(c.relname FROM '\d{6}$'), 'YYYYMM') AS mes
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'public.muestras'::regclass
+          AND c.relname ~ '^muestras_\d{6}$'
+        ORDER BY 2
+    LOOP
+        -- Solo meses completos que terminan antes del límite
+        CONTINUE WHEN (particion.mes + INTERVAL '1 month')::date > limite;
+
+        -- Agregar y eliminar en la misma transacción: la sesión nunca queda a medias
+        EXECUTE format($sql$
+            INSERT INTO public.muestras_minuto (
+                sesion_id, minuto, sesion_inicio, n, t, perclos, parpadeos, blink_rate_min,
+                pct_incompletos, tiempo_cierre, num_bostezos, velocidad_ocular, max_sin_parpadeo,
+                alertas, nivel_subjetivo, es_fatiga
+            )
+            SELECT sesion_id, t / 60, sesion_inicio, COUNT(*), MAX(t),
+                   ROUND(AVG(perclos), 2), MAX(parpadeos), ROUND(AVG(blink_rate_min), 2),
+                   ROUND(AVG(pct_incompletos), 2), MAX(tiempo_cierre), MAX(num_bostezos),
+                   ROUND(AVG(velocidad_ocular), 4), MAX(max_sin_parpadeo),
+                   MAX(alertas), MAX(nivel_subjetivo), bool_or(es_fatiga)
+            FROM public.%I
+            GROUP BY sesion_id, t / 60, sesion_inicio
+            ON CONFLICT (sesion_id, minuto) DO NOTHING
+        $sql$, particion.relname);
+        EXECUTE format('DROP TABLE public.%I', particion.relname);
+        retenidas := retenidas + 1;
+    END LOOP;
+    RETURN retenidas;
+END $$;
+
+-- Particiones para los meses con datos existentes y los próximos
+SELECT public.crear_particion_muestras(mes::date)
+FROM (
+    SELECT DISTINCT date_trunc('month', s.fecha_inicio) AS mes
+    FROM public.muestras_sin_particionar m
+    JOIN public.sesiones s ON s.id = m.sesion_id
+) meses;
+SELECT public.crear_particiones_muestras(2);
+
+INSERT INTO public.muestras (
+    sesion_id, t, sesion_inicio, perclos, parpadeos, blink_rate_min, pct_incompletos,
+    tiempo_cierre, num_bostezos, velocidad_ocular, max_sin_parpadeo, alertas, nivel_subjetivo, es_fatiga
+)
+SELECT m.sesion_id, m.t, s.fecha_inicio, m.perclos, m.parpadeos, m.blink_rate_min, m.pct_incompletos,
+       m.tiempo_cierre, m.num_bostezos, m.velocidad_ocular, m.max_sin_parpadeo, m.alertas,
+       m.nivel_subjetivo, m.es_fatiga
+FROM public.muestras_sin_particionar m
+JOIN public.sesiones s ON s.id = m.sesion_id;
+
+DROP TABLE public.muestras_sin_particionar;
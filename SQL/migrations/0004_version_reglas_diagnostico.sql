@@ -0,0 +1,6 @@
+-- 0004 - versión de las reglas de umbrales con que se generó cada diagnóstico local.
+--
+-- NULL = diagnóstico de N8N (IA) o generado antes de versionar las reglas.
+-- backend/rediagnosticar.py recalcula los diagnósticos locales de versión anterior.
+
+ALTER TABLE public.diagnosticos_ia ADD COLUMN IF NOT EXISTS reglas_version integer;
@@ -0,0 +1,7 @@
+-- 0005 - high-water mark del número de secuencia de /save-fatigue por sesión.
+--
+-- monitoreo.js numera los snapshots de cada sesión (seq creciente). El backend
+-- descarta los que no superan sesion_resumen.ultimo_seq: reintentos y snapshots
+-- atrasados no vuelven a escribir muestras. NULL = la sesión no envía seq.
+
+ALTER TABLE public.sesion_resumen ADD COLUMN IF NOT EXISTS ultimo_seq integer;
@@ -0,0 +1,49 @@
+-- 0006 - partición DEFAULT para muestras.
+--
+-- Sin ella, un INSERT con sesion_inicio fuera de las particiones mensuales existentes
+-- (mantenimiento caído, reloj adelantado, sesión de un mes sin crear) falla y se
+-- pierde el lote entero. Esas filas ahora caen en muestras_default, y
+-- crear_particion_muestras las mueve a la partición del mes cuando la crea: con una
+-- DEFAULT que ya tiene filas de ese rango, CREATE TABLE ... PARTITION OF fallaría.
+-- El backend además no arranca si falta la partición del mes siguiente.
+
+CREATE TABLE IF NOT EXISTS public.muestras_default PARTITION OF public.muestras DEFAULT;
+
+CREATE OR REPLACE FUNCTION public.crear_particion_muestras(mes date) RETURNS text
+LANGUAGE plpgsql AS $$
+DECLARE
+    inicio date := date_trunc('month', mes)::date;
+    fin date := (date_trunc('month', mes) + INTERVAL '1 month')::date;
+    nombre text := 'muestras_' || to_char(inicio, 'YYYYMM');
+BEGIN
+    -- Comprobar antes de CREATE: así la llamada periódica no bloquea la tabla padre
+    IF to_regclass('public.' || nombre) IS NOT NULL THEN
+        RETURN nombre;
+    END IF;
+
+    IF EXISTS (
+        SELECT 1 FROM public.muestras_default WHERE sesion_inicio >= inicio AND sesion_inicio < fin
+    ) THEN
+        -- Filas del mes que cayeron en DEFAULT: se mueven a una tabla nueva y se adjunta
+        -- (ATTACH crea los índices y la FK heredados de muestras)
+        EXECUTE format('CREATE TABLE public.%I (LIKE public.muestras INCLUDING DEFAULTS)', nombre);
+        EXECUTE format($sql$
+            WITH movidas AS (
+                DELETE FROM public.muestras_default
+                WHERE sesion_inicio >= %L AND sesion_inicio < %L
+                RETURNING *
+            )
+            INSERT INTO public.%I SELECT * FROM movidas
+        $sql$, inicio, fin, nombre);
+        EXECUTE format(
+            'ALTER TABLE public.muestras ATTACH PARTITION public.%I FOR VALUES FROM (%L) TO (%L)',
+            nombre, inicio, fin
+        );
+    ELSE
+        EXECUTE format(
+            'CREATE TABLE public.%I PARTITION OF public.muestras FOR VALUES FROM (%L) TO (%L)',
+            nombre, inicio, fin
+        );
+    END IF;
+    RETURN nombre;
+END $$;
@@ -0,0 +1,10 @@
+-- 0007 - marca de cierre real de la sesión.
+--
+-- fecha_fin no sirve para saber si una sesión terminó: cada snapshot de /save-fatigue
+-- la pone en NOW() (es la hora de la última actividad). cerrada_en la fija solo el
+-- cierre explícito (/end-session, "fin" del stream o inactividad); las respuestas de
+-- /sesiones/{id} y del diagnóstico se cachean únicamente con cerrada_en presente.
+-- Las sesiones anteriores quedan en NULL: no se cachean, lo que siempre es correcto.
+
+ALTER TABLE public.sesiones ADD COLUMN IF NOT EXISTS cerrada_en timestamp without time zone;
+ALTER TABLE public.sesion_resumen ADD COLUMN IF NOT EXISTS cerrada_en timestamp without time zone;
@@ -0,0 +1,29 @@
+-- migrate: sin-transaccion
+-- 0008 - "Cerrada" es cerrada_en IS NOT NULL en todas las consultas (historial, admin,
+-- exportación, acumulado por usuario y sesión abierta de /save-fatigue): fecha_fin la
+-- mueve cada snapshot. Los índices parciales pasan a ese predicado.
+-- CONCURRENTLY para no bloquear escrituras (por eso sin transacción); todo es idempotente.
+
+-- Sesiones de antes de 0007: las que no tienen actividad hace más de una hora se dan por
+-- cerradas en su fecha_fin; las demás las cierra /end-session o el mantenimiento del backend
+UPDATE public.sesiones SET cerrada_en = fecha_fin
+WHERE cerrada_en IS NULL AND fecha_fin < NOW() - INTERVAL '1 hour';
+UPDATE public.sesion_resumen r SET cerrada_en = s.cerrada_en
+FROM public.sesiones s
+WHERE s.id = r.sesion_id AND r.cerrada_en IS NULL AND s.cerrada_en IS NOT NULL;
+
+-- /save-fatigue sin sesion_id: sesión abierta más reciente del usuario
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_sesiones_abiertas_usuario_cierre
+    ON public.sesiones (usuario_id, id DESC) WHERE cerrada_en IS NULL;
+DROP INDEX CONCURRENTLY IF EXISTS public.idx_sesiones_abiertas_usuario;
+
+-- Paginación keyset de /admin/all-sessions y de la exportación
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_sesion_resumen_cerradas_en_fecha
+    ON public.sesion_resumen (fecha_inicio DESC, sesion_id DESC) WHERE cerrada_en IS NOT NULL;
+DROP INDEX CONCURRENTLY IF EXISTS public.idx_sesion_resumen_cerradas_fecha;
+
+-- /get-user-history: página keyset de un usuario
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_sesion_resumen_usuario_cerradas
+    ON public.sesion_resumen (usuario_id, fecha_inicio DESC, sesion_id DESC) WHERE cerrada_en IS NOT NULL;
+DROP INDEX CONCURRENTLY IF EXISTS public.idx_sesion_resumen_usuario_pagina;
+DROP INDEX CONCURRENTLY IF EXISTS public.idx_sesion_resumen_usuario_fecha;
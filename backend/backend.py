@@ -1,21 +1,68 @@
 import os
 import logging
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from starlette.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 import httpx
 import json
-
-import psycopg2
-from psycopg2 import pool, extras
+import asyncio
+import multiprocessing
+import base64
+import csv
+import io
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from starlette.concurrency import run_in_threadpool
+
+import psycopg
+from psycopg.rows import dict_row, tuple_row
+from psycopg.types.json import Jsonb
+from psycopg_pool import AsyncConnectionPool
 import bcrypt
 
-# Configuración de logs
-logging.basicConfig(level=logging.INFO)
-log = logging.getLogger("uvicorn.error")
+import bitacora
+import reglas_fatiga
+import senales
+from metricas import CONTENT_TYPE, REGISTRO, Contador, Histograma, Medidor
+from cache_respuestas import CacheRespuestas, Entrada, calcular_etag, coincide_etag
+from en_vivo import HubEnVivo
+from config_db import DB_CONFIG, DB_REPLICA_CONFIG
+
+# Configuración de logs: JSON por línea, escritos desde un hilo aparte (ver bitacora.py)
+LOG_NIVEL = os.getenv("LOG_NIVEL", "INFO")
+LOG_FORMATO = os.getenv("LOG_FORMATO", "json")   # json | texto
+bitacora.configurar(LOG_NIVEL, LOG_FORMATO)
+log = logging.getLogger("securityeye")
 
 app = FastAPI()
 
+# --- CONFIGURACIÓN BASE DE DATOS ---
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT_SEG = float(os.getenv("DB_POOL_TIMEOUT_SEG", "30"))
+
+# Réplica de lectura (opcional, ver config_db.py y RÉPLICA DE LECTURA)
+REPLICA_POOL_MIN = int(os.getenv("REPLICA_POOL_MIN", str(DB_POOL_MIN)))
+REPLICA_POOL_MAX = int(os.getenv("REPLICA_POOL_MAX", str(DB_POOL_MAX)))
+REPLICA_MAX_RETRASO_SEG = float(os.getenv("REPLICA_MAX_RETRASO_SEG", "5"))
+REPLICA_CHEQUEO_SEG = float(os.getenv("REPLICA_CHEQUEO_SEG", "2"))
+REPLICA_LECTURA_PROPIA_SEG = float(os.getenv("REPLICA_LECTURA_PROPIA_SEG", "10"))
+
+# --- CONFIGURACIÓN DIAGNÓSTICO IA (N8N) ---
+N8N_WEBHOOK_URL = os.getenv("N8N_WEBHOOK_URL", "http://localhost:5678/webhook/fatigue")
+N8N_TIMEOUT_SEG = float(os.getenv("N8N_TIMEOUT_SEG", "60"))
+DIAG_WORKERS = int(os.getenv("DIAG_WORKERS", "1"))
+DIAG_MAX_INTENTOS = int(os.getenv("DIAG_MAX_INTENTOS", "5"))
+DIAG_POLL_SEG = float(os.getenv("DIAG_POLL_SEG", "5"))
+
 # --- CONFIGURACIÓN CORS ---
 app.add_middleware(
     CORSMiddleware,
@@ -23,8 +70,170 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Request-ID"],
+)
+
+# --- MÉTRICAS (PROMETHEUS) ---
+# GET /metrics. En el camino caliente solo se suman números en dicts (metricas.py);
+# el estado de los pools se lee recién al exponer.
+HTTP_DURACION = Histograma(
+    "securityeye_http_duracion_segundos", "Duración de las peticiones HTTP por ruta", ("metodo", "ruta")
+)
+HTTP_RESPUESTAS = Contador(
+    "securityeye_http_respuestas_total", "Respuestas HTTP por ruta y código", ("metodo", "ruta", "codigo")
+)
+HTTP_EN_CURSO = Medidor("securityeye_http_en_curso", "Peticiones HTTP en curso", ("metodo",))
+DB_ESPERA = Histograma("securityeye_db_espera_conexion_segundos", "Espera hasta obtener una conexión del pool")
+DB_POOL = Medidor("securityeye_db_pool_conexiones", "Conexiones del pool por estado", ("pool", "estado"))
+DB_POOL_PEDIDOS = Contador("securityeye_db_pool_pedidos_total", "Conexiones pedidas al pool", ("pool",))
+DB_POOL_ENCOLADOS = Contador(
+    "securityeye_db_pool_encolados_total", "Pedidos que esperaron por no haber conexión libre", ("pool",)
+)
+DB_POOL_ESPERA = Contador("securityeye_db_pool_espera_segundos_total", "Tiempo total esperando conexión", ("pool",))
+DB_POOL_ERRORES = Contador(
+    "securityeye_db_pool_errores_total", "Pedidos de conexión fallidos (timeout o pool agotado)", ("pool",)
+)
+DB_LECTURAS = Contador(
+    "securityeye_db_lecturas_total", "Lecturas por destino (primario/replica) y motivo", ("destino", "motivo")
+)
+REPLICA_RETRASO = Medidor("securityeye_replica_retraso_segundos", "Retraso de la réplica (-1 = sin respuesta)")
+N8N_DURACION = Histograma("securityeye_n8n_duracion_segundos", "Duración de las llamadas al webhook de N8N", ("resultado",))
+N8N_ERRORES = Contador("securityeye_n8n_errores_total", "Errores del webhook de N8N", ("tipo",))
+HASH_EN_CURSO = Medidor("securityeye_hash_en_curso", "Hashes de contraseña en curso o en espera")
+SNAPSHOTS_EN_BUFFER = Medidor("securityeye_snapshots_en_buffer", "Sesiones con snapshots sin volcar (write-behind)")
+
+ESTADOS_POOL = {
+    "pool_min": "minimo", "pool_max": "maximo", "pool_size": "abiertas",
+    "pool_available": "libres", "requests_waiting": "esperando",
+}
+
+class _MiddlewareMetricas:
+    """Middleware ASGI puro: latencia, código y peticiones en curso por ruta (plantilla, no URL)"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        metodo = scope["method"]
+        codigo = 500
+
+        async def enviar(mensaje):
+            nonlocal codigo
+            if mensaje["type"] == "http.response.start":
+                codigo = mensaje["status"]
+            await send(mensaje)
+
+        HTTP_EN_CURSO.inc(metodo)
+        inicio = time.perf_counter()
+        try:
+            await self.app(scope, receive, enviar)
+        finally:
+            HTTP_EN_CURSO.dec(metodo)
+            # El router deja la ruta resuelta en el scope; sin ruta (404) se agrupa aparte
+            ruta = getattr(scope.get("route"), "path", "sin_ruta")
+            HTTP_DURACION.observar(time.perf_counter() - inicio, metodo, ruta)
+            HTTP_RESPUESTAS.inc(metodo, ruta, codigo)
+
+app.add_middleware(_MiddlewareMetricas)
+
+# --- LOGS: CORRELACIÓN Y MUESTREO DE PAYLOADS ---
+# Cada petición (y las tareas que lance) loguea con su id_peticion: el X-Request-ID
+# entrante o uno nuevo, devuelto en la respuesta. Los cuerpos de petición se loguean
+# solo en las rutas activadas, con una fracción y un tope por segundo; se cambian en
+# caliente con PUT /admin/logs/muestreo; con varios workers el cambio se reparte por
+# NOTIFY en LOGS_CANAL (LOGS_NOTIFY, independiente de VIVO_NOTIFY).
+LOGS_CANAL = "securityeye_logs"
+LOGS_NOTIFY = os.getenv("LOGS_NOTIFY", "1") == "1"   # 0 con un solo worker
+LOG_PAYLOAD_RUTAS = os.getenv("LOG_PAYLOAD_RUTAS", "")   # "/save-fatigue=0.01,/login=0.1"
+LOG_PAYLOAD_POR_SEG = int(os.getenv("LOG_PAYLOAD_POR_SEG", "5"))
+LOG_PAYLOAD_MAX_BYTES = int(os.getenv("LOG_PAYLOAD_MAX_BYTES", "16384"))
+
+muestreo_payloads = bitacora.MuestreoPayloads(
+    bitacora.MuestreoPayloads.parsear(LOG_PAYLOAD_RUTAS), LOG_PAYLOAD_POR_SEG, LOG_PAYLOAD_MAX_BYTES
 )
 
+class _MiddlewareLogs:
+    """Middleware ASGI puro: id de correlación por petición y payloads muestreados por ruta"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            return await self.app(scope, receive, send)
+        entrante = dict(scope["headers"]).get(b"x-request-id")
+        id_peticion = entrante.decode("latin-1")[:64] if entrante else uuid.uuid4().hex[:16]
+        token = bitacora.id_peticion.set(id_peticion)
+        if scope["type"] == "websocket":
+            try:
+                return await self.app(scope, receive, send)
+            finally:
+                bitacora.id_peticion.reset(token)
+
+        cuerpo, truncado, decidido = None, False, False
+
+        async def recibir():
+            nonlocal cuerpo, truncado, decidido
+            mensaje = await receive()
+            if mensaje["type"] == "http.request":
+                # El cuerpo se lee ya dentro del endpoint: la ruta está resuelta en el scope
+                if not decidido:
+                    decidido = True
+                    if muestreo_payloads.elegir(getattr(scope.get("route"), "path", None)):
+                        cuerpo = bytearray()
+                if cuerpo is not None:
+                    parte = mensaje.get("body", b"")
+                    libre = muestreo_payloads.max_bytes - len(cuerpo)
+                    truncado = truncado or len(parte) > libre
+                    cuerpo += parte[:max(libre, 0)]
+            return mensaje
+
+        async def enviar(mensaje):
+            if mensaje["type"] == "http.response.start":
+                mensaje["headers"] = list(mensaje.get("headers", [])) + [
+                    (b"x-request-id", id_peticion.encode("latin-1"))
+                ]
+            await send(mensaje)
+
+        try:
+            await self.app(scope, recibir, enviar)
+        finally:
+            if cuerpo is not None:
+                log.info("Payload muestreado", extra={
+                    "metodo": scope["method"],
+                    "ruta": scope["route"].path,
+                    "payload": bitacora.resumir_payload(bytes(cuerpo), truncado),
+                })
+            bitacora.id_peticion.reset(token)
+
+# Último en agregarse = más externo: el id ya está fijado en las métricas y en el endpoint
+app.add_middleware(_MiddlewareLogs)
+
+@REGISTRO.al_exponer
+def _recolectar_pools():
+    for nombre, atributo in (("primario", "db_pool"), ("replica", "db_pool_replica")):
+        db_pool = getattr(app.state, atributo, None)
+        if not db_pool:
+            continue
+        stats = db_pool.get_stats()
+        for clave, estado in ESTADOS_POOL.items():
+            DB_POOL.fijar(stats.get(clave, 0), nombre, estado)
+        DB_POOL_PEDIDOS.fijar(stats.get("requests_num", 0), nombre)
+        DB_POOL_ENCOLADOS.fijar(stats.get("requests_queued", 0), nombre)
+        DB_POOL_ESPERA.fijar(stats.get("requests_wait_ms", 0) / 1000, nombre)
+        DB_POOL_ERRORES.fijar(stats.get("requests_errors", 0), nombre)
+    if getattr(app.state, "db_pool_replica", None):
+        retraso = app.state.replica_retraso
+        REPLICA_RETRASO.fijar(-1 if retraso == float("inf") else retraso)
+    HASH_EN_CURSO.fijar(getattr(app.state, "hash_en_curso", 0))
+    SNAPSHOTS_EN_BUFFER.fijar(len(_snapshots_pendientes))
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    return Response(content=REGISTRO.exponer(), media_type=CONTENT_TYPE)
+
 # --- MODELOS DE DATOS ---
 class Login(BaseModel):
     correo: str
@@ -53,6 +262,7 @@ class FatigueResult(BaseModel):
     max_sin_parpadeo: int
     alertas: int
     momentos_fatiga: list = []
+    seq: int | None = None  # número de secuencia del snapshot dentro de la sesión (creciente)
 
 class ActividadDescanso(BaseModel):
     id: int
@@ -62,105 +272,560 @@ class ActividadDescanso(BaseModel):
 
 class DashboardRequest(BaseModel):
     usuario_id: int
+    limite: int = 20
+    cursor: str | None = None  # siguiente_cursor de la página anterior
 
 class DetailRequest(BaseModel):
     sesion_id: int
 
 # --- BASE DE DATOS ---
+# Pool asíncrono (psycopg 3): ninguna consulta bloquea el event loop y el pool
+# es seguro para uso concurrente desde cualquier endpoint o tarea de fondo.
 @app.on_event("startup")
-def startup():
+async def startup():
     try:
-        db_config = {
-            "host": os.getenv("DB_HOST", "127.0.0.1"),
-            "port": int(os.getenv("DB_PORT", "5432")),
-            "database": os.getenv("DB_NAME", "pry_lectura1"),
-            "user": os.getenv("DB_USER", "postgres"),
-            "password": os.getenv("DB_PASS", "123"),
-        }
-        app.state.db_pool = pool.SimpleConnectionPool(1, 10, **db_config)
-        log.info("Conexión a base de datos establecida.")
+        app.state.db_pool = AsyncConnectionPool(
+            kwargs={**DB_CONFIG, "row_factory": dict_row},
+            min_size=DB_POOL_MIN,
+            max_size=DB_POOL_MAX,
+            timeout=DB_POOL_TIMEOUT_SEG,
+            open=False,
+        )
+        await app.state.db_pool.open(wait=True)
+        log.info(f"Conexión a base de datos establecida (pool {DB_POOL_MIN}-{DB_POOL_MAX}).")
     except Exception as e:
         log.exception("Error conectando a PostgreSQL")
         raise e
 
+    if DB_REPLICA_CONFIG:
+        # Sin esperar: si la réplica no responde, las lecturas siguen en el primario
+        app.state.replica_retraso = float("inf")
+        app.state.db_pool_replica = AsyncConnectionPool(
+            kwargs={**DB_REPLICA_CONFIG, "row_factory": dict_row},
+            min_size=REPLICA_POOL_MIN,
+            max_size=REPLICA_POOL_MAX,
+            timeout=DB_POOL_TIMEOUT_SEG,
+            open=False,
+        )
+        await app.state.db_pool_replica.open(wait=False)
+        app.state.replica_tarea = asyncio.create_task(_vigilar_replica())
+        log.info(f"Réplica de lectura en {DB_REPLICA_CONFIG['host']}:{DB_REPLICA_CONFIG['port']} "
+                 f"(pool {REPLICA_POOL_MIN}-{REPLICA_POOL_MAX}, retraso máx. {REPLICA_MAX_RETRASO_SEG}s)")
+
 @app.on_event("shutdown")
-def shutdown():
+async def shutdown():
+    # Detener las tareas de fondo antes de cerrar el pool que usan; primero volcar
+    # los snapshots en buffer (encolan diagnósticos que se procesan al reiniciar)
+    await _detener_write_behind()
+    await _detener_escucha_avisos()
+    await _detener_workers_diagnostico()
+    await _detener_mantenimiento()
+    _detener_pool_hash()
+    replica_tarea = getattr(app.state, "replica_tarea", None)
+    if replica_tarea:
+        replica_tarea.cancel()
+    db_pool_replica = getattr(app.state, "db_pool_replica", None)
+    if db_pool_replica:
+        await db_pool_replica.close()
     db_pool = getattr(app.state, "db_pool", None)
     if db_pool:
-        db_pool.closeall()
+        await db_pool.close()
 
-def _get_conn_from_pool():
-    db_pool = getattr(app.state, "db_pool", None)
+@asynccontextmanager
+async def _db_conn(db_pool=None):
+    """
+    Presta una conexión del pool (por defecto, el del primario) durante el bloque `async with`.
+    Al salir hace commit si no hubo excepción (rollback si la hubo) y la devuelve al pool.
+    """
+    db_pool = db_pool or getattr(app.state, "db_pool", None)
     if not db_pool:
         raise HTTPException(status_code=500, detail="Conexión BD no disponible")
-    return db_pool.getconn()
+    inicio = time.perf_counter()
+    async with db_pool.connection() as conn:
+        DB_ESPERA.observar(time.perf_counter() - inicio)
+        yield conn
+
+# --- RÉPLICA DE LECTURA ---
+# Con DB_REPLICA_HOST, los endpoints de solo lectura (historial, detalle de sesión,
+# listado y exportación de admin) leen de un pool aparte contra la réplica y dejan
+# el primario a las escrituras. Vuelven al primario si la réplica se atrasa más de
+# REPLICA_MAX_RETRASO_SEG (o no responde) y, para leer lo propio, si la sesión o el
+# usuario se escribieron en este worker hace menos de REPLICA_LECTURA_PROPIA_SEG.
+_escrituras_recientes = OrderedDict()   # ("sesion" | "usuario", id) -> monotonic de la escritura
+
+RETRASO_REPLICA_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END AS retraso
+"""
+
+async def _vigilar_replica():
+    while True:
+        try:
+            async with app.state.db_pool_replica.connection(timeout=REPLICA_CHEQUEO_SEG) as conn:
+                fila = await (await conn.execute(RETRASO_REPLICA_SQL)).fetchone()
+            app.state.replica_retraso = float(fila["retraso"])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if app.state.replica_retraso != float("inf"):
+                log.error("Réplica sin respuesta, lecturas al primario: %s", e)
+            app.state.replica_retraso = float("inf")
+        await asyncio.sleep(REPLICA_CHEQUEO_SEG)
+
+def _marcar_escritura(sesiones=(), usuarios=()):
+    if getattr(app.state, "db_pool_replica", None) is None:
+        return
+    ahora = time.monotonic()
+    for clave in [("sesion", s) for s in sesiones] + [("usuario", u) for u in usuarios if u is not None]:
+        _escrituras_recientes[clave] = ahora
+        _escrituras_recientes.move_to_end(clave)
+    # En orden de escritura: basta podar desde el principio
+    limite = ahora - REPLICA_LECTURA_PROPIA_SEG
+    while _escrituras_recientes and next(iter(_escrituras_recientes.values())) < limite:
+        _escrituras_recientes.popitem(last=False)
+
+def _motivo_primario(claves):
+    """None si la lectura puede ir a la réplica; si no, el motivo para usar el primario"""
+    if getattr(app.state, "db_pool_replica", None) is None:
+        return "sin_replica"
+    if app.state.replica_retraso > REPLICA_MAX_RETRASO_SEG:
+        return "retraso"
+    limite = time.monotonic() - REPLICA_LECTURA_PROPIA_SEG
+    if any(_escrituras_recientes.get(clave, 0) >= limite for clave in claves):
+        return "escritura_reciente"
+    return None
+
+@asynccontextmanager
+async def _db_conn_lectura(*claves):
+    """Como _db_conn, para endpoints de solo lectura; claves: ("sesion", id) / ("usuario", id) leídos"""
+    motivo = _motivo_primario(claves)
+    DB_LECTURAS.inc("primario" if motivo else "replica", motivo or "al_dia")
+    async with _db_conn(None if motivo else app.state.db_pool_replica) as conn:
+        yield conn
+
+# --- CACHÉ DE RESPUESTAS ---
+# Una sesión cerrada y con diagnóstico ya no cambia: /sesiones/{id} y
+# /get-or-create-diagnosis se sirven desde una LRU en memoria con ETag fuerte, y un
+# If-None-Match que coincide se responde 304 sin pedir conexión al pool.
+# Las escrituras de la sesión invalidan después del commit; como la caché es por
+# worker, las entradas además vencen a los CACHE_TTL_SEG segundos.
+CACHE_MAX_ENTRADAS = int(os.getenv("CACHE_MAX_ENTRADAS", "1024"))
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+CACHE_TTL_SEG = float(os.getenv("CACHE_TTL_SEG", "60"))
+CACHE_CONTROL = "private, no-cache"  # el navegador guarda, pero revalida siempre con el ETag
+
+cache_respuestas = CacheRespuestas(CACHE_MAX_ENTRADAS, CACHE_MAX_BYTES, CACHE_TTL_SEG)
+
+def _invalidar_sesiones(sesion_ids):
+    """Tras el commit de una escritura: la caché se invalida y la réplica no sirve esas sesiones por un rato"""
+    _marcar_escritura(sesiones=sesion_ids)
+    cache_respuestas.invalidar(*(
+        (ruta, sid) for sid in sesion_ids for ruta in ("sesion", "diagnostico")
+    ))
+
+def _respuesta_cacheada(request, entrada):
+    headers = {"ETag": entrada.etag, "Cache-Control": CACHE_CONTROL}
+    if coincide_etag(request.headers.get("if-none-match"), entrada.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=entrada.cuerpo, media_type="application/json", headers=headers)
+
+def _cachear(request, clave, contenido, marca):
+    """Guarda la respuesta (si la clave no se invalidó desde `marca`) y responde con su ETag"""
+    cuerpo = JSONResponse(content=jsonable_encoder(contenido)).body
+    entrada = cache_respuestas.guardar(clave, cuerpo, marca)
+    if entrada is None:
+        return Response(content=cuerpo, media_type="application/json")
+    return _respuesta_cacheada(request, entrada)
+
+# --- COLA DE DIAGNÓSTICO IA ---
+# La tabla diagnosticos_cola guarda, por sesión, el último payload pendiente de
+# enviar a N8N. Cada /save-fatigue lo reemplaza (coalescencia) y un worker en
+# segundo plano lo procesa fuera del request.
+
+async def _encolar_diagnosticos(cur, pendientes):
+    """
+    Encola (o reemplaza) el diagnóstico de varias sesiones dentro de la transacción actual.
+    pendientes: {sesion_id: payload}
+    """
+    await cur.execute(
+        """
+        INSERT INTO diagnosticos_cola (sesion_id, payload)
+        SELECT * FROM unnest(%s::integer[], %s::jsonb[])
+        ON CONFLICT (sesion_id) DO UPDATE SET
+            payload = EXCLUDED.payload,
+            version = diagnosticos_cola.version + 1,
+            estado = CASE WHEN diagnosticos_cola.estado = 'procesando'
+                          THEN 'procesando' ELSE 'pendiente' END,
+            intentos = 0,
+            disponible_en = NOW(),
+            actualizado_en = NOW(),
+            ultimo_error = NULL
+        -- Un snapshot que llega tarde (otro worker, volcado diferido) no pisa uno más reciente
+        WHERE COALESCE((EXCLUDED.payload->>'tiempo_total_seg')::numeric, 0)
+           >= COALESCE((diagnosticos_cola.payload->>'tiempo_total_seg')::numeric, 0)
+        """,
+        (list(pendientes.keys()), [Jsonb(p) for p in pendientes.values()]),
+    )
+
+def _despertar_worker_diagnostico():
+    evento = getattr(app.state, "diag_evento", None)
+    if evento:
+        evento.set()
+
+# Las consultas calientes son constantes del módulo: verificar_planes.py revisa sus
+# planes importándolas desde aquí.
+CONSULTA_TOMAR_TRABAJO = """
+    UPDATE diagnosticos_cola
+    SET estado = 'procesando', intentos = intentos + 1, actualizado_en = NOW()
+    WHERE sesion_id = (
+        SELECT sesion_id FROM diagnosticos_cola
+        WHERE (estado = 'pendiente' AND disponible_en <= NOW())
+           OR (estado = 'procesando' AND actualizado_en < NOW() - INTERVAL '5 minutes')
+        ORDER BY disponible_en
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING sesion_id, payload, version, intentos
+"""
+
+async def _tomar_trabajo_diagnostico():
+    """Reclama un trabajo pendiente (o uno abandonado en 'procesando') con SKIP LOCKED"""
+    async with _db_conn() as conn:
+        cur = await conn.execute(CONSULTA_TOMAR_TRABAJO)
+        return await cur.fetchone()
+
+async def _guardar_diagnostico(cur, sesion_id, diagnostico, reglas_version=None):
+    """
+    Upsert en diagnosticos_ia y copia en sesion_resumen, en la misma sentencia.
+    reglas_version: versión de reglas_fatiga si es local (None si viene de N8N).
+    """
+    await cur.execute(
+        """
+        WITH d AS (
+            INSERT INTO diagnosticos_ia (sesion_id, diagnostico_json, reglas_version) VALUES (%s, %s, %s)
+            ON CONFLICT (sesion_id) DO UPDATE SET
+                diagnostico_json = EXCLUDED.diagnostico_json,
+                reglas_version = EXCLUDED.reglas_version
+            RETURNING sesion_id, diagnostico_json
+        )
+        UPDATE sesion_resumen r SET diagnostico_json = d.diagnostico_json FROM d WHERE r.sesion_id = d.sesion_id
+        """,
+        (sesion_id, Jsonb(diagnostico), reglas_version)
+    )
 
-def _put_conn_back(conn):
-    db_pool = getattr(app.state, "db_pool", None)
-    if db_pool:
-        db_pool.putconn(conn)
+async def _completar_trabajo_diagnostico(sesion_id, version, diagnostico):
+    async with _db_conn() as conn:
+        cur = conn.cursor()
+        await _guardar_diagnostico(cur, sesion_id, diagnostico)
+        await cur.execute(
+            "DELETE FROM diagnosticos_cola WHERE sesion_id = %s AND version = %s",
+            (sesion_id, version)
+        )
+        if cur.rowcount == 0:
+            # Llegó un snapshot más reciente mientras se procesaba: volver a encolar
+            await cur.execute(
+                "UPDATE diagnosticos_cola SET estado = 'pendiente', disponible_en = NOW() WHERE sesion_id = %s",
+                (sesion_id,)
+            )
+    _invalidar_sesiones([sesion_id])
 
-# --- ENDPOINTS AUTH ---
-@app.post("/register")
-def register_user(data: Register):
-    conn = None
-    cur = None
+async def _fallar_trabajo_diagnostico(sesion_id, version, intentos, error):
+    espera_seg = min(300, 5 * 2 ** (intentos - 1))
+    async with _db_conn() as conn:
+        await conn.execute(
+            """
+            UPDATE diagnosticos_cola SET
+                estado = CASE
+                    WHEN version <> %s THEN 'pendiente'
+                    WHEN intentos >= %s THEN 'error'
+                    ELSE 'pendiente' END,
+                disponible_en = CASE
+                    WHEN version <> %s THEN NOW()
+                    ELSE NOW() + make_interval(secs => %s) END,
+                actualizado_en = NOW(),
+                ultimo_error = %s
+            WHERE sesion_id = %s
+            """,
+            (version, DIAG_MAX_INTENTOS, version, espera_seg, error[:500], sesion_id)
+        )
+
+async def _llamar_n8n(payload):
+    client = app.state.http_client
+    inicio = time.perf_counter()
+    resultado = "error"
     try:
-        conn = _get_conn_from_pool()
-        cur = conn.cursor(cursor_factory=extras.RealDictCursor)
+        response = await client.post(N8N_WEBHOOK_URL, json=payload, timeout=N8N_TIMEOUT_SEG)
+        response.raise_for_status()
+        responseData = response.json()
+        resultado = "ok"
+    except httpx.TimeoutException:
+        N8N_ERRORES.inc("timeout")
+        raise
+    except httpx.HTTPStatusError:
+        N8N_ERRORES.inc("http")
+        raise
+    except httpx.HTTPError:
+        N8N_ERRORES.inc("red")
+        raise
+    except ValueError:
+        N8N_ERRORES.inc("respuesta")
+        raise
+    finally:
+        N8N_DURACION.observar(time.perf_counter() - inicio, resultado)
+    return responseData[0]['json'] if isinstance(responseData, list) and responseData and 'json' in responseData[0] else responseData
 
-        # Verificar correo único
-        cur.execute("SELECT 1 FROM usuarios WHERE correo = %s", (data.correo,))
-        if cur.fetchone():
-            raise HTTPException(status_code=400, detail="El correo ya está registrado")
+async def _worker_diagnostico(evento):
+    while True:
+        try:
+            trabajo = await _tomar_trabajo_diagnostico()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("Error leyendo la cola de diagnóstico")
+            trabajo = None
+
+        if not trabajo:
+            evento.clear()
+            try:
+                await asyncio.wait_for(evento.wait(), timeout=DIAG_POLL_SEG)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        sesion_id = trabajo["sesion_id"]
+        try:
+            diagnostico = await _llamar_n8n(trabajo["payload"])
+            if not diagnostico:
+                raise ValueError("Respuesta vacía de N8N")
+            await _completar_trabajo_diagnostico(sesion_id, trabajo["version"], diagnostico)
+            log.info("Diagnóstico IA guardado", extra={"sesion_id": sesion_id})
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.error("Error al contactar N8N: %s", e, extra={"sesion_id": sesion_id, "intento": trabajo["intentos"]})
+            try:
+                await _fallar_trabajo_diagnostico(sesion_id, trabajo["version"], trabajo["intentos"], str(e))
+            except Exception:
+                log.exception("Error registrando fallo de diagnóstico")
 
-        # Hash de contraseña
-        hashed_pw = bcrypt.hashpw(data.contrasena.encode("utf-8"), bcrypt.gensalt())
+@app.on_event("startup")
+async def iniciar_workers_diagnostico():
+    app.state.http_client = httpx.AsyncClient()
+    app.state.diag_evento = asyncio.Event()
+    app.state.diag_workers = []
+    if N8N_WEBHOOK_URL:
+        app.state.diag_workers = [
+            asyncio.create_task(_worker_diagnostico(app.state.diag_evento))
+            for _ in range(DIAG_WORKERS)
+        ]
+        log.info(f"Workers de diagnóstico IA iniciados: {DIAG_WORKERS}")
+
+async def _detener_workers_diagnostico():
+    for tarea in getattr(app.state, "diag_workers", []):
+        tarea.cancel()
+    for tarea in getattr(app.state, "diag_workers", []):
+        try:
+            await tarea
+        except asyncio.CancelledError:
+            pass
+    client = getattr(app.state, "http_client", None)
+    if client:
+        await client.aclose()
+
+# --- MANTENIMIENTO DE PARTICIONES ---
+# `muestras` está particionada por mes. Cada MANTENIMIENTO_SEG se aseguran las
+# particiones del mes actual y los siguientes y, si MUESTRAS_RETENCION_MESES > 0,
+# las de meses más viejos se agregan por minuto (muestras_minuto) y se eliminan.
+# Las funciones SQL viven en SQL/migrations/0003 y toman su propio advisory lock.
+# La primera pasada corre en el startup: si después de ella falta la partición del mes
+# siguiente el backend no arranca (las filas sin partición irían a muestras_default, 0006).
+MANTENIMIENTO_SEG = float(os.getenv("MANTENIMIENTO_SEG", "3600"))
+MUESTRAS_MESES_ADELANTE = int(os.getenv("MUESTRAS_MESES_ADELANTE", "2"))
+MUESTRAS_RETENCION_MESES = int(os.getenv("MUESTRAS_RETENCION_MESES", "0"))  # 0 = sin retención
+# Sesiones sin snapshots hace más de esto (clientes HTTP que nunca llamaron a /end-session)
+# se cierran en cada pasada: el historial y el acumulado solo cuentan sesiones con cerrada_en
+SESION_ABANDONO_SEG = float(os.getenv("SESION_ABANDONO_SEG", "3600"))  # 0 = no cerrar
+
+async def _mantener_particiones():
+    async with _db_conn() as conn:
+        await conn.execute("SELECT crear_particiones_muestras(%s)", (MUESTRAS_MESES_ADELANTE,))
+        if MUESTRAS_RETENCION_MESES > 0:
+            cur = await conn.execute(
+                "SELECT retener_muestras(make_interval(months => %s)) AS retenidas",
+                (MUESTRAS_RETENCION_MESES,)
+            )
+            retenidas = (await cur.fetchone())["retenidas"]
+            if retenidas:
+                log.info(f"Particiones de muestras retenidas (agregadas por minuto): {retenidas}")
 
-        cur.execute(
+async def _verificar_particion_siguiente():
+    async with _db_conn() as conn:
+        cur = await conn.execute(
             """
-            INSERT INTO usuarios (nombre, apellido, correo, contrasena, rol_id)
-            VALUES (%s, %s, %s, %s, 2) RETURNING id
+            SELECT nombre, to_regclass('public.' || nombre) IS NOT NULL AS existe
+            FROM (SELECT 'muestras_' || to_char(date_trunc('month', NOW()) + INTERVAL '1 month', 'YYYYMM') AS nombre) p
+            """
+        )
+        fila = await cur.fetchone()
+    if not fila["existe"]:
+        raise RuntimeError(f"Falta la partición {fila['nombre']} de muestras (revisar crear_particiones_muestras)")
+
+async def _cerrar_abandonadas():
+    if SESION_ABANDONO_SEG <= 0:
+        return
+    async with _db_conn() as conn:
+        cur = await conn.execute(
+            """
+            SELECT s.id FROM sesiones s JOIN sesion_resumen r ON r.sesion_id = s.id
+            WHERE s.cerrada_en IS NULL
+              AND r.actualizado_en < NOW() - make_interval(secs => %s)
             """,
-            (data.nombre, data.apellido, data.correo, hashed_pw.decode("utf-8")),
+            (SESION_ABANDONO_SEG,)
         )
-        conn.commit()
+        ids = [f["id"] for f in await cur.fetchall()]
+    for sesion_id in ids:
+        await _terminar_sesion(sesion_id)
+    if ids:
+        log.info(f"Sesiones abandonadas cerradas: {len(ids)}")
+
+async def _tarea_mantenimiento():
+    while True:
+        await asyncio.sleep(MANTENIMIENTO_SEG)
+        try:
+            await _mantener_particiones()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("Error en mantenimiento de particiones")
+        try:
+            await _cerrar_abandonadas()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("Error cerrando sesiones abandonadas")
+
+@app.on_event("startup")
+async def iniciar_mantenimiento():
+    await _mantener_particiones()
+    await _verificar_particion_siguiente()
+    app.state.mantenimiento = asyncio.create_task(_tarea_mantenimiento())
+
+async def _detener_mantenimiento():
+    tarea = getattr(app.state, "mantenimiento", None)
+    if tarea:
+        tarea.cancel()
+        try:
+            await tarea
+        except asyncio.CancelledError:
+            pass
+
+# --- HASH DE CONTRASEÑAS ---
+# bcrypt es CPU puro (~250 ms por hash con el costo por defecto). Corre en un pool de
+# procesos propio, así una ráfaga de logins (toda una clase a la vez) no ocupa el
+# threadpool ni el event loop, y nunca con una conexión de BD prestada.
+# Backpressure: con HASH_COLA_MAX hashes en curso o en espera se responde 429; si un
+# hash no termina en HASH_ESPERA_SEG (o el pool se rompió) se responde 503.
+HASH_PROCESOS = int(os.getenv("HASH_PROCESOS", str(os.cpu_count() or 1)))
+HASH_COLA_MAX = int(os.getenv("HASH_COLA_MAX", str(8 * HASH_PROCESOS)))
+HASH_ESPERA_SEG = float(os.getenv("HASH_ESPERA_SEG", "10"))
+
+def _crear_pool_hash():
+    return ProcessPoolExecutor(max_workers=HASH_PROCESOS, mp_context=multiprocessing.get_context("spawn"))
+
+@app.on_event("startup")
+async def iniciar_pool_hash():
+    app.state.hash_pool = _crear_pool_hash()
+    app.state.hash_en_curso = 0
+    log.info(f"Pool de hash de contraseñas: {HASH_PROCESOS} procesos, cola máx. {HASH_COLA_MAX}")
+
+def _detener_pool_hash():
+    hash_pool = getattr(app.state, "hash_pool", None)
+    if hash_pool:
+        hash_pool.shutdown(wait=False, cancel_futures=True)
+
+def _liberar_hash(_):
+    app.state.hash_en_curso -= 1
+
+async def _en_pool_hash(funcion, *args):
+    if app.state.hash_en_curso >= HASH_COLA_MAX:
+        raise HTTPException(
+            status_code=429, detail="Demasiadas solicitudes de acceso, reintenta en unos segundos",
+            headers={"Retry-After": "2"},
+        )
+    try:
+        futuro = asyncio.get_running_loop().run_in_executor(app.state.hash_pool, funcion, *args)
+    except BrokenProcessPool:
+        log.error("Pool de hash roto, recreándolo")
+        app.state.hash_pool = _crear_pool_hash()
+        raise HTTPException(status_code=503, detail="Autenticación no disponible", headers={"Retry-After": "2"})
+    # El cupo se libera cuando el hash termina de verdad, aunque este request deje de esperar
+    app.state.hash_en_curso += 1
+    futuro.add_done_callback(_liberar_hash)
+    try:
+        return await asyncio.wait_for(asyncio.shield(futuro), HASH_ESPERA_SEG)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail="Autenticación saturada", headers={"Retry-After": "5"})
+    except BrokenProcessPool:
+        log.error("Pool de hash roto, recreándolo")
+        app.state.hash_pool = _crear_pool_hash()
+        raise HTTPException(status_code=503, detail="Autenticación no disponible", headers={"Retry-After": "2"})
+
+# --- ENDPOINTS AUTH ---
+@app.post("/register")
+async def register_user(data: Register):
+    try:
+        # Hash antes de pedir conexión: el pool de BD no espera al CPU
+        hashed_pw = await _en_pool_hash(bcrypt.hashpw, data.contrasena.encode("utf-8"), bcrypt.gensalt())
+
+        async with _db_conn() as conn:
+            cur = conn.cursor()
+
+            # Verificar correo único
+            await cur.execute("SELECT 1 FROM usuarios WHERE correo = %s", (data.correo,))
+            if await cur.fetchone():
+                raise HTTPException(status_code=400, detail="El correo ya está registrado")
+
+            await cur.execute(
+                """
+                INSERT INTO usuarios (nombre, apellido, correo, contrasena, rol_id)
+                VALUES (%s, %s, %s, %s, 2) RETURNING id
+                """,
+                (data.nombre, data.apellido, data.correo, hashed_pw.decode("utf-8")),
+            )
         return {"mensaje": "Usuario registrado correctamente"}
+    except HTTPException:
+        raise
     except Exception:
         log.exception("Error en /register") # Loguear el traceback completo
-        if conn:
-            conn.rollback()
         raise HTTPException(status_code=500, detail="Error servidor")
-    finally:
-        if conn:
-            _put_conn_back(conn)
 
 @app.post("/login")
-def login_user(data: Login):
-    conn = None
+async def login_user(data: Login):
     try:
-        conn = _get_conn_from_pool()
-        cur = conn.cursor(cursor_factory=extras.RealDictCursor)
-
-        cur.execute(
-            """
-            SELECT u.id, u.nombre, u.apellido, u.correo, u.contrasena,
-                   r.nombre AS rol_nombre, u.rol_id
-            FROM usuarios u
-            LEFT JOIN roles r ON r.id = u.rol_id
-            WHERE correo = %s
-            """,
-            (data.correo,),
-        )
-        user = cur.fetchone()
+        async with _db_conn() as conn:
+            cur = await conn.execute(
+                """
+                SELECT u.id, u.nombre, u.apellido, u.correo, u.contrasena,
+                       r.nombre AS rol_nombre, u.rol_id
+                FROM usuarios u
+                LEFT JOIN roles r ON r.id = u.rol_id
+                WHERE correo = %s
+                """,
+                (data.correo,),
+            )
+            user = await cur.fetchone()
 
-        if not user or not bcrypt.checkpw(
-            data.contrasena.encode("utf-8"), user["contrasena"].encode("utf-8")
+        # Verificar con la conexión ya devuelta al pool
+        if not user or not await _en_pool_hash(
+            bcrypt.checkpw, data.contrasena.encode("utf-8"), user["contrasena"].encode("utf-8")
         ):
             raise HTTPException(status_code=401, detail="Credenciales incorrectas")
 
-        cur.execute("UPDATE usuarios SET ultimo_acceso = NOW() WHERE id = %s", (user["id"],))
-        conn.commit()
+        async with _db_conn() as conn:
+            await conn.execute("UPDATE usuarios SET ultimo_acceso = NOW() WHERE id = %s", (user["id"],))
 
         # Normalizar el nombre del rol para que coincida con el frontend
         rol_normalizado = "admin" if user["rol_nombre"] == "Administrador" else "usuario"
@@ -175,16 +840,9 @@ def login_user(data: Login):
             },
         }
     except HTTPException:
-        if conn:
-            conn.rollback()
         raise
     except Exception:
-        if conn:
-            conn.rollback()
         raise HTTPException(status_code=500, detail="Error interno")
-    finally:
-        if conn:
-            _put_conn_back(conn)
 
 # --- ENDPOINTS DATOS ---
 @app.post("/create-session")
@@ -194,7 +852,6 @@ async def create_session(data: dict):
     Input: {usuario_id, tipo_actividad, fuente (opcional)}
     Output: {sesion_id}
     """
-    conn = None
     try:
         usuario_id = data.get('usuario_id')
         tipo_actividad = data.get('tipo_actividad')  # 'pdf' | 'video'
@@ -203,218 +860,915 @@ async def create_session(data: dict):
         if not usuario_id or not tipo_actividad:
             raise HTTPException(status_code=400, detail="Faltan parámetros: usuario_id y tipo_actividad")
 
-        conn = _get_conn_from_pool()
-        cur = conn.cursor(cursor_factory=extras.RealDictCursor)
-
-        # Insertar nueva sesión
-        cur.execute(
-            """
-            INSERT INTO sesiones (usuario_id, tipo_actividad, fuente, fecha_inicio)
-            VALUES (%s, %s, %s, NOW())
-            RETURNING id
-            """,
-            (usuario_id, tipo_actividad, fuente)
-        )
-        sesion = cur.fetchone()
-        conn.commit()
+        async with _db_conn() as conn:
+            # Insertar nueva sesión (y su fila de resumen)
+            cur = conn.cursor()
+            sesion_id = await _crear_sesion(cur, usuario_id, tipo_actividad, fuente)
+            delta = {"sesion_id": sesion_id, "usuario_id": usuario_id, "actividad": tipo_actividad}
+            await _notificar_vivo(cur, [delta])
 
-        return {"sesion_id": sesion['id']}
+        _marcar_escritura(sesiones=[sesion_id], usuarios=[usuario_id])
+        hub_vivo.publicar([delta])
+        return {"sesion_id": sesion_id}
 
     except HTTPException:
         raise
     except Exception as e:
-        if conn:
-            conn.rollback()
         log.exception("Error creando sesión")
         raise HTTPException(status_code=500, detail=f"Error creando sesión: {str(e)}")
-    finally:
-        if conn:
-            _put_conn_back(conn)
 
-@app.post("/save-fatigue")
-async def save_fatigue(data: FatigueResult):
-    conn = None
-    mensaje_ui = None
-    diagnostico_ia = None
-    
-    try:
-        conn = _get_conn_from_pool()
-        cur = conn.cursor(cursor_factory=extras.RealDictCursor)
-
-        # Usar la sesión proporcionada; si no viene, buscar la más reciente abierta
-        if data.sesion_id:
-            sesion_id = data.sesion_id
-        else:
-            cur.execute("SELECT id FROM sesiones WHERE usuario_id = %s AND fecha_fin IS NULL ORDER BY id DESC LIMIT 1", (data.usuario_id,))
-            row = cur.fetchone()
-            if row:
-                sesion_id = row["id"]
-            else:
-                cur.execute("INSERT INTO sesiones (usuario_id, fecha_inicio) VALUES (%s, NOW()) RETURNING id", (data.usuario_id,))
-                sesion_id = cur.fetchone()["id"]
+async def _crear_sesion(cur, usuario_id, tipo_actividad=None, fuente=None):
+    """Inserta la sesión y su fila en sesion_resumen en la misma sentencia. Devuelve el id."""
+    await cur.execute(
+        """
+        WITH s AS (
+            INSERT INTO sesiones (usuario_id, tipo_actividad, fuente, fecha_inicio)
+            VALUES (%s, %s, %s, NOW())
+            RETURNING id, usuario_id, tipo_actividad, fecha_inicio
+        )
+        INSERT INTO sesion_resumen (sesion_id, usuario_id, tipo_actividad, fecha_inicio)
+        SELECT id, usuario_id, tipo_actividad, fecha_inicio FROM s
+        RETURNING sesion_id
+        """,
+        (usuario_id, tipo_actividad, fuente)
+    )
+    return (await cur.fetchone())["sesion_id"]
+
+# --- MUESTRAS Y RESUMEN POR SESIÓN ---
+# Cada snapshot se guarda como una fila angosta en `muestras`, clave (sesion_id, t),
+# con los valores puntuales de los contadores en el segundo t. La tabla está
+# particionada por mes de inicio de la sesión (sesion_inicio, ver MANTENIMIENTO). El reductor
+# (_reducir_resumen) mantiene en `sesion_resumen` el acumulado de la sesión, y los
+# momentos de fatiga nuevos se agregan a `alertas`; así cada escritura tiene tamaño
+# constante y las lecturas toman una sola fila precalculada.
+BATCH_MAX_SNAPSHOTS = int(os.getenv("BATCH_MAX_SNAPSHOTS", "1000"))
+
+def _payload_diagnostico(sesion_id, data: FatigueResult):
+    return {
+        "usuario_id": data.usuario_id,
+        "sesion_id": sesion_id,
+        "actividad": data.actividad,
+        "perclos": float(data.perclos),
+        "sebr": data.sebr,
+        "blink_rate_min": float(data.blink_rate_min),
+        "pct_incompletos": float(data.pct_incompletos),
+        "num_bostezos": data.num_bostezos,
+        "tiempo_cierre": float(data.tiempo_cierre),
+        "velocidad_ocular": float(data.velocidad_ocular),
+        "nivel_subjetivo": data.nivel_subjetivo,
+        "es_fatiga": data.es_fatiga,
+        "tiempo_total_seg": data.tiempo_total_seg,
+        "max_sin_parpadeo": data.max_sin_parpadeo,
+        "alertas": data.alertas,
+        "momentos_fatiga": data.momentos_fatiga
+    }
+
+def _columnas_muestras(snapshots):
+    """Convierte [(sesion_id, FatigueResult)] en arrays por columna para unnest()"""
+    return (
+        [sid for sid, _ in snapshots],
+        [d.tiempo_total_seg for _, d in snapshots],
+        [d.actividad for _, d in snapshots],
+        [d.perclos for _, d in snapshots],
+        [d.sebr for _, d in snapshots],
+        [d.blink_rate_min for _, d in snapshots],
+        [d.pct_incompletos for _, d in snapshots],
+        [d.tiempo_cierre for _, d in snapshots],
+        [d.num_bostezos for _, d in snapshots],
+        [d.velocidad_ocular for _, d in snapshots],
+        [d.max_sin_parpadeo for _, d in snapshots],
+        [d.alertas for _, d in snapshots],
+        [d.nivel_subjetivo for _, d in snapshots],
+        [d.es_fatiga for _, d in snapshots],
+        [d.seq for _, d in snapshots],
+    )
+
+UNNEST_MUESTRAS = """
+    unnest(%s::integer[], %s::integer[], %s::varchar[], %s::float8[], %s::integer[], %s::float8[],
+           %s::float8[], %s::float8[], %s::integer[], %s::float8[], %s::integer[], %s::integer[],
+           %s::integer[], %s::boolean[], %s::integer[])
+    AS v(sesion_id, t, actividad, perclos, parpadeos, blink_rate_min,
+         pct_incompletos, tiempo_cierre, num_bostezos, velocidad_ocular, max_sin_parpadeo, alertas,
+         nivel_subjetivo, es_fatiga, seq)
+"""
+
+# Momentos de fatiga nuevos (posteriores al último registrado) -> alertas y sesion_resumen.momentos
+CONSULTA_MOMENTOS = """
+    WITH nuevos AS (
+        INSERT INTO alertas (sesion_id, momento_seg, motivo)
+        SELECT v.sesion_id, v.t, v.motivo
+        FROM unnest(%s::integer[], %s::integer[], %s::text[]) AS v(sesion_id, t, motivo)
+        LEFT JOIN sesion_resumen r ON r.sesion_id = v.sesion_id
+        WHERE v.t > COALESCE(r.ultimo_momento_t, -1)
+        ORDER BY v.sesion_id, v.t
+        RETURNING sesion_id, momento_seg, motivo
+    )
+    UPDATE sesion_resumen r
+    SET momentos = r.momentos || n.momentos
+    FROM (
+        SELECT sesion_id, jsonb_agg(jsonb_build_object('t', momento_seg, 'reason', motivo) ORDER BY momento_seg) AS momentos
+        FROM nuevos
+        GROUP BY sesion_id
+    ) n
+    WHERE r.sesion_id = n.sesion_id
+"""
+
+async def _guardar_muestras(cur, snapshots):
+    """
+    Escribe un lote de snapshots [(sesion_id, FatigueResult)] y actualiza el resumen
+    de cada sesión afectada. Devuelve {sesion_id: snapshot más reciente}, solo para las
+    sesiones donde ese snapshot supera lo ya guardado (su seq no quedó atrás de ultimo_seq).
+    """
+    # Una fila por (sesion_id, t): si llegan duplicados gana el último recibido
+    por_clave = {(sid, d.tiempo_total_seg): (sid, d) for sid, d in snapshots}
+    filas = list(por_clave.values())
+
+    ultimos = {}
+    for sid, d in filas:
+        previo = ultimos.get(sid)
+        if previo is None or d.tiempo_total_seg >= previo.tiempo_total_seg:
+            ultimos[sid] = d
+
+    await cur.execute(
+        f"""
+        INSERT INTO muestras (sesion_id, t, sesion_inicio, perclos, parpadeos, blink_rate_min, pct_incompletos,
+                              tiempo_cierre, num_bostezos, velocidad_ocular, max_sin_parpadeo,
+                              alertas, nivel_subjetivo, es_fatiga)
+        SELECT v.sesion_id, v.t, s.fecha_inicio, v.perclos, v.parpadeos, v.blink_rate_min, v.pct_incompletos,
+               v.tiempo_cierre, v.num_bostezos, v.velocidad_ocular, v.max_sin_parpadeo,
+               v.alertas, v.nivel_subjetivo, v.es_fatiga
+        FROM {UNNEST_MUESTRAS}
+        JOIN sesiones s ON s.id = v.sesion_id
+        LEFT JOIN sesion_resumen r ON r.sesion_id = v.sesion_id
+        -- Reintentos y snapshots atrasados (seq ya visto, quizá por otro worker) no se reescriben
+        WHERE v.seq IS NULL OR r.ultimo_seq IS NULL OR v.seq > r.ultimo_seq
+        ON CONFLICT (sesion_id, t, sesion_inicio) DO UPDATE SET
+            perclos = EXCLUDED.perclos, parpadeos = EXCLUDED.parpadeos,
+            blink_rate_min = EXCLUDED.blink_rate_min, pct_incompletos = EXCLUDED.pct_incompletos,
+            tiempo_cierre = EXCLUDED.tiempo_cierre, num_bostezos = EXCLUDED.num_bostezos,
+            velocidad_ocular = EXCLUDED.velocidad_ocular, max_sin_parpadeo = EXCLUDED.max_sin_parpadeo,
+            alertas = EXCLUDED.alertas, nivel_subjetivo = EXCLUDED.nivel_subjetivo,
+            es_fatiga = EXCLUDED.es_fatiga
+        """,
+        _columnas_muestras(filas),
+    )
+
+    # Momentos de fatiga: solo los posteriores al último ya registrado para la sesión.
+    # Se copian también a sesion_resumen.momentos para leer la sesión sin tocar alertas.
+    momentos = [
+        (sid, int(round(float(m.get("t", 0)))), m.get("reason") or "Fatiga")
+        for sid, d in ultimos.items()
+        for m in d.momentos_fatiga if isinstance(m, dict)
+    ]
+    if momentos:
+        await cur.execute(
+            CONSULTA_MOMENTOS,
+            ([m[0] for m in momentos], [m[1] for m in momentos], [m[2] for m in momentos]),
+        )
 
-        # Guardar medición continua (sin etapa inicial/final)
-        estado_txt = "FATIGA" if data.es_fatiga else "NORMAL"
-        nivel_val = 1 if data.es_fatiga else 0
-        momentos_json = json.dumps(data.momentos_fatiga) if data.momentos_fatiga else None
+    vigentes = await _reducir_resumen(cur, ultimos)
+    # Un snapshot atrasado (p. ej. un reintento que llega a otro worker después de uno
+    # más nuevo) no pisa los totales de sesiones, el diagnóstico en cola ni el dashboard
+    return {sid: d for sid, d in ultimos.items() if sid in vigentes}
 
-        query = """
-            INSERT INTO mediciones (
-                sesion_id, actividad, parpadeos, blink_rate_min, perclos, pct_incompletos,
-                tiempo_cierre, num_bostezos, velocidad_ocular,
-                nivel_subjetivo, nivel_fatiga, estado_fatiga, max_sin_parpadeo, alertas, momentos_fatiga
-            ) VALUES (
-                %s,
-                %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
-            )
+async def _reducir_resumen(cur, ultimos):
+    """
+    Reductor incremental: combina el snapshot más reciente de cada sesión con su resumen.
+    Los contadores acumulativos toman el máximo y las tasas el valor del mayor t, de modo
+    que un snapshot atrasado nunca retrocede el resumen. Como /save-fatigue, marca fecha_fin
+    (salvo con un seq ya superado). Devuelve las sesiones cuyo snapshot quedó como el más nuevo.
+    """
+    ids = list(ultimos.keys())
+    ultimo_momento = [
+        max((int(round(float(m.get("t", 0)))) for m in d.momentos_fatiga if isinstance(m, dict)), default=None)
+        for d in ultimos.values()
+    ]
+    await cur.execute(
+        f"""
+        INSERT INTO sesion_resumen AS r (
+            sesion_id, t, actividad, perclos, parpadeos, blink_rate_min, pct_incompletos,
+            tiempo_cierre, num_bostezos, velocidad_ocular, max_sin_parpadeo, alertas,
+            nivel_subjetivo, es_fatiga, ultimo_seq, ultimo_momento_t, actualizado_en,
+            usuario_id, tipo_actividad, fecha_inicio, fecha_fin
+        )
+        SELECT v.*, u.ultimo_momento_t, NOW(), s.usuario_id, s.tipo_actividad, s.fecha_inicio, NOW()
+        FROM {UNNEST_MUESTRAS}
+        JOIN unnest(%s::integer[], %s::integer[]) AS u(sesion_id, ultimo_momento_t)
+          ON u.sesion_id = v.sesion_id
+        JOIN sesiones s ON s.id = v.sesion_id
+        ON CONFLICT (sesion_id) DO UPDATE SET
+            actividad = COALESCE(EXCLUDED.actividad, r.actividad),
+            perclos = CASE WHEN r.t IS NULL OR EXCLUDED.t >= r.t THEN EXCLUDED.perclos ELSE r.perclos END,
+            blink_rate_min = CASE WHEN r.t IS NULL OR EXCLUDED.t >= r.t THEN EXCLUDED.blink_rate_min ELSE r.blink_rate_min END,
+            pct_incompletos = CASE WHEN r.t IS NULL OR EXCLUDED.t >= r.t THEN EXCLUDED.pct_incompletos ELSE r.pct_incompletos END,
+            velocidad_ocular = CASE WHEN r.t IS NULL OR EXCLUDED.t >= r.t THEN EXCLUDED.velocidad_ocular ELSE r.velocidad_ocular END,
+            es_fatiga = CASE WHEN r.t IS NULL OR EXCLUDED.t >= r.t THEN EXCLUDED.es_fatiga ELSE r.es_fatiga END,
+            parpadeos = GREATEST(r.parpadeos, EXCLUDED.parpadeos),
+            tiempo_cierre = GREATEST(r.tiempo_cierre, EXCLUDED.tiempo_cierre),
+            num_bostezos = GREATEST(r.num_bostezos, EXCLUDED.num_bostezos),
+            max_sin_parpadeo = GREATEST(r.max_sin_parpadeo, EXCLUDED.max_sin_parpadeo),
+            alertas = GREATEST(r.alertas, EXCLUDED.alertas),
+            nivel_subjetivo = GREATEST(r.nivel_subjetivo, EXCLUDED.nivel_subjetivo),
+            ultimo_momento_t = GREATEST(r.ultimo_momento_t, EXCLUDED.ultimo_momento_t),
+            ultimo_seq = GREATEST(r.ultimo_seq, EXCLUDED.ultimo_seq),
+            t = GREATEST(r.t, EXCLUDED.t),
+            fecha_fin = CASE WHEN EXCLUDED.ultimo_seq IS NULL OR r.ultimo_seq IS NULL
+                                  OR EXCLUDED.ultimo_seq > r.ultimo_seq
+                             THEN EXCLUDED.fecha_fin ELSE r.fecha_fin END,
+            actualizado_en = NOW()
+        RETURNING r.sesion_id, r.ultimo_seq
+        """,
+        _columnas_muestras(list(ultimos.items())) + (ids, ultimo_momento),
+    )
+    # Tras el upsert ultimo_seq es el mayor visto: el snapshot es vigente si lo alcanza
+    return {
+        f["sesion_id"] for f in await cur.fetchall()
+        if ultimos[f["sesion_id"]].seq is None or f["ultimo_seq"] is None
+        or ultimos[f["sesion_id"]].seq >= f["ultimo_seq"]
+    }
+
+async def _actualizar_resumen_sesiones(cur, ultimos):
+    """
+    Un único UPDATE de sesiones con el snapshot más reciente de cada sesión. Solo las que
+    ya están cerradas (p. ej. el KSS final después del "fin") pasan al acumulado por
+    usuario: las que siguen corriendo no bloquean sesion_resumen ni usuario_resumen.
+    ultimos: {sesion_id: FatigueResult}
+    """
+    ids = list(ultimos.keys())
+    snaps = list(ultimos.values())
+    await cur.execute(
         """
-        cur.execute(query, (
-            sesion_id,
-            data.actividad, data.sebr, data.blink_rate_min, data.perclos, 
-            data.pct_incompletos, data.tiempo_cierre, data.num_bostezos, data.velocidad_ocular,
-            data.nivel_subjetivo, nivel_val, estado_txt, data.max_sin_parpadeo, data.alertas, momentos_json,
-        ))
-
-        # Actualizar sesión con resumen final
-        cur.execute(
-            """UPDATE sesiones SET fecha_fin = NOW(), total_segundos = %s, alertas = %s, 
-               kss_final = %s, es_fatiga = %s WHERE id = %s""",
-            (data.tiempo_total_seg, data.alertas, data.nivel_subjetivo, data.es_fatiga, sesion_id)
+        UPDATE sesiones s SET fecha_fin = NOW(), total_segundos = v.total_segundos, alertas = v.alertas,
+               kss_final = v.kss_final, es_fatiga = v.es_fatiga
+        FROM unnest(%s::integer[], %s::integer[], %s::integer[], %s::integer[], %s::boolean[])
+             AS v(id, total_segundos, alertas, kss_final, es_fatiga)
+        WHERE s.id = v.id
+        RETURNING s.id, s.cerrada_en
+        """,
+        (
+            ids,
+            [d.tiempo_total_seg for d in snaps],
+            [d.alertas for d in snaps],
+            [d.nivel_subjetivo for d in snaps],
+            [d.es_fatiga for d in snaps],
         )
+    )
+    cerradas = [f["id"] for f in await cur.fetchall() if f["cerrada_en"] is not None]
+    if cerradas:
+        await _acumular_usuarios(cur, cerradas)
 
-        # Obtener sesión_id para diagnóstico
-        cur.execute(
-            "SELECT id FROM sesiones WHERE id = %s",
-            (sesion_id,)
+async def _acumular_usuarios(cur, sesion_ids):
+    """
+    Suma a usuario_resumen el aporte de las sesiones cerradas (cerrada_en). Cada sesión
+    guarda en sesion_resumen.rollup_* lo que ya aportó, así que un snapshot que llega
+    después del cierre (el KSS final) solo suma la diferencia y nada cuenta doble.
+    """
+    ids = sorted(set(sesion_ids))
+    # Bloquear primero: la sentencia siguiente toma una foto nueva con el aporte vigente
+    await cur.execute(
+        "SELECT 1 FROM sesion_resumen WHERE sesion_id = ANY(%s) ORDER BY sesion_id FOR UPDATE",
+        (ids,)
+    )
+    await cur.execute(
+        """
+        WITH deltas AS (
+            UPDATE sesion_resumen r
+            SET rollup_segundos = COALESCE(r.t, 0),
+                rollup_alertas = COALESCE(r.alertas, 0),
+                rollup_perclos = r.perclos
+            FROM sesion_resumen prev
+            WHERE prev.sesion_id = r.sesion_id
+              AND r.sesion_id = ANY(%s)
+              AND r.cerrada_en IS NOT NULL
+              AND r.usuario_id IS NOT NULL
+            RETURNING
+                r.usuario_id,
+                (prev.rollup_segundos IS NULL)::integer AS d_sesiones,
+                r.rollup_segundos - COALESCE(prev.rollup_segundos, 0) AS d_segundos,
+                r.rollup_alertas - COALESCE(prev.rollup_alertas, 0) AS d_alertas,
+                COALESCE(r.rollup_perclos, 0) - COALESCE(prev.rollup_perclos, 0) AS d_perclos,
+                (r.rollup_perclos IS NOT NULL)::integer - (prev.rollup_perclos IS NOT NULL)::integer AS d_perclos_n
+        )
+        INSERT INTO usuario_resumen AS u (
+            usuario_id, sesiones, segundos_total, alertas_total, perclos_suma, perclos_n, actualizado_en
         )
-        sesion_row = cur.fetchone()
-        sesion_id = sesion_row["id"] if sesion_row else None
-            
+        SELECT usuario_id, SUM(d_sesiones), SUM(d_segundos), SUM(d_alertas), SUM(d_perclos), SUM(d_perclos_n), NOW()
+        FROM deltas
+        GROUP BY usuario_id
+        ON CONFLICT (usuario_id) DO UPDATE SET
+            sesiones = u.sesiones + EXCLUDED.sesiones,
+            segundos_total = u.segundos_total + EXCLUDED.segundos_total,
+            alertas_total = u.alertas_total + EXCLUDED.alertas_total,
+            perclos_suma = u.perclos_suma + EXCLUDED.perclos_suma,
+            perclos_n = u.perclos_n + EXCLUDED.perclos_n,
+            actualizado_en = NOW()
+        """,
+        (ids,)
+    )
+
+CONSULTA_SESION_ABIERTA = "SELECT id FROM sesiones WHERE usuario_id = %s AND cerrada_en IS NULL ORDER BY id DESC LIMIT 1"
 
+@app.post("/save-fatigue")
+async def save_fatigue(data: FatigueResult):
+    # Reintento o snapshot atrasado: se descarta sin tocar la BD
+    if _seq_repetido(data):
+        return {
+            "mensaje": "Snapshot repetido o atrasado, descartado",
+            "sesion_id": data.sesion_id,
+            "diagnostico_detallado_ia": None,
+            "diagnostico_estado": None,
+            "descartado": True
+        }
 
-        # --- Llamada a N8N para diagnóstico ---
-        try:
-            n8n_webhook_url = os.getenv("N8N_WEBHOOK_URL", "http://localhost:5678/webhook/fatigue")
-            if n8n_webhook_url:
-                payload_to_n8n = {
-                    "usuario_id": data.usuario_id,
-                    "sesion_id": sesion_id,
-                    "actividad": data.actividad,
-                    "perclos": float(data.perclos),
-                    "sebr": data.sebr,
-                    "blink_rate_min": float(data.blink_rate_min),
-                    "pct_incompletos": float(data.pct_incompletos),
-                    "num_bostezos": data.num_bostezos,
-                    "tiempo_cierre": float(data.tiempo_cierre),
-                    "velocidad_ocular": float(data.velocidad_ocular),
-                    "nivel_subjetivo": data.nivel_subjetivo,
-                    "es_fatiga": data.es_fatiga,
-                    "tiempo_total_seg": data.tiempo_total_seg,
-                    "max_sin_parpadeo": data.max_sin_parpadeo,
-                    "alertas": data.alertas,
-                    "momentos_fatiga": data.momentos_fatiga
-                }
-                
-                log.info(f"Enviando payload a N8N: {json.dumps(payload_to_n8n, indent=2)}")
-                
-                async with httpx.AsyncClient() as client:
-                    response = await client.post(n8n_webhook_url, json=payload_to_n8n, timeout=60)
-                    response.raise_for_status()
-                    responseData = response.json()
-                    diagnostico_ia = responseData[0]['json'] if isinstance(responseData, list) and responseData and 'json' in responseData[0] else responseData
-
-                if diagnostico_ia and sesion_id:
-                    cur.execute(
-                        "INSERT INTO diagnosticos_ia (sesion_id, diagnostico_json) VALUES (%s, %s) ON CONFLICT (sesion_id) DO UPDATE SET diagnostico_json = EXCLUDED.diagnostico_json",
-                        (sesion_id, json.dumps(diagnostico_ia))
-                    )
-        except Exception as e:
-            log.error(f"Error al contactar N8N: {e}")
+    # Snapshot periódico de una sesión conocida: al buffer, se escribe en el próximo volcado
+    if data.sesion_id and data.nivel_subjetivo == 0 and _bufferizar_snapshot(data.sesion_id, data):
+        _registrar_seq(data.sesion_id, data.seq)
+        hub_vivo.publicar(_deltas_vivo({data.sesion_id: data}))
+        return {
+            "mensaje": "Snapshot recibido",
+            "sesion_id": data.sesion_id,
+            "diagnostico_detallado_ia": None,
+            "diagnostico_estado": "pendiente" if N8N_WEBHOOK_URL else None
+        }
+
+    # Guardado final (con KSS) o sin sesión: síncrono, junto con lo que la sesión tenga en buffer
+    previos = await _tomar_pendientes_sesion(data.sesion_id) if data.sesion_id else []
+    try:
+        async with _db_conn() as conn:
+            cur = conn.cursor()
+
+            # Usar la sesión proporcionada; si no viene, buscar la más reciente abierta
+            if data.sesion_id:
+                sesion_id = data.sesion_id
+            else:
+                await cur.execute(CONSULTA_SESION_ABIERTA, (data.usuario_id,))
+                row = await cur.fetchone()
+                if row:
+                    sesion_id = row["id"]
+                else:
+                    sesion_id = await _crear_sesion(cur, data.usuario_id)
+
+            # Guardar muestras, reducirlas al resumen de la sesión y encolar el diagnóstico
+            # IA en la misma transacción: el worker llama a N8N fuera del request, así
+            # /save-fatigue no retiene la conexión esperando al modelo
+            await _escribir_snapshots(cur, {sesion_id: previos + [data]})
+            diagnostico_estado = "pendiente" if N8N_WEBHOOK_URL else None
+
+        _registrar_seq(sesion_id, data.seq)
+        _invalidar_sesiones([sesion_id])
+        _marcar_escritura(usuarios=[data.usuario_id])
+        hub_vivo.publicar(_deltas_vivo({sesion_id: data}))
+        if diagnostico_estado:
+            _despertar_worker_diagnostico()
 
-        conn.commit()
-        
         return {
             "mensaje": "Sesión guardada exitosamente",
             "sesion_id": sesion_id,
-            "diagnostico_detallado_ia": diagnostico_ia
+            "diagnostico_detallado_ia": None,
+            "diagnostico_estado": diagnostico_estado
         }
 
     except Exception as e:
-        if conn: conn.rollback()
+        if previos:
+            _devolver_pendientes({data.sesion_id: previos})
         log.exception("Error en save_fatigue")
         raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/save-fatigue/batch")
+async def save_fatigue_batch(data: list[FatigueResult]):
+    """
+    Guarda varios snapshots (de una o muchas sesiones) en una sola transacción:
+    un INSERT multi-fila a muestras, un UPDATE de sesiones por lote y un encolado de diagnósticos.
+    Input: [FatigueResult, ...] (sesion_id obligatorio)
+    """
+    if not data:
+        return {"mensaje": "Lote vacío", "guardados": 0, "sesiones": []}
+    if len(data) > BATCH_MAX_SNAPSHOTS:
+        raise HTTPException(status_code=413, detail=f"Máximo {BATCH_MAX_SNAPSHOTS} snapshots por lote")
+    if any(d.sesion_id is None for d in data):
+        raise HTTPException(status_code=400, detail="Todos los snapshots del lote requieren sesion_id")
+
+    nuevos = [d for d in data if not _seq_repetido(d)]
+    if not nuevos:
+        return {"mensaje": "Lote repetido, descartado", "guardados": 0, "sesiones": []}
+
+    try:
+        async with _db_conn() as conn:
+            cur = conn.cursor()
+
+            # Los snapshots son acumulativos: para el resumen de cada sesión basta el más reciente
+            pendientes = {}
+            for d in nuevos:
+                pendientes.setdefault(d.sesion_id, []).append(d)
+            ultimos = await _escribir_snapshots(cur, pendientes)
+
+        for d in nuevos:
+            _registrar_seq(d.sesion_id, d.seq)
+        _invalidar_sesiones(ultimos)
+        _marcar_escritura(usuarios={d.usuario_id for d in ultimos.values()})
+        hub_vivo.publicar(_deltas_vivo(ultimos))
+        if N8N_WEBHOOK_URL:
+            _despertar_worker_diagnostico()
+
+        return {
+            "mensaje": "Lote guardado exitosamente",
+            "guardados": len(nuevos),
+            "sesiones": list(ultimos.keys()),
+        }
+
+    except Exception as e:
+        log.exception("Error en save_fatigue_batch")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# --- SECUENCIA DE SNAPSHOTS (REINTENTOS) ---
+# El cliente numera los snapshots de cada sesión (FatigueResult.seq, creciente).
+# Cada worker recuerda el mayor seq aceptado por sesión y descarta en memoria los
+# reintentos y los snapshots atrasados, sin abrir transacción. Lo que un worker no
+# vio (otra instancia, reinicio) lo filtra el INSERT de muestras contra
+# sesion_resumen.ultimo_seq. Sin seq, el snapshot se procesa como siempre.
+SEQ_CACHE_MAX = int(os.getenv("SEQ_CACHE_MAX", "10000"))  # sesiones recordadas por worker
+
+_seq_sesiones = OrderedDict()  # sesion_id -> mayor seq aceptado
+
+def _seq_repetido(data: FatigueResult):
+    return _seq_visto(data.sesion_id, data.seq)
+
+def _seq_visto(sesion_id, seq):
+    if seq is None or sesion_id is None:
+        return False
+    ultimo = _seq_sesiones.get(sesion_id)
+    return ultimo is not None and seq <= ultimo
+
+def _registrar_seq(sesion_id, seq):
+    if seq is None:
+        return
+    _seq_sesiones[sesion_id] = max(seq, _seq_sesiones.get(sesion_id, seq))
+    _seq_sesiones.move_to_end(sesion_id)
+    while len(_seq_sesiones) > SEQ_CACHE_MAX:
+        _seq_sesiones.popitem(last=False)
+
+# --- WRITE-BEHIND DE SNAPSHOTS PERIÓDICOS ---
+# Los /save-fatigue periódicos (nivel_subjetivo = 0) de una sesión conocida no abren
+# transacción: quedan en un buffer por sesion_id y cada SNAPSHOTS_FLUSH_SEG se vuelcan
+# todas las sesiones con cambios en una sola transacción, como /save-fatigue/batch.
+# Cada snapshot sigue siendo una fila de `muestras` (la serie de los gráficos), pero el
+# resumen y el diagnóstico se calculan una vez por sesión con el más reciente.
+# El guardado final con KSS y /end-session escriben en el momento, junto con lo que la
+# sesión tenga en buffer; al apagar se vuelca todo.
+# Por sesión el buffer guarda un snapshot por t (como muestras) y como mucho
+# SNAPSHOTS_POR_SESION_MAX: pasado eso el request escribe en el momento, y si un volcado
+# falla varias veces seguidas se descartan los más viejos.
+SNAPSHOTS_FLUSH_SEG = float(os.getenv("SNAPSHOTS_FLUSH_SEG", "2"))       # 0 = sin buffer
+SNAPSHOTS_BUFFER_MAX = int(os.getenv("SNAPSHOTS_BUFFER_MAX", "5000"))    # sesiones en buffer
+SNAPSHOTS_POR_SESION_MAX = int(os.getenv("SNAPSHOTS_POR_SESION_MAX", "120"))  # snapshots por sesión
+
+_snapshots_pendientes = {}   # sesion_id -> [FatigueResult] en orden de llegada
+_volcado_en_curso = {}       # sesion_id -> asyncio.Event del volcado que la está escribiendo
+
+async def _escribir_snapshots(cur, pendientes):
+    """pendientes: {sesion_id: [snapshots]}; escribe en la transacción de cur y devuelve {sesion_id: último}"""
+    ultimos = await _guardar_muestras(cur, [(sid, d) for sid, lista in pendientes.items() for d in lista])
+    await _actualizar_resumen_sesiones(cur, ultimos)
+    if N8N_WEBHOOK_URL:
+        await _encolar_diagnosticos(cur, {sid: _payload_diagnostico(sid, d) for sid, d in ultimos.items()})
+    await _notificar_vivo(cur, _deltas_vivo(ultimos))
+    return ultimos
+
+def _coalescer(lista):
+    """Un snapshot por t (gana el último recibido), en orden de llegada"""
+    por_t = {}
+    for d in lista:
+        por_t.pop(d.tiempo_total_seg, None)
+        por_t[d.tiempo_total_seg] = d
+    return list(por_t.values())
+
+def _bufferizar_snapshot(sesion_id, data):
+    """False si no hay buffer (desactivado o lleno): el request escribe en el momento"""
+    if SNAPSHOTS_FLUSH_SEG <= 0 or not hasattr(app.state, "volcado_evento"):
+        return False
+    if sesion_id not in _snapshots_pendientes and len(_snapshots_pendientes) >= SNAPSHOTS_BUFFER_MAX:
+        app.state.volcado_evento.set()
+        return False
+    lista = _coalescer(_snapshots_pendientes.get(sesion_id, []) + [data])
+    if len(lista) > SNAPSHOTS_POR_SESION_MAX:
+        # El request se lleva lo que la sesión tenga en buffer (_tomar_pendientes_sesion)
+        app.state.volcado_evento.set()
+        return False
+    _snapshots_pendientes[sesion_id] = lista
+    return True
+
+def _devolver_pendientes(pendientes):
+    """Tras un fallo: los snapshots vuelven al buffer delante de los llegados mientras tanto"""
+    for sid, lista in pendientes.items():
+        lista = _coalescer(lista + _snapshots_pendientes.get(sid, []))
+        if len(lista) > SNAPSHOTS_POR_SESION_MAX:
+            log.warning(
+                f"Buffer de la sesión {sid} lleno tras un volcado fallido: "
+                f"se descartan {len(lista) - SNAPSHOTS_POR_SESION_MAX} snapshots viejos"
+            )
+            lista = lista[-SNAPSHOTS_POR_SESION_MAX:]
+        _snapshots_pendientes[sid] = lista
+
+async def _tomar_pendientes_sesion(sesion_id):
+    """Saca del buffer los snapshots de la sesión (si un volcado ya los está escribiendo, lo espera)"""
+    while (evento := _volcado_en_curso.get(sesion_id)) is not None:
+        await evento.wait()
+    return _snapshots_pendientes.pop(sesion_id, [])
+
+async def _volcar_pendientes():
+    if not _snapshots_pendientes:
+        return
+    pendientes = dict(_snapshots_pendientes)
+    _snapshots_pendientes.clear()
+    evento = asyncio.Event()
+    for sid in pendientes:
+        _volcado_en_curso[sid] = evento
+    try:
+        async with _db_conn() as conn:
+            await _escribir_snapshots(conn.cursor(), pendientes)
+    except Exception:
+        _devolver_pendientes(pendientes)
+        raise
     finally:
-        if conn: _put_conn_back(conn)
+        for sid in pendientes:
+            if _volcado_en_curso.get(sid) is evento:
+                del _volcado_en_curso[sid]
+        evento.set()
+    _invalidar_sesiones(pendientes)
+    _marcar_escritura(usuarios={lista[-1].usuario_id for lista in pendientes.values()})
+    if N8N_WEBHOOK_URL:
+        _despertar_worker_diagnostico()
+
+async def _tarea_write_behind(evento):
+    while True:
+        try:
+            await asyncio.wait_for(evento.wait(), timeout=SNAPSHOTS_FLUSH_SEG)
+        except asyncio.TimeoutError:
+            pass
+        evento.clear()
+        try:
+            await _volcar_pendientes()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception(f"Error volcando snapshots ({len(_snapshots_pendientes)} sesiones en buffer)")
 
-# --- ENDPOINT: HISTORIAL DIRECTO DE BD ---
-@app.post("/get-user-history")
-def get_user_history(data: DashboardRequest):
-    conn = None
+@app.on_event("startup")
+async def iniciar_write_behind():
+    if SNAPSHOTS_FLUSH_SEG > 0:
+        app.state.volcado_evento = asyncio.Event()
+        app.state.volcado_tarea = asyncio.create_task(_tarea_write_behind(app.state.volcado_evento))
+
+async def _detener_write_behind():
+    tarea = getattr(app.state, "volcado_tarea", None)
+    if tarea:
+        tarea.cancel()
+        try:
+            await tarea
+        except asyncio.CancelledError:
+            pass
     try:
-        conn = _get_conn_from_pool()
-        cur = conn.cursor(cursor_factory=extras.RealDictCursor)
+        await _volcar_pendientes()
+    except Exception:
+        log.exception(f"Snapshots sin volcar al apagar: {len(_snapshots_pendientes)} sesiones")
 
-        query = """
-            SELECT
-                s.id as sesion_id,
-                TO_CHAR(s.fecha_inicio, 'DD/MM/YYYY HH24:MI') as fecha,
-                s.tipo_actividad,
-                s.total_segundos,
-                s.alertas,
-                s.es_fatiga,
-                m.perclos,
-                m.velocidad_ocular,
-                m.num_bostezos,
-                m.blink_rate_min,
-                dia.diagnostico_json
-            FROM sesiones s
-            LEFT JOIN mediciones m ON m.sesion_id = s.id
-            LEFT JOIN diagnosticos_ia dia ON dia.sesion_id = s.id
-            WHERE s.usuario_id = %s AND s.fecha_fin IS NOT NULL
-            ORDER BY s.fecha_inicio DESC
-        """
-        cur.execute(query, (data.usuario_id,))
-        historial = cur.fetchall()
+# --- SEÑALES CRUDAS EN BINARIO ---
+# Las señales por frame (ts, EAR, MAR, iris) llegan como chunks binarios SEYE
+# (columnas float16/float32 con prefijo de largo, ver senales.py). El servidor solo
+# valida la cabecera y guarda el chunk comprimido en senales_crudas sin decodificarlo.
+SENALES_MAX_BYTES = int(os.getenv("SENALES_MAX_BYTES", str(8 * 1024 * 1024)))
 
-        if not historial:
-            return {"empty": True}
+@app.post("/save-fatigue/raw/{sesion_id}")
+async def save_fatigue_raw(sesion_id: int, seq: int, request: Request):
+    """
+    Guarda un chunk de señales crudas de una sesión.
+    Input: cuerpo application/octet-stream (chunk SEYE), ?seq=<n> orden del chunk.
+    Reintentar el mismo seq es idempotente.
+    """
+    cuerpo = await request.body()
+    if len(cuerpo) > SENALES_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"Máximo {SENALES_MAX_BYTES} bytes por chunk")
+
+    try:
+        if senales.leer_cabecera(cuerpo)[2]:
+            datos, n_frames = senales.validar_y_comprimir(cuerpo)
+        else:
+            # Comprimir es CPU (zlib libera el GIL): fuera del event loop
+            datos, n_frames = await run_in_threadpool(senales.validar_y_comprimir, cuerpo)
+    except senales.FormatoInvalido as e:
+        raise HTTPException(status_code=400, detail=f"Chunk inválido: {e}")
+
+    try:
+        async with _db_conn() as conn:
+            cur = await conn.execute("""
+                INSERT INTO senales_crudas (sesion_id, seq, n_frames, datos)
+                SELECT id, %s, %s, %s FROM sesiones WHERE id = %s
+                ON CONFLICT (sesion_id, seq) DO NOTHING
+                RETURNING seq
+            """, (seq, n_frames, datos, sesion_id))
+            guardado = await cur.fetchone()
+
+            if not guardado:
+                existe = await (await conn.execute(
+                    "SELECT 1 FROM sesiones WHERE id = %s", (sesion_id,)
+                )).fetchone()
+                if not existe:
+                    raise HTTPException(status_code=404, detail="Sesión no encontrada")
+
+        return {
+            "mensaje": "Señales guardadas" if guardado else "Chunk ya recibido",
+            "sesion_id": sesion_id,
+            "seq": seq,
+            "frames": n_frames,
+            "bytes": len(datos),
+        }
 
-        # Calcular promedios de sesiones continuas
-        sesiones_unicas = {h["sesion_id"]: h for h in historial}.values()
+    except HTTPException:
+        raise
+    except Exception as e:
+        log.exception("Error en save_fatigue_raw")
+        raise HTTPException(status_code=500, detail=str(e))
 
-        def _to_float(val):
+# --- STREAM DE MÉTRICAS POR WEBSOCKET ---
+# Una conexión por sesión activa. El cliente envía frames pequeños con solo los
+# campos que cambiaron ({"seq", "perclos", ...} y "momentos" nuevos); el servidor
+# reconstruye el snapshot completo, confirma cada frame y los escribe a la BD por
+# lotes cada WS_FLUSH_SEG segundos (o al juntar WS_FLUSH_MAX).
+# "seq" es la secuencia del snapshot en la sesión (la misma de /save-fatigue) y se
+# mantiene entre reconexiones: los frames reenviados tras un corte se descartan.
+# Solo {"tipo": "fin"} termina la sesión; si la conexión se corta y nadie la retoma
+# en WS_INACTIVIDAD_SEG (ni llegan snapshots por otro worker), se termina sola.
+WS_FLUSH_SEG = float(os.getenv("WS_FLUSH_SEG", "5"))
+WS_FLUSH_MAX = int(os.getenv("WS_FLUSH_MAX", "50"))
+WS_INACTIVIDAD_SEG = float(os.getenv("WS_INACTIVIDAD_SEG", "120"))
+CAMPOS_STREAM = set(FatigueResult.model_fields) - {"sesion_id", "usuario_id", "momentos_fatiga"}
+
+_ws_conectadas = {}        # sesion_id -> conexiones abiertas en este worker
+_tareas_inactividad = set()
+
+async def _finalizar_si_inactiva(sesion_id):
+    await asyncio.sleep(WS_INACTIVIDAD_SEG)
+    if _ws_conectadas.get(sesion_id):
+        return
+    try:
+        async with _db_conn() as conn:
+            cur = await conn.execute(
+                """
+                SELECT 1 FROM sesiones s JOIN sesion_resumen r ON r.sesion_id = s.id
+                WHERE s.id = %s AND s.cerrada_en IS NULL
+                  AND r.actualizado_en < NOW() - make_interval(secs => %s)
+                """,
+                (sesion_id, WS_INACTIVIDAD_SEG),
+            )
+            inactiva = await cur.fetchone()
+        if inactiva:
+            await _terminar_sesion(sesion_id)
+            log.info("Sesión terminada por inactividad del stream", extra={"sesion_id": sesion_id})
+    except Exception:
+        log.exception(f"Error terminando por inactividad la sesión {sesion_id}")
+
+def _programar_inactividad(sesion_id):
+    tarea = asyncio.create_task(_finalizar_si_inactiva(sesion_id))
+    _tareas_inactividad.add(tarea)
+    tarea.add_done_callback(_tareas_inactividad.discard)
+
+async def _volcar_snapshots(sesion_id, snapshots):
+    """Escribe un lote de snapshots de la sesión por el mismo camino que el write-behind"""
+    async with _db_conn() as conn:
+        ultimos = await _escribir_snapshots(conn.cursor(), {sesion_id: snapshots})
+    _invalidar_sesiones([sesion_id])
+    _marcar_escritura(usuarios={d.usuario_id for d in ultimos.values()})
+    hub_vivo.publicar(_deltas_vivo(ultimos))
+    if N8N_WEBHOOK_URL:
+        _despertar_worker_diagnostico()
+
+@app.websocket("/ws/sesiones/{sesion_id}")
+async def stream_sesion(websocket: WebSocket, sesion_id: int):
+    await websocket.accept()
+    try:
+        async with _db_conn() as conn:
+            cur = await conn.execute("SELECT usuario_id, tipo_actividad FROM sesiones WHERE id = %s", (sesion_id,))
+            sesion = await cur.fetchone()
+    except Exception:
+        log.exception("Error abriendo stream de sesión")
+        await websocket.close(code=1011)
+        return
+    if not sesion:
+        await websocket.close(code=4404, reason="Sesión no encontrada")
+        return
+
+    estado = {
+        "sesion_id": sesion_id,
+        "usuario_id": sesion["usuario_id"],
+        "actividad": sesion["tipo_actividad"] or "pdf",
+        "sebr": 0, "blink_rate_min": 0.0, "perclos": 0.0, "pct_incompletos": 0.0,
+        "tiempo_cierre": 0.0, "num_bostezos": 0, "velocidad_ocular": 0.0,
+        "nivel_subjetivo": 0, "es_fatiga": False, "tiempo_total_seg": 0,
+        "max_sin_parpadeo": 0, "alertas": 0, "momentos_fatiga": [],
+    }
+    pendientes = []
+    ultimo_seq = 0
+    candado = asyncio.Lock()
+
+    async def volcar():
+        nonlocal pendientes
+        async with candado:
+            if not pendientes:
+                return
+            lote, seq_lote = pendientes, ultimo_seq
+            pendientes = []
             try:
-                return float(val) if val is not None else 0.0
+                await _volcar_snapshots(sesion_id, lote)
             except Exception:
-                return 0.0
-
-        def _to_int(val):
+                log.exception(f"Error guardando stream de sesión {sesion_id}")
+                pendientes = lote + pendientes  # reintentar en el próximo volcado
+                return
+            _registrar_seq(sesion_id, seq_lote)
+        try:
+            await websocket.send_json({"tipo": "guardado", "seq": seq_lote})
+        except Exception:
+            pass
+
+    async def volcado_periodico():
+        while True:
+            await asyncio.sleep(WS_FLUSH_SEG)
+            await volcar()
+
+    volcador = asyncio.create_task(volcado_periodico())
+    _ws_conectadas[sesion_id] = _ws_conectadas.get(sesion_id, 0) + 1
+    desconectado = False
+    fin = False
+    try:
+        while True:
+            try:
+                frame = await asyncio.wait_for(websocket.receive_json(), timeout=WS_INACTIVIDAD_SEG)
+            except asyncio.TimeoutError:
+                await websocket.close(code=1001, reason="Sin frames")
+                desconectado = True
+                break
+            if frame.get("tipo") == "fin":
+                fin = True
+                break
+
+            seq = frame.get("seq")
+            if seq is not None and (not isinstance(seq, int) or isinstance(seq, bool)):
+                await websocket.send_json({"tipo": "error", "seq": seq, "detalle": "seq debe ser un entero"})
+                continue
+
+            for campo in CAMPOS_STREAM.intersection(frame):
+                estado[campo] = frame[campo]
+            if frame.get("momentos"):
+                estado["momentos_fatiga"] = estado["momentos_fatiga"] + list(frame["momentos"])
+
+            # Reenvío tras reconectar (o frame atrasado): ya está guardado o en el lote;
+            # solo sirve para reconstruir el estado de esta conexión
+            if seq is not None and (seq <= ultimo_seq or _seq_visto(sesion_id, seq)):
+                await websocket.send_json({"tipo": "ack", "seq": seq})
+                continue
             try:
-                return int(val) if val is not None else 0
+                snapshot = FatigueResult(**estado)
+            except ValidationError as e:
+                await websocket.send_json({"tipo": "error", "seq": seq, "detalle": str(e)})
+                continue
+
+            ultimo_seq = seq if seq is not None else ultimo_seq + 1
+            pendientes.append(snapshot)
+            await websocket.send_json({"tipo": "ack", "seq": ultimo_seq})
+            if len(pendientes) >= WS_FLUSH_MAX:
+                await volcar()
+    except WebSocketDisconnect:
+        desconectado = True
+    except Exception:
+        log.exception(f"Error en stream de sesión {sesion_id}")
+    finally:
+        volcador.cancel()
+        _ws_conectadas[sesion_id] -= 1
+        if not _ws_conectadas[sesion_id]:
+            del _ws_conectadas[sesion_id]
+        # Al cerrar: volcar lo pendiente; la sesión termina solo con "fin" explícito.
+        # Un corte de red deja la sesión abierta para que el cliente reconecte.
+        await volcar()
+        if fin:
+            try:
+                await _terminar_sesion(sesion_id)
             except Exception:
-                return 0
-
-        avg_perclos = (
-            sum(_to_float(s.get("perclos")) for s in sesiones_unicas) / len(sesiones_unicas)
-        ) if sesiones_unicas else 0
-        total_alertas = sum(_to_int(s.get("alertas")) for s in sesiones_unicas)
-        total_tiempo = sum(_to_int(s.get("total_segundos")) for s in sesiones_unicas)
-        
+                log.exception(f"Error finalizando sesión {sesion_id} desde stream")
+        else:
+            _programar_inactividad(sesion_id)
+
+    if fin and not desconectado:
+        try:
+            await websocket.send_json({"tipo": "fin", "seq": ultimo_seq})
+            await websocket.close()
+        except Exception:
+            pass
+
+# --- PAGINACIÓN POR CURSOR ---
+# Paginación keyset sobre (fecha_inicio, sesion_id) DESC: cada página es un index scan
+# que arranca donde terminó la anterior, sin OFFSET. El cursor es opaco para el cliente.
+def _codificar_cursor(fecha_inicio, sesion_id):
+    crudo = json.dumps([fecha_inicio.isoformat(), sesion_id]).encode()
+    return base64.urlsafe_b64encode(crudo).decode().rstrip("=")
+
+def _decodificar_cursor(cursor):
+    try:
+        crudo = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        fecha, sesion_id = json.loads(crudo)
+        return datetime.fromisoformat(fecha), int(sesion_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
+def _paginar(filas, limite):
+    """Recorta la página (se piden limite + 1 filas) y devuelve (filas, siguiente_cursor)"""
+    siguiente_cursor = None
+    if len(filas) > limite:
+        filas = filas[:limite]
+        siguiente_cursor = _codificar_cursor(filas[-1]["fecha_inicio"], filas[-1]["sesion_id"])
+    for fila in filas:
+        del fila["fecha_inicio"]
+    return filas, siguiente_cursor
+
+# --- ENDPOINT: HISTORIAL DIRECTO DE BD ---
+HISTORIAL_LIMITE_MAX = 100
+
+# Página keyset: FILTRO_CURSOR se agrega al WHERE con los valores de _decodificar_cursor
+FILTRO_CURSOR = "(r.fecha_inicio, r.sesion_id) < (%s, %s)"
+
+CONSULTA_ACUMULADO_USUARIO = (
+    "SELECT sesiones, segundos_total, alertas_total, perclos_suma, perclos_n FROM usuario_resumen WHERE usuario_id = %s"
+)
+
+CONSULTA_HISTORIAL = """
+    SELECT
+        r.sesion_id,
+        r.fecha_inicio,
+        TO_CHAR(r.fecha_inicio, 'DD/MM/YYYY HH24:MI') as fecha,
+        r.tipo_actividad,
+        r.t AS total_segundos,
+        r.alertas,
+        r.es_fatiga,
+        r.perclos,
+        r.velocidad_ocular,
+        r.num_bostezos,
+        r.blink_rate_min,
+        r.diagnostico_json
+    FROM sesion_resumen r
+    WHERE r.usuario_id = %s AND r.cerrada_en IS NOT NULL {filtro_cursor}
+    ORDER BY r.fecha_inicio DESC, r.sesion_id DESC
+    LIMIT %s
+"""
+
+@app.post("/get-user-history")
+async def get_user_history(data: DashboardRequest):
+    """
+    Acumulado del usuario (usuario_resumen, una fila) y una página de sus sesiones cerradas.
+    Input: {usuario_id, limite?, cursor?}; la siguiente página se pide con siguiente_cursor.
+    """
+    limite = max(1, min(data.limite, HISTORIAL_LIMITE_MAX))
+    filtro_cursor = ""
+    params = [data.usuario_id]
+    if data.cursor:
+        filtro_cursor = "AND " + FILTRO_CURSOR
+        params += list(_decodificar_cursor(data.cursor))
+
+    try:
+        async with _db_conn_lectura(("usuario", data.usuario_id)) as conn:
+            cur = await conn.execute(CONSULTA_ACUMULADO_USUARIO, (data.usuario_id,))
+            acumulado = await cur.fetchone()
+
+            cur = await conn.execute(CONSULTA_HISTORIAL.format(filtro_cursor=filtro_cursor), (*params, limite + 1))
+            historial, siguiente_cursor = _paginar(await cur.fetchall(), limite)
+
+        if not acumulado or not acumulado["sesiones"]:
+            return {"empty": True}
+
+        perclos_n = acumulado["perclos_n"]
         promedios = {
-            "perclos_avg": round(avg_perclos, 1),
-            "alertas_total": total_alertas,
-            "tiempo_total_min": round(total_tiempo / 60, 1) if total_tiempo else 0,
+            "sesiones_total": acumulado["sesiones"],
+            "perclos_avg": round(float(acumulado["perclos_suma"]) / perclos_n, 1) if perclos_n else 0,
+            "alertas_total": acumulado["alertas_total"],
+            "tiempo_total_min": round(acumulado["segundos_total"] / 60, 1),
         }
 
-        return {"empty": False, "historial": list(sesiones_unicas), "promedios": promedios}
+        return {
+            "empty": False,
+            "historial": historial,
+            "promedios": promedios,
+            "siguiente_cursor": siguiente_cursor,
+        }
+    except HTTPException:
+        raise
     except Exception as e:
         log.exception("Error historial")
         return {"error": str(e)}
-    finally:
-        if conn:
-            _put_conn_back(conn)
 
 # --- NUEVOS ENDPOINTS PARA SESIONES CONTINUAS ---
+@app.get("/reglas-fatiga")
+def get_reglas_fatiga(request: Request):
+    """Definición vigente de reglas_fatiga.json; el navegador la compila al iniciar el monitoreo"""
+    cuerpo = JSONResponse(content=reglas_fatiga.actuales().definicion).body
+    return _respuesta_cacheada(request, Entrada(cuerpo, calcular_etag(cuerpo), 0))
+
 @app.get("/actividades-descanso")
 def get_actividades_descanso():
     """Retorna las 3 actividades de descanso predefinidas"""
@@ -432,272 +1786,600 @@ class RegistroDescanso(BaseModel):
     duracion_seg: int
 
 @app.post("/registrar-descanso")
-def registrar_actividad_descanso(data: RegistroDescanso):
+async def registrar_actividad_descanso(data: RegistroDescanso):
     """Registra que el usuario realizó una actividad de descanso durante la sesión"""
-    conn = None
     try:
-        conn = _get_conn_from_pool()
-        cur = conn.cursor()
-        
-        # Guardar la actividad dentro de sesiones.resumen como array JSON
-        cur.execute(
-            """
-            UPDATE sesiones
-            SET resumen = COALESCE(resumen, '[]'::jsonb) || jsonb_build_array(
-                jsonb_build_object(
-                    'tipo', 'descanso',
-                    'actividad_id', %s,
-                    'actividad', %s,
-                    'duracion_seg', %s,
-                    'timestamp', NOW()
+        async with _db_conn() as conn:
+            # Guardar la actividad dentro de sesiones.resumen como array JSON
+            await conn.execute(
+                """
+                UPDATE sesiones
+                SET resumen = COALESCE(resumen, '[]'::jsonb) || jsonb_build_array(
+                    jsonb_build_object(
+                        'tipo', 'descanso',
+                        'actividad_id', %s::integer,
+                        'actividad', %s::text,
+                        'duracion_seg', %s::integer,
+                        'timestamp', NOW()
+                    )
                 )
+                WHERE id = %s
+                """,
+                (data.actividad_id, data.actividad_nombre, data.duracion_seg, data.sesion_id)
             )
-            WHERE id = %s
-            """,
-            (data.actividad_id, data.actividad_nombre, data.duracion_seg, data.sesion_id)
-        )
-        conn.commit()
-        
-        log.info(f"Actividad de descanso registrada: {data.actividad_nombre} en sesión {data.sesion_id}")
+        _invalidar_sesiones([data.sesion_id])
+
+        log.info("Actividad de descanso registrada",
+                 extra={"sesion_id": data.sesion_id, "actividad": data.actividad_nombre})
         return {"mensaje": "Actividad de descanso registrada", "exito": True}
-        
+
     except Exception as e:
-        if conn: conn.rollback()
         log.exception("Error registrando actividad de descanso")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if conn: _put_conn_back(conn)
+
+async def _finalizar_sesion(conn, sesion_id):
+    """Cierra la sesión escribiendo antes los snapshots que tenga en buffer. Devuelve el usuario_id (None si ya estaba cerrada)"""
+    previos = await _tomar_pendientes_sesion(sesion_id)
+    try:
+        if previos:
+            await _escribir_snapshots(conn.cursor(), {sesion_id: previos})
+        return await _cerrar_sesion(conn, sesion_id)
+    except Exception:
+        if previos:
+            _devolver_pendientes({sesion_id: previos})
+        raise
+
+async def _cerrar_sesion(conn, sesion_id):
+    cur = await conn.execute(
+        """
+        WITH s AS (
+            UPDATE sesiones SET fecha_fin = COALESCE(fecha_fin, NOW()), cerrada_en = NOW()
+            WHERE id = %s AND cerrada_en IS NULL
+            RETURNING id, fecha_fin, cerrada_en
+        )
+        UPDATE sesion_resumen r SET fecha_fin = s.fecha_fin, cerrada_en = s.cerrada_en
+        FROM s WHERE r.sesion_id = s.id
+        RETURNING r.usuario_id
+        """,
+        (sesion_id,)
+    )
+    fila = await cur.fetchone()
+    await _acumular_usuarios(conn.cursor(), [sesion_id])
+    await _notificar_vivo(conn.cursor(), [{"sesion_id": sesion_id, "fin": True}])
+    return fila["usuario_id"] if fila else None
+
+async def _terminar_sesion(sesion_id):
+    """/end-session, "fin" del stream o inactividad: cierra en la BD y avisa a cachés, réplica y dashboard"""
+    async with _db_conn() as conn:
+        usuario_id = await _finalizar_sesion(conn, sesion_id)
+    _invalidar_sesiones([sesion_id])
+    _marcar_escritura(usuarios=[usuario_id])
+    hub_vivo.publicar([{"sesion_id": sesion_id, "fin": True}])
 
 @app.post("/end-session/{sesion_id}")
-def end_session(sesion_id: int):
+async def end_session(sesion_id: int):
     """Finalizar una sesión manualmente"""
-    conn = None
     try:
-        conn = _get_conn_from_pool()
-        cur = conn.cursor()
-        cur.execute(
-            "UPDATE sesiones SET fecha_fin = NOW() WHERE id = %s AND fecha_fin IS NULL",
-            (sesion_id,)
-        )
-        conn.commit()
+        await _terminar_sesion(sesion_id)
         return {"mensaje": "Sesión finalizada"}
     except Exception as e:
-        if conn: conn.rollback()
         log.exception("Error end_session")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if conn: _put_conn_back(conn)
+
+CONSULTA_DETALLE_SESION = """
+    SELECT
+        sesion_id AS id, usuario_id, tipo_actividad, t AS total_segundos, alertas,
+        nivel_subjetivo AS kss_final, es_fatiga, fecha_inicio, fecha_fin, cerrada_en,
+        perclos, velocidad_ocular, num_bostezos, blink_rate_min,
+        parpadeos, max_sin_parpadeo,
+        momentos AS momentos_fatiga,
+        diagnostico_json
+    FROM sesion_resumen
+    WHERE sesion_id = %s
+"""
 
 @app.get("/sesiones/{sesion_id}")
-def get_sesion_details(sesion_id: int):
+async def get_sesion_details(sesion_id: int, request: Request):
     """Obtener detalles de una sesión continua"""
-    conn = None
+    clave = ("sesion", sesion_id)
+    entrada = cache_respuestas.obtener(clave)
+    if entrada:
+        return _respuesta_cacheada(request, entrada)
+    marca = cache_respuestas.marca()
     try:
-        conn = _get_conn_from_pool()
-        cur = conn.cursor(cursor_factory=extras.RealDictCursor)
-        
-        cur.execute(
-            """
-            SELECT 
-                s.id, s.usuario_id, s.tipo_actividad, s.total_segundos, s.alertas, 
-                s.kss_final, s.es_fatiga, s.fecha_inicio, s.fecha_fin,
-                m.perclos, m.velocidad_ocular, m.num_bostezos, m.blink_rate_min,
-                m.parpadeos, m.max_sin_parpadeo, m.momentos_fatiga,
-                dia.diagnostico_json
-            FROM sesiones s
-            LEFT JOIN LATERAL (
-                SELECT perclos, velocidad_ocular, num_bostezos, blink_rate_min,
-                       parpadeos, max_sin_parpadeo, momentos_fatiga
-                FROM mediciones m2
-                WHERE m2.sesion_id = s.id
-                ORDER BY m2.fecha DESC
-                LIMIT 1
-            ) m ON TRUE
-            LEFT JOIN diagnosticos_ia dia ON dia.sesion_id = s.id
-            WHERE s.id = %s
-            """,
-            (sesion_id,)
-        )
-        resultado = cur.fetchone()
-        return resultado if resultado else {"error": "Sesión no encontrada"}
+        async with _db_conn_lectura(("sesion", sesion_id)) as conn:
+            cur = await conn.execute(CONSULTA_DETALLE_SESION, (sesion_id,))
+            resultado = await cur.fetchone()
+        if not resultado:
+            return {"error": "Sesión no encontrada"}
+        # Solo se cachea lo que ya no cambia: sesión cerrada (cerrada_en; fecha_fin la mueve
+        # cada snapshot) y con diagnóstico
+        if resultado["cerrada_en"] and resultado["diagnostico_json"]:
+            return _cachear(request, clave, resultado, marca)
+        return resultado
     except Exception as e:
         log.exception("Error get_sesion_details")
         return {"error": str(e)}
-    finally:
-        if conn: _put_conn_back(conn)
 
 
 # --- ENDPOINT: OBTENER O CREAR DIAGNÓSTICO IA ---
-@app.post("/get-or-create-diagnosis")
-async def get_or_create_diagnosis(data: DetailRequest):
-    conn = None
-    try:
-        conn = _get_conn_from_pool()
-        cur = conn.cursor(cursor_factory=extras.RealDictCursor)
-
-        # 1. Verificar si ya existe un diagnóstico
-        cur.execute("SELECT diagnostico_json FROM diagnosticos_ia WHERE sesion_id = %s", (data.sesion_id,))
-        existing_diagnosis = cur.fetchone()
-        if existing_diagnosis and existing_diagnosis['diagnostico_json']:
-            log.info(f"Devolviendo diagnóstico existente para sesion_id: {data.sesion_id}")
-            return existing_diagnosis['diagnostico_json']
-
-        # 2. Flujo continuo: tomar la medición más reciente de la sesión (sin etapas)
-        log.info(f"Generando diagnóstico para sesión continua: {data.sesion_id}")
+# Varias pestañas pueden pedir a la vez el diagnóstico de la misma sesión. Dentro de
+# un worker las peticiones concurrentes esperan una sola tarea por sesion_id
+# (single-flight); entre workers, un advisory lock por sesión serializa la generación
+# y el que llega segundo encuentra el diagnóstico ya guardado.
+LOCK_DIAGNOSTICO = 7346003  # clave de pg_advisory_xact_lock(LOCK_DIAGNOSTICO, sesion_id)
+
+_diagnosticos_en_curso = {}  # sesion_id -> asyncio.Task
+
+def _con_estado_listo(diagnostico):
+    return {**diagnostico, "estado": "listo"} if isinstance(diagnostico, dict) else diagnostico
+
+def _generar_diagnostico_local(measurement):
+    """Diagnóstico por umbrales (reglas_fatiga) sobre el resumen acumulado; incluye reglas_version"""
+    reglas = reglas_fatiga.actuales()
+    return reglas.diagnostico(reglas.puntaje_diagnostico(measurement))
+
+CONSULTA_ESTADO_COLA = "SELECT estado FROM diagnosticos_cola WHERE sesion_id = %s"
+
+async def _obtener_o_generar_diagnostico(sesion_id):
+    """
+    Devuelve (status, contenido, marca): marca es la marca de caché si la respuesta
+    se puede cachear (sesión cerrada con diagnóstico), o None.
+    """
+    marca = cache_respuestas.marca()
+    async with _db_conn() as conn:
+        cur = conn.cursor()
+
+        # 1. Si el worker aún tiene el diagnóstico IA en cola, informar estado pendiente
+        await cur.execute(CONSULTA_ESTADO_COLA, (sesion_id,))
+        en_cola = await cur.fetchone()
+        if en_cola and en_cola['estado'] in ('pendiente', 'procesando'):
+            return 202, {"estado": "pendiente", "sesion_id": sesion_id}, None
+
+        # 2. Un solo generador por sesión entre workers (se libera con el commit)
+        await cur.execute("SELECT pg_advisory_xact_lock(%s, %s)", (LOCK_DIAGNOSTICO, sesion_id))
+
+        # 3. Una sola fila de sesion_resumen trae el diagnóstico existente y el acumulado
         query = """
-            SELECT 
-                s.usuario_id,
-                m.perclos,
-                m.parpadeos AS sebr,
-                m.pct_incompletos,
-                m.tiempo_cierre,
-                m.num_bostezos,
-                m.velocidad_ocular,
-                m.nivel_subjetivo,
-                m.alertas
-            FROM mediciones m
-            JOIN sesiones s ON m.sesion_id = s.id
-            WHERE m.sesion_id = %s
-            ORDER BY m.fecha DESC
-            LIMIT 1
+            SELECT
+                diagnostico_json,
+                cerrada_en,
+                t,
+                usuario_id,
+                perclos,
+                parpadeos AS sebr,
+                pct_incompletos,
+                tiempo_cierre,
+                num_bostezos,
+                velocidad_ocular,
+                nivel_subjetivo,
+                alertas
+            FROM sesion_resumen
+            WHERE sesion_id = %s
         """
-        cur.execute(query, (data.sesion_id,))
-        measurement = cur.fetchone()
+        await cur.execute(query, (sesion_id,))
+        measurement = await cur.fetchone()
+
+        if measurement and measurement['diagnostico_json']:
+            log.info("Devolviendo diagnóstico existente", extra={"sesion_id": sesion_id})
+            diagnostico = _con_estado_listo(measurement['diagnostico_json'])
+            return 200, diagnostico, marca if measurement['cerrada_en'] else None
 
-        if not measurement:
+        # 4. Flujo continuo: generar a partir del resumen acumulado de la sesión
+        log.info("Generando diagnóstico local", extra={"sesion_id": sesion_id})
+        if not measurement or measurement['t'] is None:
             raise HTTPException(status_code=404, detail="Sin mediciones para esta sesión continua.")
 
-        # 3. Generar diagnóstico simple local basado en umbrales
-        perclos = float(measurement.get('perclos') or 0)
-        sebr = float(measurement.get('sebr') or 0)
-        pct_inc = float(measurement.get('pct_incompletos') or 0)
-        tiempo_cierre = float(measurement.get('tiempo_cierre') or 0)
-        num_bostezos = float(measurement.get('num_bostezos') or 0)
-        vel = float(measurement.get('velocidad_ocular') or 0)
-        kss = int(measurement.get('nivel_subjetivo') or 0)
-        alertas = int(measurement.get('alertas') or 0)
-
-        score = 0
-        if perclos >= 28: score += 3
-        if sebr <= 5: score += 3
-        if pct_inc >= 20: score += 2
-        if tiempo_cierre >= 0.4: score += 1
-        if num_bostezos >= 1: score += 1
-        if vel < 0.02: score += 1
-        if kss >= 7: score += 1
-        if alertas >= 2: score += 2
-
-        severidad = 'NORMAL'
-        if score >= 7:
-            severidad = 'ALTA'
-        elif score >= 4:
-            severidad = 'MODERADA'
-
-        diagnostico_generado = {
-            "diagnostico_general": "Fatiga detectada" if score >= 3 else "Estado normal",
-            "severidad_fatiga_final": severidad,
-            "recomendaciones_generales": [
-                "Aplica la regla 20-20-20",
-                "Parpadea conscientemente cada 20s",
-                "Toma un descanso de 2-3 minutos"
-            ]
-        }
+        diagnostico_generado = _generar_diagnostico_local(measurement)
 
-        # 4. Guardar diagnóstico generado
-        cur.execute(
-            "INSERT INTO diagnosticos_ia (sesion_id, diagnostico_json) VALUES (%s, %s) ON CONFLICT (sesion_id) DO UPDATE SET diagnostico_json = EXCLUDED.diagnostico_json",
-            (data.sesion_id, json.dumps(diagnostico_generado))
-        )
-        conn.commit()
-        log.info(f"Diagnóstico para sesion_id: {data.sesion_id} guardado en la BD.")
+        # 5. Guardar diagnóstico generado
+        await _guardar_diagnostico(cur, sesion_id, diagnostico_generado, diagnostico_generado["reglas_version"])
+    _invalidar_sesiones([sesion_id])
+    log.info("Diagnóstico guardado en la BD", extra={"sesion_id": sesion_id})
 
-        return diagnostico_generado
+    return 200, _con_estado_listo(diagnostico_generado), None
 
+async def _diagnostico_single_flight(sesion_id):
+    tarea = _diagnosticos_en_curso.get(sesion_id)
+    if tarea is None:
+        tarea = asyncio.ensure_future(_obtener_o_generar_diagnostico(sesion_id))
+        _diagnosticos_en_curso[sesion_id] = tarea
+        tarea.add_done_callback(lambda _: _diagnosticos_en_curso.pop(sesion_id, None))
+    # shield: si un cliente se desconecta, la tarea sigue para los demás que esperan
+    return await asyncio.shield(tarea)
+
+@app.post("/get-or-create-diagnosis")
+async def get_or_create_diagnosis(data: DetailRequest, request: Request):
+    clave = ("diagnostico", data.sesion_id)
+    entrada = cache_respuestas.obtener(clave)
+    if entrada:
+        return _respuesta_cacheada(request, entrada)
+    try:
+        status, contenido, marca = await _diagnostico_single_flight(data.sesion_id)
     except HTTPException:
-        if conn: conn.rollback()
         raise
     except Exception as e:
-        if conn: conn.rollback()
         log.exception("Error crítico en get_or_create_diagnosis")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if conn:
-            _put_conn_back(conn)
+
+    if status == 202:
+        return JSONResponse(status_code=202, content=contenido)
+    if marca is not None:
+        return _cachear(request, clave, contenido, marca)
+    return contenido
 
 
 # --- ENDPOINT: DETALLE PARA GRÁFICOS ---
+CONSULTA_MUESTRAS_SESION = """
+    WITH s AS (SELECT fecha_inicio FROM sesiones WHERE id = %(sesion_id)s)
+    SELECT t, perclos, parpadeos, velocidad_ocular, num_bostezos, nivel_subjetivo, es_fatiga
+    FROM muestras
+    WHERE sesion_id = %(sesion_id)s AND sesion_inicio = (SELECT fecha_inicio FROM s)
+    UNION ALL
+    SELECT t, perclos, parpadeos, velocidad_ocular, num_bostezos, nivel_subjetivo, es_fatiga
+    FROM muestras_minuto
+    WHERE sesion_id = %(sesion_id)s
+    ORDER BY t
+"""
+
 @app.post("/get-session-details")
-def get_session_details(data: DetailRequest):
-    conn = None
+async def get_session_details(data: DetailRequest):
+    """
+    Serie temporal de muestras de la sesión (una fila por snapshot, ordenada por t).
+    Si la partición de la sesión ya fue retenida, devuelve una fila por minuto desde
+    muestras_minuto con las mismas columnas; una sesión nunca está en ambas tablas.
+    """
     try:
-        conn = _get_conn_from_pool()
-        cur = conn.cursor(cursor_factory=extras.RealDictCursor)
-
-        cur.execute(
-            """
-            SELECT
-                etapa,
-                perclos,
-                parpadeos,
-                velocidad_ocular,
-                num_bostezos,
-                nivel_subjetivo,
-                estado_fatiga
-            FROM mediciones
-            WHERE sesion_id = %s
-            """,
-            (data.sesion_id,),
-        )
-        filas = cur.fetchall()
-
-        datos = {}
-        for fila in filas:
-            datos[fila["etapa"]] = fila
+        async with _db_conn_lectura(("sesion", data.sesion_id)) as conn:
+            cur = await conn.execute(CONSULTA_MUESTRAS_SESION, {"sesion_id": data.sesion_id})
+            filas = await cur.fetchall()
 
-        return datos
+        return {"muestras": filas}
     except Exception as e:
         log.exception("Error detalle")
         return {"error": str(e)}
-    finally:
-        if conn:
-            _put_conn_back(conn)
 
-from fastapi import FastAPI
-from psycopg2 import extras
+# --- ENDPOINT: ADMIN (PAGINADO POR CURSOR) ---
+ADMIN_LIMITE_DEFAULT = 50
+ADMIN_LIMITE_MAX = 200
+
+def _filtros_sesiones(desde, hasta, usuario_id, estudiante, tipo_actividad, es_fatiga):
+    """WHERE (sobre sesion_resumen r JOIN usuarios u) y parámetros de los filtros del admin"""
+    filtros = ["r.cerrada_en IS NOT NULL"]
+    params = []
+    if desde:
+        filtros.append("r.fecha_inicio >= %s")
+        params.append(desde)
+    if hasta:
+        filtros.append("r.fecha_inicio < %s")
+        params.append(hasta + timedelta(days=1))
+    if usuario_id is not None:
+        filtros.append("r.usuario_id = %s")
+        params.append(usuario_id)
+    if estudiante:
+        filtros.append("CONCAT(u.nombre, ' ', u.apellido) ILIKE %s")
+        params.append(f"%{estudiante}%")
+    if tipo_actividad:
+        filtros.append("r.tipo_actividad = %s")
+        params.append(tipo_actividad)
+    if es_fatiga is not None:
+        filtros.append("r.es_fatiga = %s")
+        params.append(es_fatiga)
+    return " AND ".join(filtros), params
+
+async def _estimar_total(conn, where, params):
+    """Estimación del planner (EXPLAIN) en vez de COUNT(*): no recorre la tabla"""
+    cur = await conn.execute(
+        f"EXPLAIN (FORMAT JSON) SELECT 1 FROM sesion_resumen r JOIN usuarios u ON u.id = r.usuario_id WHERE {where}",
+        params,
+    )
+    plan = (await cur.fetchone())["QUERY PLAN"]
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+CONSULTA_ADMIN_SESIONES = """
+    SELECT
+        r.sesion_id,
+        r.fecha_inicio,
+        CONCAT(u.nombre, ' ', u.apellido) AS estudiante,
+        TO_CHAR(r.fecha_inicio, 'DD/MM/YYYY HH24:MI') AS fecha,
+        r.tipo_actividad,
+        r.t AS total_segundos,
+        r.alertas,
+        r.es_fatiga,
+        r.perclos,
+        r.velocidad_ocular,
+        r.num_bostezos
+    FROM sesion_resumen r
+    JOIN usuarios u ON u.id = r.usuario_id
+    WHERE {where}
+    ORDER BY r.fecha_inicio DESC, r.sesion_id DESC
+    LIMIT %s
+"""
 
 @app.get("/admin/all-sessions")
-def admin_all_sessions():
-    conn = None
+async def admin_all_sessions(
+    limite: int = ADMIN_LIMITE_DEFAULT,
+    cursor: str | None = None,
+    desde: date | None = None,
+    hasta: date | None = None,
+    usuario_id: int | None = None,
+    estudiante: str | None = None,
+    tipo_actividad: str | None = None,
+    es_fatiga: bool | None = None,
+):
+    """
+    Sesiones cerradas, una fila por sesión, de la más reciente a la más antigua.
+    Query: limite, cursor (siguiente_cursor de la página anterior), desde/hasta (YYYY-MM-DD,
+    inclusive), usuario_id, estudiante (texto en nombre/apellido), tipo_actividad, es_fatiga.
+    total_estimado solo se calcula en la primera página.
+    """
+    limite = max(1, min(limite, ADMIN_LIMITE_MAX))
+    where, params = _filtros_sesiones(desde, hasta, usuario_id, estudiante, tipo_actividad, es_fatiga)
+
+    pagina_where = where
+    pagina_params = list(params)
+    if cursor:
+        fecha_cursor, id_cursor = _decodificar_cursor(cursor)
+        pagina_where += " AND " + FILTRO_CURSOR
+        pagina_params += [fecha_cursor, id_cursor]
+
     try:
-        conn = _get_conn_from_pool()
-        cur = conn.cursor(cursor_factory=extras.RealDictCursor)
-
-        cur.execute("""
-            SELECT 
-                s.id AS sesion_id,
-                CONCAT(u.nombre, ' ', u.apellido) AS estudiante,
-                TO_CHAR(s.fecha_inicio, 'DD/MM/YYYY HH24:MI') AS fecha,
-                s.tipo_actividad,
-                s.total_segundos,
-                s.alertas,
-                s.es_fatiga,
-                m.perclos,
-                m.velocidad_ocular,
-                m.num_bostezos
-            FROM sesiones s
-            JOIN usuarios u ON u.id = s.usuario_id
-            LEFT JOIN mediciones m ON m.sesion_id = s.id
-            WHERE s.fecha_fin IS NOT NULL
-            ORDER BY s.fecha_inicio DESC
-        """)
-
-        sesiones = cur.fetchall()
-
-        return {"ok": True, "sesiones": sesiones}
+        async with _db_conn_lectura() as conn:
+            cur = await conn.execute(CONSULTA_ADMIN_SESIONES.format(where=pagina_where), (*pagina_params, limite + 1))
+            sesiones, siguiente_cursor = _paginar(await cur.fetchall(), limite)
 
+            total_estimado = None if cursor else await _estimar_total(conn, where, params)
+
+        return {
+            "ok": True,
+            "sesiones": sesiones,
+            "siguiente_cursor": siguiente_cursor,
+            "total_estimado": total_estimado,
+        }
+
+    except HTTPException:
+        raise
     except Exception as e:
         return {"ok": False, "error": str(e)}
-    finally:
-        if conn:
-            _put_conn_back(conn)
 
+
+# --- ENDPOINT: ADMIN EXPORTACIÓN (STREAMING) ---
+# Exporta con un cursor con nombre (del lado del servidor): Postgres entrega de a
+# EXPORT_FETCH filas y cada lote se serializa y se envía antes de pedir el siguiente,
+# así la memoria no crece con el tamaño de la exportación. La conexión queda prestada
+# mientras dura la descarga.
+EXPORT_FETCH = int(os.getenv("EXPORT_FETCH", "2000"))
+
+CONSULTAS_EXPORT = {
+    "sesiones": """
+        SELECT r.sesion_id, r.usuario_id, CONCAT(u.nombre, ' ', u.apellido) AS estudiante,
+               r.tipo_actividad, r.fecha_inicio, r.fecha_fin, r.t AS total_segundos,
+               r.perclos, r.parpadeos, r.blink_rate_min, r.pct_incompletos, r.tiempo_cierre,
+               r.num_bostezos, r.velocidad_ocular, r.max_sin_parpadeo, r.alertas,
+               r.nivel_subjetivo AS kss_final, r.es_fatiga
+        FROM sesion_resumen r
+        JOIN usuarios u ON u.id = r.usuario_id
+        WHERE {where}
+        ORDER BY r.fecha_inicio, r.sesion_id
+    """,
+    # Muestras crudas o, si la partición ya se retuvo, una fila por minuto
+    "muestras": """
+        SELECT r.sesion_id, r.usuario_id, m.resolucion, m.t, m.perclos, m.parpadeos, m.blink_rate_min,
+               m.pct_incompletos, m.tiempo_cierre, m.num_bostezos, m.velocidad_ocular,
+               m.max_sin_parpadeo, m.alertas, m.nivel_subjetivo, m.es_fatiga
+        FROM sesion_resumen r
+        JOIN usuarios u ON u.id = r.usuario_id
+        CROSS JOIN LATERAL (
+            SELECT 'segundo' AS resolucion, t, perclos, parpadeos, blink_rate_min, pct_incompletos,
+                   tiempo_cierre, num_bostezos, velocidad_ocular, max_sin_parpadeo, alertas,
+                   nivel_subjetivo, es_fatiga
+            FROM muestras WHERE sesion_id = r.sesion_id AND sesion_inicio = r.fecha_inicio
+            UNION ALL
+            SELECT 'minuto', t, perclos, parpadeos, blink_rate_min, pct_incompletos,
+                   tiempo_cierre, num_bostezos, velocidad_ocular, max_sin_parpadeo, alertas,
+                   nivel_subjetivo, es_fatiga
+            FROM muestras_minuto WHERE sesion_id = r.sesion_id
+            ORDER BY t
+        ) m
+        WHERE {where}
+        ORDER BY r.fecha_inicio, r.sesion_id
+    """,
+    "diagnosticos": """
+        SELECT r.sesion_id, r.usuario_id, CONCAT(u.nombre, ' ', u.apellido) AS estudiante,
+               r.fecha_inicio, d.reglas_version, d.fecha_creacion, d.diagnostico_json
+        FROM sesion_resumen r
+        JOIN usuarios u ON u.id = r.usuario_id
+        JOIN diagnosticos_ia d ON d.sesion_id = r.sesion_id
+        WHERE {where}
+        ORDER BY r.fecha_inicio, r.sesion_id
+    """,
+}
+
+def _json_export(valor):
+    if isinstance(valor, Decimal):
+        return float(valor)
+    if isinstance(valor, (datetime, date)):
+        return valor.isoformat()
+    raise TypeError(f"No serializable: {type(valor).__name__}")
+
+def _lote_ndjson(columnas, filas):
+    return "".join(
+        json.dumps(dict(zip(columnas, fila)), default=_json_export, ensure_ascii=False) + "\n"
+        for fila in filas
+    )
+
+def _lote_csv(filas):
+    salida = io.StringIO()
+    escritor = csv.writer(salida)
+    escritor.writerows(
+        [json.dumps(v, ensure_ascii=False) if isinstance(v, (dict, list)) else v for v in fila]
+        for fila in filas
+    )
+    return salida.getvalue()
+
+async def _stream_export(consulta, params, formato):
+    try:
+        async with _db_conn_lectura() as conn:
+            async with conn.cursor(name="export_admin", row_factory=tuple_row) as cur:
+                await cur.execute(consulta, params)
+                columnas = [c.name for c in cur.description]
+                if formato == "csv":
+                    yield _lote_csv([columnas])
+                while filas := await cur.fetchmany(EXPORT_FETCH):
+                    yield _lote_ndjson(columnas, filas) if formato == "ndjson" else _lote_csv(filas)
+    except Exception:
+        # Ya se enviaron los encabezados: solo queda cortar la descarga
+        log.exception("Error durante la exportación")
+        raise
+
+@app.get("/admin/export/{recurso}")
+async def admin_export(
+    recurso: str,
+    formato: str = "ndjson",
+    desde: date | None = None,
+    hasta: date | None = None,
+    usuario_id: int | None = None,
+    estudiante: str | None = None,
+    tipo_actividad: str | None = None,
+    es_fatiga: bool | None = None,
+):
+    """
+    Descarga sesiones, muestras o diagnósticos de las sesiones cerradas que cumplen
+    los mismos filtros que /admin/all-sessions, en NDJSON (una fila JSON por línea) o CSV.
+    """
+    if recurso not in CONSULTAS_EXPORT:
+        raise HTTPException(status_code=404, detail=f"Recurso inválido; opciones: {', '.join(CONSULTAS_EXPORT)}")
+    if formato not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="formato debe ser 'ndjson' o 'csv'")
+
+    where, params = _filtros_sesiones(desde, hasta, usuario_id, estudiante, tipo_actividad, es_fatiga)
+    consulta = CONSULTAS_EXPORT[recurso].format(where=where)
+    archivo = f"{recurso}_{datetime.now():%Y%m%d_%H%M}.{formato}"
+    return StreamingResponse(
+        _stream_export(consulta, params, formato),
+        media_type="application/x-ndjson" if formato == "ndjson" else "text/csv",
+        headers={"Content-Disposition": f'attachment; filename="{archivo}"'},
+    )
+
+# --- ADMIN EN VIVO (SSE) ---
+# /admin/live empuja al dashboard el estado de las sesiones abiertas a medida que
+# llegan los snapshots, sin leer la BD: cada worker mantiene un hub en memoria que
+# se alimenta de sus propias escrituras y, con varios workers, de las de los demás
+# vía LISTEN/NOTIFY. El pg_notify va dentro de la transacción de la escritura
+# (llega solo si hace commit) y cada worker ignora los avisos que él mismo emitió.
+VIVO_CANAL = "securityeye_vivo"
+VIVO_NOTIFY = os.getenv("VIVO_NOTIFY", "1") == "1"               # 0 con un solo worker
+VIVO_INTERVALO_SEG = float(os.getenv("VIVO_INTERVALO_SEG", "1"))    # mínimo entre eventos a un cliente
+VIVO_HEARTBEAT_SEG = float(os.getenv("VIVO_HEARTBEAT_SEG", "15"))
+VIVO_ORIGEN = f"{os.getpid()}-{os.urandom(4).hex()}"
+
+hub_vivo = HubEnVivo(inactiva_seg=float(os.getenv("VIVO_INACTIVA_SEG", "600")))
+
+def _deltas_vivo(ultimos):
+    """{sesion_id: snapshot} -> deltas compactos para el dashboard"""
+    return [
+        {
+            "sesion_id": sid, "usuario_id": d.usuario_id, "actividad": d.actividad,
+            "t": d.tiempo_total_seg, "perclos": float(d.perclos), "alertas": d.alertas,
+            "es_fatiga": d.es_fatiga,
+        }
+        for sid, d in ultimos.items()
+    ]
+
+async def _notificar_vivo(cur, deltas):
+    if VIVO_NOTIFY and deltas:
+        await cur.execute(
+            "SELECT pg_notify(%s, x) FROM unnest(%s::text[]) AS x",
+            (VIVO_CANAL, [json.dumps({**d, "origen": VIVO_ORIGEN}) for d in deltas]),
+        )
+
+async def _escuchar_avisos():
+    """
+    Conexión dedicada (fuera del pool) en LISTEN; se reconecta con backoff. Escucha
+    VIVO_CANAL si VIVO_NOTIFY y LOGS_CANAL si LOGS_NOTIFY: cada uno se activa por separado.
+    """
+    canales = [canal for canal, activo in ((VIVO_CANAL, VIVO_NOTIFY), (LOGS_CANAL, LOGS_NOTIFY)) if activo]
+    espera = 1
+    while True:
+        try:
+            async with await psycopg.AsyncConnection.connect(**DB_CONFIG, autocommit=True) as conn:
+                for canal in canales:
+                    await conn.execute(f"LISTEN {canal}")
+                espera = 1
+                async for aviso in conn.notifies():
+                    if aviso.channel == LOGS_CANAL:
+                        regla = json.loads(aviso.payload)
+                        muestreo_payloads.fijar(regla["ruta"], regla["fraccion"])
+                        continue
+                    delta = json.loads(aviso.payload)
+                    if delta.pop("origen", None) != VIVO_ORIGEN:
+                        hub_vivo.publicar([delta])
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception(f"Error escuchando {', '.join(canales)}; reintento en {espera}s")
+            await asyncio.sleep(espera)
+            espera = min(espera * 2, 30)
+
+@app.on_event("startup")
+async def iniciar_escucha_avisos():
+    if VIVO_NOTIFY or LOGS_NOTIFY:
+        app.state.avisos_tarea = asyncio.create_task(_escuchar_avisos())
+
+async def _detener_escucha_avisos():
+    tarea = getattr(app.state, "avisos_tarea", None)
+    if tarea:
+        tarea.cancel()
+        try:
+            await tarea
+        except asyncio.CancelledError:
+            pass
+
+@app.get("/admin/live")
+async def admin_live(request: Request):
+    """
+    Stream SSE de las sesiones abiertas. Primero llega el estado conocido y luego, como
+    mucho cada VIVO_INTERVALO_SEG, los cambios: evento "sesiones" con una lista de
+    {sesion_id, usuario_id, actividad, t, perclos, alertas, es_fatiga} (solo los
+    campos que llegaron) o {sesion_id, fin: true} al cerrarse la sesión.
+    """
+    async def eventos():
+        sub = hub_vivo.suscribir()
+        try:
+            yield "retry: 3000\n\n"
+            while not await request.is_disconnected():
+                deltas = await sub.siguiente(VIVO_HEARTBEAT_SEG)
+                if deltas:
+                    yield f"event: sesiones\ndata: {json.dumps(deltas)}\n\n"
+                    await asyncio.sleep(VIVO_INTERVALO_SEG)
+                else:
+                    yield ": ping\n\n"
+        finally:
+            hub_vivo.desuscribir(sub)
+
+    return StreamingResponse(
+        eventos(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# --- ENDPOINT: ADMIN MUESTREO DE LOGS ---
+class MuestreoRuta(BaseModel):
+    ruta: str        # plantilla de la ruta, p. ej. "/save-fatigue" o "/sesiones/{sesion_id}"
+    fraccion: float  # 0 desactiva, 1 loguea todas (hasta LOG_PAYLOAD_POR_SEG por segundo)
+
+@app.get("/admin/logs/muestreo")
+async def ver_muestreo_logs():
+    return {"rutas": muestreo_payloads.reglas, "max_por_seg": muestreo_payloads.max_por_seg}
+
+@app.put("/admin/logs/muestreo")
+async def fijar_muestreo_logs(data: MuestreoRuta):
+    """Activa o cambia el logueo de payloads de una ruta en este worker y, por NOTIFY, en los demás"""
+    if data.ruta not in {getattr(r, "path", None) for r in app.routes}:
+        raise HTTPException(status_code=404, detail=f"Ruta desconocida: {data.ruta}")
+    muestreo_payloads.fijar(data.ruta, data.fraccion)
+    if LOGS_NOTIFY:
+        async with _db_conn() as conn:
+            await conn.execute("SELECT pg_notify(%s, %s)", (LOGS_CANAL, data.model_dump_json()))
+    log.info("Muestreo de payloads actualizado", extra={"ruta": data.ruta, "fraccion": data.fraccion})
+    return {"rutas": muestreo_payloads.reglas}
@@ -0,0 +1,113 @@
+"""
+Benchmark de logins en ráfaga contra un backend en marcha.
+
+Crea usuarios de prueba (todos con la misma contraseña, un solo hash), lanza
+--concurrencia logins simultáneos hasta completar --logins y, mientras tanto,
+mide cada --sondeo-ms la latencia de una lectura que usa el pool de BD
+(/sesiones/0): si el hash de contraseñas ocupara el pool o el event loop, se nota ahí.
+Al terminar borra los usuarios creados.
+
+Uso:
+    uvicorn backend:app --workers 2 &
+    python bench_login.py                                # 200 logins, 60 a la vez
+    python bench_login.py --logins 1000 --concurrencia 200 --url http://127.0.0.1:8000
+"""
+import argparse
+import asyncio
+import time
+from collections import Counter
+
+import bcrypt
+import httpx
+import numpy as np
+import psycopg
+
+from config_db import DB_CONFIG
+
+CONTRASENA = "bench-login"
+
+def _crear_usuarios(conn, n):
+    hash_pw = bcrypt.hashpw(CONTRASENA.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+    prefijo = f"bench-login-{int(time.time())}"
+    filas = conn.execute(
+        """
+        INSERT INTO usuarios (nombre, apellido, correo, contrasena, rol_id)
+        SELECT 'Bench', 'Login', %s || '-' || g || '@bench.test', %s, 2
+        FROM generate_series(1, %s) g
+        RETURNING correo
+        """,
+        (prefijo, hash_pw, n),
+    ).fetchall()
+    return prefijo, [f[0] for f in filas]
+
+def _percentiles(latencias):
+    if not latencias:
+        return "sin datos"
+    p50, p95, p99 = np.percentile(np.asarray(latencias) * 1000, [50, 95, 99])
+    return f"p50 {p50:.0f} ms, p95 {p95:.0f} ms, p99 {p99:.0f} ms, máx {max(latencias) * 1000:.0f} ms"
+
+async def _rafaga(url, correos, logins, concurrencia, sondeo_ms):
+    estados = Counter()
+    latencias_ok, latencias_sondeo = [], []
+    limites = httpx.Limits(max_connections=concurrencia + 1, max_keepalive_connections=concurrencia + 1)
+    async with httpx.AsyncClient(base_url=url, limits=limites, timeout=60) as cliente:
+        cola = asyncio.Queue()
+        for i in range(logins):
+            cola.put_nowait(correos[i % len(correos)])
+
+        async def loguear():
+            while not cola.empty():
+                correo = cola.get_nowait()
+                inicio = time.perf_counter()
+                try:
+                    r = await cliente.post("/login", json={"correo": correo, "contrasena": CONTRASENA})
+                    estados[r.status_code] += 1
+                    if r.status_code == 200:
+                        latencias_ok.append(time.perf_counter() - inicio)
+                except httpx.HTTPError as e:
+                    estados[type(e).__name__] += 1
+
+        async def sondear():
+            while True:
+                inicio = time.perf_counter()
+                try:
+                    await cliente.get("/sesiones/0")
+                    latencias_sondeo.append(time.perf_counter() - inicio)
+                except httpx.HTTPError:
+                    pass
+                await asyncio.sleep(sondeo_ms / 1000)
+
+        sonda = asyncio.create_task(sondear())
+        inicio = time.perf_counter()
+        await asyncio.gather(*(loguear() for _ in range(concurrencia)))
+        duracion = time.perf_counter() - inicio
+        sonda.cancel()
+    return duracion, estados, latencias_ok, latencias_sondeo
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="backend a medir")
+    parser.add_argument("--usuarios", type=int, default=60, help="usuarios de prueba a crear")
+    parser.add_argument("--logins", type=int, default=200, help="logins totales")
+    parser.add_argument("--concurrencia", type=int, default=60, help="logins simultáneos")
+    parser.add_argument("--sondeo-ms", type=float, default=100, help="intervalo de la lectura de control")
+    args = parser.parse_args(argv)
+
+    with psycopg.connect(**DB_CONFIG, autocommit=True) as conn:
+        prefijo, correos = _crear_usuarios(conn, args.usuarios)
+        try:
+            duracion, estados, latencias_ok, latencias_sondeo = asyncio.run(
+                _rafaga(args.url, correos, args.logins, args.concurrencia, args.sondeo_ms)
+            )
+        finally:
+            conn.execute("DELETE FROM usuarios WHERE correo LIKE %s", (prefijo + "-%",))
+
+    exitosos = estados.get(200, 0)
+    print(f"{args.logins} logins ({args.concurrencia} a la vez) en {duracion:.2f}s: "
+          f"{exitosos / duracion:.1f} logins/s exitosos")
+    print(f"Estados: {dict(estados)}")
+    print(f"Latencia login OK: {_percentiles(latencias_ok)}")
+    print(f"Lectura de control durante la ráfaga: {_percentiles(latencias_sondeo)}")
+
+if __name__ == "__main__":
+    main()
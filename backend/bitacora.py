@@ -0,0 +1,145 @@
+"""
+Logs estructurados (una línea JSON por registro) que no bloquean el event loop.
+
+configurar() deja en el logger raíz un QueueHandler: quien loguea solo arma el
+registro y lo encola; un hilo (QueueListener) lo formatea y lo escribe en stdout.
+Los loggers de uvicorn se redirigen por el mismo camino. Cada registro lleva el
+id de la petición en curso (id_peticion, lo fija el middleware de backend.py) y
+los campos pasados en extra={...}:
+
+    log.info("Diagnóstico guardado", extra={"sesion_id": 42})
+    -> {"ts": "...", "nivel": "INFO", "logger": "securityeye", "msg": "Diagnóstico guardado",
+        "id_peticion": "3f9c...", "sesion_id": 42}
+
+MuestreoPayloads decide qué cuerpos de petición se loguean: por ruta, una
+fracción (0-1) y un máximo por segundo, modificables en caliente.
+"""
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+from datetime import datetime, timezone
+
+id_peticion = contextvars.ContextVar("id_peticion", default=None)
+
+# Atributos propios de LogRecord (más los que agrega uvicorn): el resto vino en extra
+_ATRIBUTOS_REGISTRO = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {
+    "message", "asctime", "id_peticion", "color_message",
+}
+CAMPOS_SENSIBLES = {"contrasena", "password", "token", "authorization"}
+
+class _FiltroPeticion(logging.Filter):
+    """Corre en el hilo que loguea, donde el ContextVar de la petición es visible"""
+
+    def filter(self, record):
+        record.id_peticion = id_peticion.get()
+        return True
+
+class _ManejadorCola(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # El mensaje se resuelve ahora (los args podrían cambiar después); la excepción
+        # queda aparte para que el formato JSON la ponga en su propio campo
+        record = copy.copy(record)
+        record.msg, record.args = record.getMessage(), None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+class FormatoJson(logging.Formatter):
+    def format(self, record):
+        datos = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "nivel": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "id_peticion", None):
+            datos["id_peticion"] = record.id_peticion
+        for clave, valor in vars(record).items():
+            if clave not in _ATRIBUTOS_REGISTRO:
+                datos[clave] = valor
+        if record.exc_text:
+            datos["exc"] = record.exc_text
+        return json.dumps(datos, ensure_ascii=False, default=str)
+
+def configurar(nivel="INFO", formato="json"):
+    """Instala el logging en cola; devuelve el QueueListener (se detiene al salir)"""
+    salida = logging.StreamHandler(sys.stdout)
+    if formato == "json":
+        salida.setFormatter(FormatoJson())
+    else:
+        salida.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(id_peticion)s] %(message)s"))
+
+    cola = queue.SimpleQueue()
+    manejador = _ManejadorCola(cola)
+    manejador.addFilter(_FiltroPeticion())
+    raiz = logging.getLogger()
+    raiz.handlers = [manejador]
+    raiz.setLevel(nivel)
+    for nombre in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        logger = logging.getLogger(nombre)
+        logger.handlers = []
+        logger.propagate = True
+
+    oyente = logging.handlers.QueueListener(cola, salida)
+    oyente.start()
+    atexit.register(oyente.stop)
+    return oyente
+
+def _redactar(valor):
+    if isinstance(valor, dict):
+        return {k: "***" if k.lower() in CAMPOS_SENSIBLES else _redactar(v) for k, v in valor.items()}
+    if isinstance(valor, list):
+        return [_redactar(v) for v in valor]
+    return valor
+
+def resumir_payload(cuerpo, truncado=False):
+    """Cuerpo de la petición para el log: JSON con campos sensibles ocultos, o su tamaño si no es JSON"""
+    if not truncado:
+        try:
+            return _redactar(json.loads(cuerpo))
+        except ValueError:
+            pass
+    return {"bytes": len(cuerpo), "truncado": truncado}
+
+class MuestreoPayloads:
+    def __init__(self, reglas=None, max_por_seg=5, max_bytes=16384):
+        self.reglas = dict(reglas or {})   # ruta (plantilla) -> fracción de peticiones a loguear
+        self.max_por_seg = max_por_seg     # tope por ruta, aunque la fracción sea 1
+        self.max_bytes = max_bytes
+        self._ventanas = {}                # ruta -> [segundo, logueadas en ese segundo]
+
+    @staticmethod
+    def parsear(texto):
+        """'/save-fatigue=0.01,/login=0.5' -> {'/save-fatigue': 0.01, '/login': 0.5}"""
+        reglas = {}
+        for parte in filter(None, (p.strip() for p in texto.split(","))):
+            ruta, _, fraccion = parte.partition("=")
+            reglas[ruta.strip()] = float(fraccion or 1)
+        return reglas
+
+    def fijar(self, ruta, fraccion):
+        if fraccion <= 0:
+            self.reglas.pop(ruta, None)
+        else:
+            self.reglas[ruta] = min(float(fraccion), 1.0)
+
+    def elegir(self, ruta):
+        fraccion = self.reglas.get(ruta)
+        if not fraccion or random.random() >= fraccion:
+            return False
+        segundo = int(time.monotonic())
+        ventana = self._ventanas.get(ruta)
+        if ventana is None or ventana[0] != segundo:
+            ventana = self._ventanas[ruta] = [segundo, 0]
+        if ventana[1] >= self.max_por_seg:
+            return False
+        ventana[1] += 1
+        return True
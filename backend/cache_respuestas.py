@@ -0,0 +1,100 @@
+"""
+Caché LRU en memoria (por proceso) de respuestas JSON ya serializadas, con ETag fuerte.
+
+Uso típico en un endpoint:
+
+    entrada = cache.obtener(clave)
+    if entrada is None:
+        marca = cache.marca()         # antes de leer la BD
+        ...                           # leer y armar la respuesta
+        entrada = cache.guardar(clave, cuerpo, marca)
+
+guardar() descarta la respuesta si la clave se invalidó después de `marca`: así una
+lectura que empezó antes de un commit no deja en caché datos viejos. Las escrituras
+invalidan con cache.invalidar(clave) después del commit.
+
+Cada worker de uvicorn tiene su propia caché; la invalidación es local, por eso las
+entradas además vencen a los ttl_seg segundos.
+"""
+import hashlib
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+@dataclass(frozen=True)
+class Entrada:
+    cuerpo: bytes
+    etag: str
+    vence: float
+
+def calcular_etag(cuerpo):
+    """ETag fuerte: hash del cuerpo exacto que se envía"""
+    return '"' + hashlib.sha256(cuerpo).hexdigest()[:32] + '"'
+
+def coincide_etag(if_none_match, etag):
+    """True si la cabecera If-None-Match incluye el ETag (o es *)"""
+    if not if_none_match:
+        return False
+    candidatos = [c.strip() for c in if_none_match.split(",")]
+    return "*" in candidatos or etag in candidatos
+
+class CacheRespuestas:
+    def __init__(self, max_entradas=1024, max_bytes=16 * 1024 * 1024, ttl_seg=300):
+        self.max_entradas = max_entradas
+        self.max_bytes = max_bytes
+        self.ttl_seg = ttl_seg
+        self._entradas = OrderedDict()
+        self._bytes = 0
+        self._contador = 0          # aumenta con cada invalidación
+        self._invalidada_en = {}    # clave -> contador de su última invalidación
+        self._piso = 0              # marcas anteriores a esto se rechazan (tras podar _invalidada_en)
+        self.aciertos = 0
+        self.fallos = 0
+
+    def __len__(self):
+        return len(self._entradas)
+
+    def obtener(self, clave):
+        entrada = self._entradas.get(clave)
+        if entrada is None or entrada.vence < time.monotonic():
+            if entrada is not None:
+                self._quitar(clave)
+            self.fallos += 1
+            return None
+        self._entradas.move_to_end(clave)
+        self.aciertos += 1
+        return entrada
+
+    def marca(self):
+        return self._contador
+
+    def guardar(self, clave, cuerpo, marca):
+        """Guarda y devuelve la entrada, o None si la clave se invalidó después de `marca`"""
+        if marca < self._piso or self._invalidada_en.get(clave, -1) > marca:
+            return None
+        if len(cuerpo) > self.max_bytes:
+            return None
+        self._quitar(clave)
+        entrada = Entrada(cuerpo, calcular_etag(cuerpo), time.monotonic() + self.ttl_seg)
+        self._entradas[clave] = entrada
+        self._bytes += len(cuerpo)
+        while len(self._entradas) > self.max_entradas or self._bytes > self.max_bytes:
+            _, vieja = self._entradas.popitem(last=False)
+            self._bytes -= len(vieja.cuerpo)
+        return entrada
+
+    def invalidar(self, *claves):
+        self._contador += 1
+        for clave in claves:
+            self._quitar(clave)
+            self._invalidada_en[clave] = self._contador
+        # Acotar el registro de invalidaciones: al podarlo, rechazar las marcas previas
+        if len(self._invalidada_en) > 4 * self.max_entradas:
+            self._invalidada_en.clear()
+            self._contador += 1
+            self._piso = self._contador
+
+    def _quitar(self, clave):
+        vieja = self._entradas.pop(clave, None)
+        if vieja is not None:
+            self._bytes -= len(vieja.cuerpo)
@@ -0,0 +1,312 @@
+"""
+Prueba de carga: aulas completas monitoreándose a la vez contra un backend local.
+
+Levanta un webhook de N8N falso (latencia y tasa de error configurables) y, salvo
+que se pase --url, un backend propio con uvicorn apuntando a él y a la BD de
+config_db. Cada estudiante virtual recorre el flujo del navegador:
+
+    create-session -> /save-fatigue periódico -> registrar-descanso
+    -> /save-fatigue final con KSS -> end-session
+    -> /sesiones/{id} + /get-or-create-diagnosis (reintenta mientras responda 202)
+
+Las aulas arrancan escalonadas y todos sus estudiantes a la vez (inicio de clase).
+Reporta por endpoint: peticiones, peticiones/s, % de error y latencia p50/p95/p99.
+Al terminar borra los usuarios y sesiones creados.
+
+Uso:
+    python carga_aulas.py                                     # 2 aulas x 30 estudiantes
+    python carga_aulas.py --aulas 5 --estudiantes 40 --snapshots 10 --intervalo 2
+    python carga_aulas.py --n8n-latencia-ms 3000 --n8n-errores 0.1 --workers 4
+    python carga_aulas.py --url http://127.0.0.1:8000         # backend ya en marcha
+    python carga_aulas.py --json resultado.json --max-errores 0.01
+Sale con código 1 si la tasa de error total supera --max-errores.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from collections import Counter, defaultdict
+
+import httpx
+import numpy as np
+import psycopg
+import uvicorn
+
+from config_db import DB_CONFIG
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# --- N8N FALSO ---
+class N8nFalso:
+    """App ASGI mínima con la forma de respuesta del webhook real ([{"json": diagnóstico}])"""
+
+    def __init__(self, latencia_ms, jitter_ms, tasa_error, semilla=None):
+        self.latencia_ms = latencia_ms
+        self.jitter_ms = jitter_ms
+        self.tasa_error = tasa_error
+        self.llamadas = Counter()
+        self.rng = random.Random(semilla)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        mas = True
+        while mas:
+            mensaje = await receive()
+            mas = mensaje.get("more_body", False)
+        espera = max(0.0, self.latencia_ms + self.rng.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+        await asyncio.sleep(espera)
+
+        if self.rng.random() < self.tasa_error:
+            self.llamadas["error"] += 1
+            codigo, cuerpo = 500, {"message": "error simulado"}
+        else:
+            self.llamadas["ok"] += 1
+            codigo, cuerpo = 200, [{"json": {
+                "diagnostico_general": "Diagnóstico simulado",
+                "severidad_fatiga_final": "MODERADA",
+                "recomendaciones_generales": ["Toma un descanso de 2-3 minutos"],
+            }}]
+        datos = json.dumps(cuerpo).encode("utf-8")
+        await send({
+            "type": "http.response.start", "status": codigo,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(datos)).encode())],
+        })
+        await send({"type": "http.response.body", "body": datos})
+
+async def _iniciar_n8n(n8n, puerto):
+    servidor = uvicorn.Server(uvicorn.Config(n8n, host="127.0.0.1", port=puerto, log_level="warning", lifespan="off"))
+    tarea = asyncio.create_task(servidor.serve())
+    while not servidor.started:
+        if tarea.done():
+            tarea.result()
+        await asyncio.sleep(0.05)
+    return servidor, tarea
+
+# --- BACKEND ---
+def _lanzar_backend(puerto, workers, n8n_url):
+    env = {**os.environ, "N8N_WEBHOOK_URL": n8n_url}
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "backend:app", "--host", "127.0.0.1", "--port", str(puerto),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env,
+    )
+
+async def _esperar_backend(url, proceso, timeout_seg=60):
+    limite = time.monotonic() + timeout_seg
+    async with httpx.AsyncClient(base_url=url) as cliente:
+        while time.monotonic() < limite:
+            if proceso is not None and proceso.poll() is not None:
+                raise RuntimeError(f"El backend terminó al iniciar (código {proceso.returncode})")
+            try:
+                if (await cliente.get("/actividades-descanso")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.25)
+    raise RuntimeError(f"El backend no respondió en {timeout_seg}s")
+
+# --- ESTUDIANTES VIRTUALES ---
+class Estadisticas:
+    def __init__(self):
+        self.latencias = defaultdict(list)
+        self.estados = defaultdict(Counter)
+
+    async def pedir(self, cliente, nombre, metodo, ruta, **kwargs):
+        inicio = time.perf_counter()
+        try:
+            respuesta = await cliente.request(metodo, ruta, **kwargs)
+        except httpx.HTTPError as e:
+            self.estados[nombre][type(e).__name__] += 1
+            return None
+        self.latencias[nombre].append(time.perf_counter() - inicio)
+        self.estados[nombre][respuesta.status_code] += 1
+        return respuesta
+
+    @staticmethod
+    def _es_error(estado):
+        return not isinstance(estado, int) or estado >= 400
+
+    def resumen(self, duracion):
+        filas = {}
+        for nombre in sorted(self.estados):
+            estados = self.estados[nombre]
+            total = sum(estados.values())
+            errores = sum(n for e, n in estados.items() if self._es_error(e))
+            latencias = np.asarray(self.latencias[nombre]) * 1000
+            p50, p95, p99 = np.percentile(latencias, [50, 95, 99]) if latencias.size else (0.0, 0.0, 0.0)
+            filas[nombre] = {
+                "peticiones": total,
+                "por_seg": round(total / duracion, 2),
+                "errores": errores,
+                "tasa_error": round(errores / total, 4) if total else 0.0,
+                "p50_ms": round(float(p50), 1),
+                "p95_ms": round(float(p95), 1),
+                "p99_ms": round(float(p99), 1),
+                "estados": {str(e): n for e, n in estados.items()},
+            }
+        return filas
+
+def _snapshot(sesion_id, usuario_id, i, intervalo, rng, kss=0):
+    t = int(i * intervalo)
+    sebr = int(t / 60 * rng.uniform(8, 18))
+    alertas = i // 4
+    perclos = round(rng.uniform(5, 35), 2)
+    return {
+        "sesion_id": sesion_id, "usuario_id": usuario_id, "actividad": "pdf",
+        "sebr": sebr, "blink_rate_min": round(sebr / max(t / 60, 1 / 60), 2), "perclos": perclos,
+        "pct_incompletos": round(rng.uniform(0, 30), 2), "tiempo_cierre": round(rng.uniform(0, 4), 2),
+        "num_bostezos": i // 5, "velocidad_ocular": round(rng.uniform(0.01, 0.2), 4),
+        "nivel_subjetivo": kss, "es_fatiga": perclos >= 15 or alertas >= 2 or kss >= 7,
+        "tiempo_total_seg": t, "max_sin_parpadeo": rng.randint(2, 15), "alertas": alertas,
+        "momentos_fatiga": [{"t": t, "reason": "Fatiga moderada"}] if alertas and i % 4 == 0 else [],
+        "seq": i,
+    }
+
+async def _estudiante(cliente, stats, usuario_id, args, rng):
+    r = await stats.pedir(cliente, "create-session", "POST", "/create-session",
+                          json={"usuario_id": usuario_id, "tipo_actividad": "pdf", "fuente": "carga"})
+    if r is None or r.status_code != 200:
+        return
+    sesion_id = r.json()["sesion_id"]
+
+    # Desfase dentro del intervalo: no todos los navegadores guardan en el mismo instante
+    await asyncio.sleep(rng.uniform(0, args.intervalo))
+    for i in range(1, args.snapshots + 1):
+        await stats.pedir(cliente, "save-fatigue", "POST", "/save-fatigue",
+                          json=_snapshot(sesion_id, usuario_id, i, args.intervalo, rng))
+        if i == max(1, args.snapshots // 2):
+            await stats.pedir(cliente, "registrar-descanso", "POST", "/registrar-descanso", json={
+                "sesion_id": sesion_id, "actividad_id": 1, "actividad_nombre": "20-20-20", "duracion_seg": 20,
+            })
+        await asyncio.sleep(args.intervalo)
+
+    await stats.pedir(cliente, "save-fatigue (KSS final)", "POST", "/save-fatigue",
+                      json=_snapshot(sesion_id, usuario_id, args.snapshots + 1, args.intervalo, rng,
+                                     kss=rng.randint(1, 9)))
+    await stats.pedir(cliente, "end-session", "POST", f"/end-session/{sesion_id}")
+
+    # Página de resumen
+    await stats.pedir(cliente, "sesiones/{id}", "GET", f"/sesiones/{sesion_id}")
+    for _ in range(args.diagnostico_intentos):
+        r = await stats.pedir(cliente, "get-or-create-diagnosis", "POST", "/get-or-create-diagnosis",
+                              json={"sesion_id": sesion_id})
+        if r is None or r.status_code != 202:
+            break
+        await asyncio.sleep(args.diagnostico_espera)
+
+async def _correr(args, usuarios):
+    n8n = N8nFalso(args.n8n_latencia_ms, args.n8n_jitter_ms, args.n8n_errores, args.semilla)
+    servidor_n8n, tarea_n8n = await _iniciar_n8n(n8n, args.n8n_puerto)
+    proceso = None
+    url = args.url
+    try:
+        if not url:
+            proceso = _lanzar_backend(args.puerto, args.workers, f"http://127.0.0.1:{args.n8n_puerto}/webhook/fatigue")
+            url = f"http://127.0.0.1:{args.puerto}"
+        await _esperar_backend(url, proceso)
+
+        stats = Estadisticas()
+        rng = random.Random(args.semilla)
+        limites = httpx.Limits(max_connections=len(usuarios) + 10, max_keepalive_connections=len(usuarios) + 10)
+        async with httpx.AsyncClient(base_url=url, limits=limites, timeout=args.timeout) as cliente:
+            async def aula(indice, ids):
+                await asyncio.sleep(indice * args.escalonado)
+                await asyncio.gather(*(
+                    _estudiante(cliente, stats, uid, args, random.Random(rng.random())) for uid in ids
+                ))
+
+            inicio = time.perf_counter()
+            await asyncio.gather(*(
+                aula(a, usuarios[a * args.estudiantes:(a + 1) * args.estudiantes]) for a in range(args.aulas)
+            ))
+            duracion = time.perf_counter() - inicio
+        return duracion, stats, n8n.llamadas
+    finally:
+        if proceso is not None:
+            proceso.terminate()
+            try:
+                proceso.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                proceso.kill()
+        servidor_n8n.should_exit = True
+        await tarea_n8n
+
+def _crear_usuarios(conn, n):
+    prefijo = f"carga-{int(time.time())}"
+    filas = conn.execute(
+        """
+        INSERT INTO usuarios (nombre, apellido, correo, contrasena, rol_id)
+        SELECT 'Carga', 'N' || g, %s || '-' || g || '@carga.test', 'x', 2
+        FROM generate_series(1, %s) g
+        ORDER BY g
+        RETURNING id
+        """,
+        (prefijo, n),
+    ).fetchall()
+    return prefijo, [f[0] for f in filas]
+
+def _borrar(conn, prefijo):
+    conn.execute(
+        "DELETE FROM sesiones WHERE usuario_id IN (SELECT id FROM usuarios WHERE correo LIKE %s)", (prefijo + "-%",)
+    )
+    conn.execute("DELETE FROM usuario_resumen WHERE usuario_id IN (SELECT id FROM usuarios WHERE correo LIKE %s)",
+                 (prefijo + "-%",))
+    conn.execute("DELETE FROM usuarios WHERE correo LIKE %s", (prefijo + "-%",))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--aulas", type=int, default=2)
+    parser.add_argument("--estudiantes", type=int, default=30, help="estudiantes por aula")
+    parser.add_argument("--escalonado", type=float, default=5, help="segundos entre el inicio de cada aula")
+    parser.add_argument("--snapshots", type=int, default=6, help="/save-fatigue periódicos por estudiante")
+    parser.add_argument("--intervalo", type=float, default=5, help="segundos entre snapshots")
+    parser.add_argument("--diagnostico-intentos", type=int, default=10)
+    parser.add_argument("--diagnostico-espera", type=float, default=1, help="segundos entre consultas con 202")
+    parser.add_argument("--url", help="backend ya en marcha (si no, se lanza uno con uvicorn)")
+    parser.add_argument("--puerto", type=int, default=8765, help="puerto del backend lanzado")
+    parser.add_argument("--workers", type=int, default=1, help="workers de uvicorn del backend lanzado")
+    parser.add_argument("--n8n-puerto", type=int, default=5679)
+    parser.add_argument("--n8n-latencia-ms", type=float, default=800)
+    parser.add_argument("--n8n-jitter-ms", type=float, default=200)
+    parser.add_argument("--n8n-errores", type=float, default=0.0, help="fracción de llamadas a N8N que fallan")
+    parser.add_argument("--timeout", type=float, default=30, help="timeout por petición (s)")
+    parser.add_argument("--semilla", type=int, default=1)
+    parser.add_argument("--json", help="guardar el resultado en este archivo")
+    parser.add_argument("--max-errores", type=float, default=0.01, help="tasa de error total admitida")
+    args = parser.parse_args(argv)
+
+    with psycopg.connect(**DB_CONFIG, autocommit=True) as conn:
+        prefijo, usuarios = _crear_usuarios(conn, args.aulas * args.estudiantes)
+        try:
+            duracion, stats, llamadas_n8n = asyncio.run(_correr(args, usuarios))
+        finally:
+            _borrar(conn, prefijo)
+
+    filas = stats.resumen(duracion)
+    print(f"{args.aulas} aulas x {args.estudiantes} estudiantes en {duracion:.1f}s; "
+          f"N8N falso: {dict(llamadas_n8n)}")
+    print(f"{'endpoint':28} {'pet.':>6} {'pet/s':>7} {'error%':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for nombre, f in filas.items():
+        print(f"{nombre:28} {f['peticiones']:>6} {f['por_seg']:>7.1f} {f['tasa_error'] * 100:>6.2f}% "
+              f"{f['p50_ms']:>8.1f} {f['p95_ms']:>8.1f} {f['p99_ms']:>8.1f}")
+
+    total = sum(f["peticiones"] for f in filas.values())
+    errores = sum(f["errores"] for f in filas.values())
+    tasa = errores / total if total else 1.0
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as archivo:
+            json.dump({
+                "parametros": vars(args), "duracion_seg": round(duracion, 2),
+                "tasa_error": round(tasa, 4), "endpoints": filas, "n8n": dict(llamadas_n8n),
+            }, archivo, ensure_ascii=False, indent=2)
+    if tasa > args.max_errores:
+        print(f"FALLO: tasa de error {tasa:.2%} > {args.max_errores:.2%}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
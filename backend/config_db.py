@@ -0,0 +1,20 @@
+"""Parámetros de conexión a PostgreSQL compartidos por el backend y los comandos de mantenimiento"""
+import os
+
+DB_CONFIG = {
+    "host": os.getenv("DB_HOST", "127.0.0.1"),
+    "port": int(os.getenv("DB_PORT", "5432")),
+    "dbname": os.getenv("DB_NAME", "pry_lectura1"),
+    "user": os.getenv("DB_USER", "postgres"),
+    "password": os.getenv("DB_PASS", "123"),
+}
+
+# Réplica de lectura (opcional). Sin DB_REPLICA_HOST todo va al primario;
+# usuario, contraseña y base son los del primario salvo que se indiquen.
+DB_REPLICA_CONFIG = {
+    **DB_CONFIG,
+    "host": os.getenv("DB_REPLICA_HOST"),
+    "port": int(os.getenv("DB_REPLICA_PORT", str(DB_CONFIG["port"]))),
+    "user": os.getenv("DB_REPLICA_USER", DB_CONFIG["user"]),
+    "password": os.getenv("DB_REPLICA_PASS", DB_CONFIG["password"]),
+} if os.getenv("DB_REPLICA_HOST") else None
@@ -0,0 +1,99 @@
+"""
+Hub en memoria del monitoreo en vivo (/admin/live).
+
+Guarda el último estado conocido de cada sesión abierta y reparte los cambios a
+los suscriptores. Cada suscripción acumula solo el delta más reciente por sesión:
+un cliente lento no hace crecer ninguna cola, al leer recibe el estado actual.
+Se usa solo desde el event loop, así que no lleva locks.
+
+    hub = HubEnVivo()
+    sub = hub.suscribir()                 # el estado conocido llega como primer lote
+    hub.publicar([{"sesion_id": 7, "t": 30, "perclos": 12.5}])
+    deltas = await sub.siguiente(timeout=15)
+    hub.desuscribir(sub)
+"""
+import asyncio
+import time
+from collections import OrderedDict
+
+class Suscripcion:
+    def __init__(self):
+        self._pendientes = {}   # sesion_id -> delta combinado aún no leído
+        self._evento = asyncio.Event()
+
+    def _agregar(self, delta):
+        previo = self._pendientes.get(delta["sesion_id"])
+        self._pendientes[delta["sesion_id"]] = {**previo, **delta} if previo else dict(delta)
+        self._evento.set()
+
+    async def siguiente(self, timeout=None):
+        """Deltas acumulados desde la última lectura ([] si venció el timeout)"""
+        if not self._pendientes:
+            try:
+                await asyncio.wait_for(self._evento.wait(), timeout)
+            except asyncio.TimeoutError:
+                return []
+        self._evento.clear()
+        deltas, self._pendientes = list(self._pendientes.values()), {}
+        return deltas
+
+class HubEnVivo:
+    def __init__(self, max_sesiones=5000, inactiva_seg=600):
+        self.max_sesiones = max_sesiones
+        self.inactiva_seg = inactiva_seg   # sin noticias en este tiempo: se da por abandonada
+        self.sesiones = OrderedDict()      # sesion_id -> último estado (sesiones abiertas)
+        self.visto = {}                    # sesion_id -> monotonic del último delta
+        self.finalizadas = OrderedDict()   # cerradas hace poco: ignora snapshots que lleguen tarde
+        self.suscripciones = set()
+
+    def _aplicar(self, delta):
+        """Actualiza el estado; False si el delta es atrasado o de una sesión ya cerrada"""
+        sid = delta["sesion_id"]
+        if delta.get("fin"):
+            self.sesiones.pop(sid, None)
+            self.visto.pop(sid, None)
+            self.finalizadas[sid] = True
+            if len(self.finalizadas) > self.max_sesiones:
+                self.finalizadas.popitem(last=False)
+            return True
+        if sid in self.finalizadas:
+            return False
+        estado = self.sesiones.get(sid)
+        if estado is None:
+            if len(self.sesiones) >= self.max_sesiones:
+                self.visto.pop(self.sesiones.popitem(last=False)[0], None)
+            self.sesiones[sid] = dict(delta)
+        elif delta.get("t") is not None and estado.get("t") is not None and delta["t"] < estado["t"]:
+            return False
+        else:
+            estado.update(delta)
+            self.sesiones.move_to_end(sid)
+        self.visto[sid] = time.monotonic()
+        return True
+
+    def podar(self):
+        """Olvida las sesiones que dejaron de enviar snapshots sin cerrarse (pestaña cerrada)"""
+        limite = time.monotonic() - self.inactiva_seg
+        while self.sesiones:
+            sid = next(iter(self.sesiones))
+            if self.visto.get(sid, 0) >= limite:
+                break
+            del self.sesiones[sid]
+            self.visto.pop(sid, None)
+
+    def publicar(self, deltas):
+        for delta in deltas:
+            if self._aplicar(delta):
+                for sub in self.suscripciones:
+                    sub._agregar(delta)
+
+    def suscribir(self):
+        self.podar()
+        sub = Suscripcion()
+        for estado in self.sesiones.values():
+            sub._agregar(estado)
+        self.suscripciones.add(sub)
+        return sub
+
+    def desuscribir(self, sub):
+        self.suscripciones.discard(sub)
@@ -0,0 +1,124 @@
+"""
+Métricas en memoria con salida en formato de texto de Prometheus (sin dependencias).
+
+Contador, Medidor e Histograma guardan sus valores en dicts indexados por la tupla
+de etiquetas; registrar una observación es una búsqueda en dict más una suma (y un
+bisect en los histogramas). Se actualizan solo desde el event loop, así que no
+llevan locks. Cada worker de uvicorn expone las suyas: Prometheus las agrega.
+
+    PETICIONES = Contador("app_peticiones_total", "Peticiones", ("ruta",))
+    PETICIONES.inc("/login")
+    texto = REGISTRO.exponer()
+"""
+from bisect import bisect_left
+
+BUCKETS_SEG = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _escapar(valor):
+    return str(valor).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _etiquetas(nombres, valores, extra=""):
+    partes = [f'{n}="{_escapar(v)}"' for n, v in zip(nombres, valores)]
+    if extra:
+        partes.append(extra)
+    return "{" + ",".join(partes) + "}" if partes else ""
+
+def _numero(valor):
+    if valor == float("inf"):
+        return "+Inf"
+    return repr(float(valor)) if isinstance(valor, float) else str(valor)
+
+class _Metrica:
+    tipo = ""
+
+    def __init__(self, nombre, ayuda, etiquetas=(), registro=None):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.etiquetas = tuple(etiquetas)
+        self.valores = {}
+        (registro or REGISTRO).registrar(self)
+
+    def exponer(self):
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} {self.tipo}"]
+        lineas.extend(self._muestras())
+        return lineas
+
+    def _muestras(self):
+        return [
+            f"{self.nombre}{_etiquetas(self.etiquetas, clave)} {_numero(valor)}"
+            for clave, valor in self.valores.items()
+        ]
+
+class Contador(_Metrica):
+    tipo = "counter"
+
+    def inc(self, *etiquetas, n=1):
+        self.valores[etiquetas] = self.valores.get(etiquetas, 0) + n
+
+    def fijar(self, valor, *etiquetas):
+        """Para contadores que ya lleva otro componente (p. ej. las estadísticas del pool)"""
+        self.valores[etiquetas] = valor
+
+class Medidor(_Metrica):
+    tipo = "gauge"
+
+    def inc(self, *etiquetas, n=1):
+        self.valores[etiquetas] = self.valores.get(etiquetas, 0) + n
+
+    def dec(self, *etiquetas, n=1):
+        self.valores[etiquetas] = self.valores.get(etiquetas, 0) - n
+
+    def fijar(self, valor, *etiquetas):
+        self.valores[etiquetas] = valor
+
+class Histograma(_Metrica):
+    tipo = "histogram"
+
+    def __init__(self, nombre, ayuda, etiquetas=(), buckets=BUCKETS_SEG, registro=None):
+        super().__init__(nombre, ayuda, etiquetas, registro)
+        self.buckets = tuple(sorted(buckets))
+
+    def observar(self, valor, *etiquetas):
+        serie = self.valores.get(etiquetas)
+        if serie is None:
+            # [conteo por bucket (no acumulado; el último es +Inf), suma]
+            serie = self.valores[etiquetas] = [[0] * (len(self.buckets) + 1), 0.0]
+        serie[0][bisect_left(self.buckets, valor)] += 1
+        serie[1] += valor
+
+    def _muestras(self):
+        lineas = []
+        for clave, (conteos, suma) in self.valores.items():
+            acumulado = 0
+            for limite, conteo in zip(self.buckets + (float("inf"),), conteos):
+                acumulado += conteo
+                le = f'le="{_numero(limite)}"'
+                lineas.append(f"{self.nombre}_bucket{_etiquetas(self.etiquetas, clave, le)} {acumulado}")
+            lineas.append(f"{self.nombre}_sum{_etiquetas(self.etiquetas, clave)} {_numero(suma)}")
+            lineas.append(f"{self.nombre}_count{_etiquetas(self.etiquetas, clave)} {acumulado}")
+        return lineas
+
+class Registro:
+    def __init__(self):
+        self.metricas = []
+        self.recolectores = []
+
+    def registrar(self, metrica):
+        self.metricas.append(metrica)
+
+    def al_exponer(self, funcion):
+        """funcion() se llama antes de cada exposición (valores que se leen al momento)"""
+        self.recolectores.append(funcion)
+        return funcion
+
+    def exponer(self):
+        for funcion in self.recolectores:
+            funcion()
+        lineas = []
+        for metrica in self.metricas:
+            lineas.extend(metrica.exponer())
+        return "\n".join(lineas) + "\n"
+
+REGISTRO = Registro()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
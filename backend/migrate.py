@@ -0,0 +1,149 @@
+"""
+Aplica las migraciones de SQL/migrations en orden y las registra en schema_migraciones.
+
+Uso:
+    python migrate.py                   # aplica las pendientes
+    python migrate.py --estado          # lista aplicadas / pendientes
+    python migrate.py --baseline 0001   # marca hasta 0001 como aplicadas sin ejecutarlas
+                                        # (bases creadas con el antiguo SQL/nuevo)
+
+Cada archivo NNNN_nombre.sql corre en su propia transacción, salvo los que empiezan
+con la línea "-- migrate: sin-transaccion" (p. ej. CREATE INDEX CONCURRENTLY), que se
+ejecutan sentencia por sentencia en autocommit y deben ser idempotentes.
+Un advisory lock evita que dos procesos migren a la vez, y el checksum guardado
+detecta migraciones ya aplicadas que se editaron después.
+"""
+import argparse
+import hashlib
+import os
+import re
+import sys
+
+import psycopg
+
+from config_db import DB_CONFIG
+
+MIGRACIONES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "SQL", "migrations")
+LOCK_MIGRACIONES = 7346001  # clave del pg_advisory_lock
+MARCA_SIN_TRANSACCION = "-- migrate: sin-transaccion"
+
+class ErrorMigracion(Exception):
+    pass
+
+def listar_migraciones(directorio=MIGRACIONES_DIR):
+    """[(version, nombre, ruta)] ordenadas por versión"""
+    migraciones = []
+    for archivo in sorted(os.listdir(directorio)):
+        coincidencia = re.fullmatch(r"(\d{4})_(\w+)\.sql", archivo)
+        if coincidencia:
+            migraciones.append((coincidencia.group(1), coincidencia.group(2), os.path.join(directorio, archivo)))
+    return migraciones
+
+def _checksum(sql):
+    return hashlib.sha256(sql.encode("utf-8")).hexdigest()
+
+def _sentencias(sql):
+    """Divide un archivo sin transacción en sentencias (solo DDL simple, sin funciones)"""
+    sin_comentarios = "\n".join(l for l in sql.splitlines() if not l.strip().startswith("--"))
+    return [s.strip() for s in sin_comentarios.split(";") if s.strip()]
+
+def _asegurar_tabla(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS public.schema_migraciones (
+            version varchar(4) PRIMARY KEY,
+            nombre text NOT NULL,
+            checksum varchar(64) NOT NULL,
+            aplicada_en timestamp without time zone NOT NULL DEFAULT now()
+        )
+    """)
+
+def _aplicadas(conn):
+    filas = conn.execute("SELECT version, checksum FROM public.schema_migraciones").fetchall()
+    return dict(filas)
+
+def _registrar(conn, version, nombre, checksum):
+    conn.execute(
+        "INSERT INTO public.schema_migraciones (version, nombre, checksum) VALUES (%s, %s, %s)",
+        (version, nombre, checksum),
+    )
+
+def _base_sin_registrar(conn):
+    """True si el esquema ya existe (creado con SQL/nuevo) pero no hay migraciones registradas"""
+    return conn.execute("SELECT to_regclass('public.sesiones') IS NOT NULL").fetchone()[0]
+
+def aplicar(conn, directorio=MIGRACIONES_DIR, salida=sys.stdout):
+    """Aplica las migraciones pendientes. conn debe estar en autocommit. Devuelve las versiones aplicadas."""
+    conn.execute("SELECT pg_advisory_lock(%s)", (LOCK_MIGRACIONES,))
+    try:
+        _asegurar_tabla(conn)
+        aplicadas = _aplicadas(conn)
+        if not aplicadas and _base_sin_registrar(conn):
+            raise ErrorMigracion(
+                "La base ya tiene el esquema pero schema_migraciones está vacía: "
+                "registrala con --baseline 0001 antes de migrar"
+            )
+
+        nuevas = []
+        for version, nombre, ruta in listar_migraciones(directorio):
+            with open(ruta, encoding="utf-8") as f:
+                sql = f.read()
+            checksum = _checksum(sql)
+            if version in aplicadas:
+                if aplicadas[version] != checksum:
+                    raise ErrorMigracion(f"La migración {version}_{nombre} cambió después de aplicarse")
+                continue
+
+            print(f"Aplicando {version}_{nombre} ...", file=salida)
+            if sql.lstrip().startswith(MARCA_SIN_TRANSACCION):
+                for sentencia in _sentencias(sql):
+                    conn.execute(sentencia)
+                _registrar(conn, version, nombre, checksum)
+            else:
+                with conn.transaction():
+                    conn.execute(sql)
+                    _registrar(conn, version, nombre, checksum)
+            # 0001 fija search_path = '' para la sesión; restaurarlo para las siguientes
+            conn.execute("RESET search_path")
+            nuevas.append(version)
+        return nuevas
+    finally:
+        conn.execute("SELECT pg_advisory_unlock(%s)", (LOCK_MIGRACIONES,))
+
+def baseline(conn, hasta, directorio=MIGRACIONES_DIR):
+    """Registra como aplicadas las migraciones <= hasta sin ejecutarlas"""
+    _asegurar_tabla(conn)
+    aplicadas = _aplicadas(conn)
+    registradas = []
+    for version, nombre, ruta in listar_migraciones(directorio):
+        if version > hasta or version in aplicadas:
+            continue
+        with open(ruta, encoding="utf-8") as f:
+            _registrar(conn, version, nombre, _checksum(f.read()))
+        registradas.append(version)
+    return registradas
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--estado", action="store_true", help="lista migraciones aplicadas y pendientes")
+    parser.add_argument("--baseline", metavar="VERSION", help="marca como aplicadas hasta VERSION sin ejecutarlas")
+    args = parser.parse_args(argv)
+
+    with psycopg.connect(**DB_CONFIG, autocommit=True) as conn:
+        try:
+            if args.baseline:
+                registradas = baseline(conn, args.baseline)
+                print(f"Registradas sin ejecutar: {', '.join(registradas) or 'ninguna'}")
+            elif args.estado:
+                _asegurar_tabla(conn)
+                aplicadas = _aplicadas(conn)
+                for version, nombre, _ in listar_migraciones():
+                    print(f"{'aplicada ' if version in aplicadas else 'pendiente'}  {version}_{nombre}")
+            else:
+                nuevas = aplicar(conn)
+                print(f"Migraciones aplicadas: {', '.join(nuevas) or 'ninguna (al día)'}")
+        except ErrorMigracion as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
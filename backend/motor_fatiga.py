@@ -0,0 +1,337 @@
+"""
+Motor de métricas de fatiga visual del lado del servidor.
+
+Recalcula a partir de la serie por frame (timestamp, EAR, MAR y posición del iris)
+las mismas métricas que static/js/monitoreo.js calcula en el navegador: calibración,
+umbrales de EAR, máquina de estados de parpadeo, parpadeos incompletos, PERCLOS,
+bostezos, velocidad ocular, nivelFatiga y alertas con cooldown. Todo se resuelve con
+operaciones vectorizadas de NumPy (sin bucles por frame). nivelFatiga y es_fatiga
+salen de las reglas compiladas de reglas_fatiga.json, las mismas que usa el navegador.
+
+Uso:
+    python motor_fatiga.py rescore sesiones/*.npz --procesos 8 > resultados.ndjson
+    python motor_fatiga.py rescore --sesion-id 42 --sesion-id 43 --dsn "host=... dbname=..."
+    python motor_fatiga.py bench --frames 108000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import reglas_fatiga
+
+# Mismas constantes que monitoreo.js
+CALIBRATION_DURATION = 10.0
+ALERT_COOLDOWN = 30.0
+MIN_YAWN_TIME = 1.5
+FACTOR_CIERRE = 0.55        # thresClose = baselineEAR * 0.55
+FACTOR_APERTURA = 0.85      # thresOpen = baselineEAR * 0.85
+FACTOR_INCOMPLETO = 0.7     # parpadeo incompleto si minEar > thresClose * 0.7
+MIN_UMBRAL_BOSTEZO = 0.5    # thresYawn = max(0.5, baselineMAR + 0.30)
+MARGEN_BOSTEZO = 0.30
+
+def _redondear(x):
+    """Math.round de JavaScript (mitades hacia arriba)"""
+    return np.floor(np.asarray(x, dtype=np.float64) + 0.5)
+
+def _ultimo_indice(mask):
+    """Para cada posición, índice del último True de mask hasta ahí (-1 si no hubo)"""
+    idx = np.where(mask, np.arange(mask.size), -1)
+    return np.maximum.accumulate(idx) if mask.size else idx
+
+def _metricas_vacias(kss):
+    return {
+        "sebr": 0, "blink_rate_min": 0.0, "perclos": 0.0, "pct_incompletos": 0.0,
+        "tiempo_cierre": 0.0, "num_bostezos": 0, "velocidad_ocular": 0.0,
+        "nivel_subjetivo": int(kss), "es_fatiga": bool(reglas_fatiga.actuales().es_fatiga({"nivel_subjetivo": kss})),
+        "tiempo_total_seg": 0,
+        "max_sin_parpadeo": 0, "alertas": 0, "momentos_fatiga": [], "nivel_fatiga": 0,
+        "frames": 0,
+    }
+
+def calcular_metricas(ts, ear, mar, iris_x, iris_y, kss=0):
+    """
+    Calcula las métricas de una sesión a partir de sus series por frame.
+
+    ts: segundos (monótonos) de cada frame; ear/mar: relación de aspecto de ojo y boca;
+    iris_x/iris_y: posición normalizada del centro del iris izquierdo.
+    Devuelve un dict con los mismos campos que FatigueResult más nivel_fatiga y frames.
+    """
+    ts = np.asarray(ts, dtype=np.float64)
+    ear = np.asarray(ear, dtype=np.float64)
+    mar = np.asarray(mar, dtype=np.float64)
+    iris_x = np.asarray(iris_x, dtype=np.float64)
+    iris_y = np.asarray(iris_y, dtype=np.float64)
+
+    n = ts.size
+    if n == 0:
+        return _metricas_vacias(kss)
+
+    # --- Calibración: frames hasta el primero con elapsed >= 10s (incluido) ---
+    n_cal = int(np.searchsorted(ts - ts[0], CALIBRATION_DURATION, side="left")) + 1
+    if n_cal >= n:
+        return _metricas_vacias(kss)
+
+    base_ear = ear[:n_cal].mean()
+    base_mar = mar[:n_cal].mean()
+    thres_close = base_ear * FACTOR_CIERRE
+    thres_open = base_ear * FACTOR_APERTURA
+    thres_yawn = max(MIN_UMBRAL_BOSTEZO, base_mar + MARGEN_BOSTEZO)
+
+    inicio = ts[n_cal - 1]
+    t = ts[n_cal:]
+    e = ear[n_cal:]
+    m = mar[n_cal:]
+    dt = np.diff(ts[n_cal - 1:])
+    total = t.size
+    frames = np.arange(1, total + 1)
+
+    # --- Parpadeo: histéresis entre thresClose y thresOpen ---
+    cerrado = e < thres_close
+    abierto = e > thres_open
+    ultimo_evento = _ultimo_indice(cerrado | abierto)
+    parpadeando = (ultimo_evento >= 0) & cerrado[np.maximum(ultimo_evento, 0)]
+    parpadeando_prev = np.concatenate(([False], parpadeando[:-1]))
+
+    inicio_parpadeo = cerrado & ~parpadeando_prev
+    fin_parpadeo = abierto & parpadeando_prev
+    inicios = np.flatnonzero(inicio_parpadeo)
+    fines = np.flatnonzero(fin_parpadeo)
+
+    # EAR mínimo de cada parpadeo: entre dos inicios solo hay frames del propio
+    # parpadeo o frames abiertos (EAR >= thresClose), que no cambian el mínimo
+    incompleto_en = np.zeros(total, dtype=bool)
+    if fines.size:
+        minimos = np.minimum.reduceat(e, inicios)
+        segmento = np.cumsum(inicio_parpadeo)[fines] - 1
+        incompleto_en[fines] = minimos[segmento] > thres_close * FACTOR_INCOMPLETO
+
+    parpadeos_acum = np.cumsum(fin_parpadeo)
+    incompletos_acum = np.cumsum(incompleto_en)
+    cerrados_acum = np.cumsum(cerrado)
+    cierre_acum = np.cumsum(np.where(cerrado, dt, 0.0))
+
+    perclos_acum = cerrados_acum / frames * 100
+    pct_incompletos_acum = np.divide(
+        incompletos_acum * 100.0, parpadeos_acum,
+        out=np.zeros(total), where=parpadeos_acum > 0,
+    )
+
+    # --- Máximo tiempo sin parpadear ---
+    ultimo_parpadeo = _ultimo_indice(fin_parpadeo)
+    t_ultimo_parpadeo = np.where(ultimo_parpadeo >= 0, t[np.maximum(ultimo_parpadeo, 0)], inicio)
+    max_sin_parpadeo_acum = np.maximum.accumulate(t - t_ultimo_parpadeo)
+
+    # --- Bostezos: tramos con MAR > umbral que duran más de MIN_YAWN_TIME ---
+    bostezando = m > thres_yawn
+    bostezando_prev = np.concatenate(([False], bostezando[:-1]))
+    fin_tramo = ~bostezando & bostezando_prev
+    inicio_tramo = _ultimo_indice(bostezando & ~bostezando_prev)
+    bostezo_en = np.zeros(total, dtype=bool)
+    idx_fin = np.flatnonzero(fin_tramo)
+    if idx_fin.size:
+        duracion = t[idx_fin] - t[inicio_tramo[idx_fin - 1]]
+        bostezo_en[idx_fin] = duracion > MIN_YAWN_TIME
+    bostezos_acum = np.cumsum(bostezo_en)
+
+    # --- Velocidad ocular: desplazamiento medio del iris entre frames ---
+    ix = iris_x[n_cal:]
+    iy = iris_y[n_cal:]
+    distancia = np.concatenate(([0.0], np.hypot(np.diff(ix), np.diff(iy))))
+    cuenta_iris = frames - 1
+    velocidad_acum = np.where(
+        cuenta_iris > 5,
+        np.round(np.cumsum(distancia) / np.maximum(cuenta_iris, 1) * 100, 4),
+        0.0,
+    )
+
+    # --- nivelFatiga por frame ---
+    reglas = reglas_fatiga.actuales()
+    nivel = reglas.nivel_fatiga.lote({
+        "perclos": perclos_acum,
+        "sebr": parpadeos_acum,
+        "frames": frames,
+        "pct_incompletos": pct_incompletos_acum,
+        "num_bostezos": bostezos_acum,
+        "velocidad_ocular": velocidad_acum,
+        "tiempo_cierre": cierre_acum,
+        "max_sin_parpadeo": max_sin_parpadeo_acum,
+    })
+
+    # --- Alertas con cooldown: se salta de alerta en alerta con searchsorted ---
+    candidatos = np.flatnonzero(nivel >= reglas.umbral_alerta)
+    t_candidatos = t[candidatos]
+    alertas_idx = []
+    pos = 0
+    while pos < candidatos.size:
+        alertas_idx.append(candidatos[pos])
+        ultima = t_candidatos[pos]
+        pos = int(np.searchsorted(t_candidatos, ultima + ALERT_COOLDOWN, side="left"))
+        # Misma comparación que el navegador: (now - lastAlertTime) > ALERT_COOLDOWN
+        while pos < candidatos.size and t_candidatos[pos] - ultima <= ALERT_COOLDOWN:
+            pos += 1
+    alertas_idx = np.asarray(alertas_idx, dtype=np.int64)
+
+    momentos = [
+        {"t": int(seg), "reason": "Fatiga severa" if nv >= reglas.umbral_severa else "Fatiga moderada"}
+        for seg, nv in zip(_redondear(t[alertas_idx] - inicio), nivel[alertas_idx])
+    ]
+
+    tiempo_total = float(t[-1] - inicio)
+    sebr = int(parpadeos_acum[-1])
+    perclos = float(perclos_acum[-1])
+    alertas = int(alertas_idx.size)
+    kss = int(kss)
+
+    return {
+        "sebr": sebr,
+        "blink_rate_min": round(sebr / (tiempo_total / 60), 2) if sebr > 0 and tiempo_total > 0 else 0.0,
+        "perclos": round(perclos, 2),
+        "pct_incompletos": round(float(pct_incompletos_acum[-1]), 2),
+        "tiempo_cierre": round(float(cierre_acum[-1]), 2),
+        "num_bostezos": int(bostezos_acum[-1]),
+        "velocidad_ocular": float(velocidad_acum[-1]),
+        "nivel_subjetivo": kss,
+        "es_fatiga": bool(reglas.es_fatiga({"perclos": perclos, "alertas": alertas, "nivel_subjetivo": kss})),
+        "tiempo_total_seg": int(_redondear(tiempo_total)),
+        "max_sin_parpadeo": int(_redondear(max_sin_parpadeo_acum[-1])),
+        "alertas": alertas,
+        "momentos_fatiga": momentos,
+        "nivel_fatiga": int(nivel[-1]),
+        "frames": int(n),
+    }
+
+# --- SERIES DE PRUEBA ---
+def serie_sintetica(n_frames, fps=30.0, seed=0):
+    """Serie por frame plausible: parpadeos cada ~4s, algún bostezo y deriva del iris"""
+    rng = np.random.default_rng(seed)
+    ts = np.arange(n_frames) / fps
+    ear = 0.30 + rng.normal(0, 0.01, n_frames)
+    mar = 0.30 + rng.normal(0, 0.02, n_frames)
+
+    inicios = np.flatnonzero(rng.random(n_frames) < 1 / (4 * fps))
+    for desfase, valor in enumerate((0.18, 0.10, 0.08, 0.12, 0.20)):
+        ear[np.minimum(inicios + desfase, n_frames - 1)] = valor
+
+    bostezos = np.flatnonzero(rng.random(n_frames) < 1 / (300 * fps))
+    for desfase in range(int(2 * fps)):
+        mar[np.minimum(bostezos + desfase, n_frames - 1)] = 0.85
+
+    iris_x = 0.5 + np.cumsum(rng.normal(0, 0.002, n_frames))
+    iris_y = 0.5 + np.cumsum(rng.normal(0, 0.002, n_frames))
+    return ts, ear, mar, iris_x, iris_y
+
+# --- CLI ---
+def _cargar_seye(ruta):
+    from senales import COLUMNAS_MOTOR, leer_chunk
+
+    with open(ruta, "rb") as f:
+        columnas = leer_chunk(f.read())
+    nombre = os.path.splitext(os.path.basename(ruta))[0]
+    sesion_id = int(nombre) if nombre.isdigit() else nombre
+    # float16 -> float64 para el motor (la única copia)
+    return sesion_id, tuple(columnas[c].astype(np.float64) for c in COLUMNAS_MOTOR), 0
+
+def _cargar_npz(ruta):
+    if ruta.endswith(".seye"):
+        return _cargar_seye(ruta)
+    with np.load(ruta) as datos:
+        if "sesion_id" in datos:
+            sesion_id = int(datos["sesion_id"])
+        else:
+            nombre = os.path.splitext(os.path.basename(ruta))[0]
+            sesion_id = int(nombre) if nombre.isdigit() else nombre
+        kss = int(datos["kss"]) if "kss" in datos else 0
+        return sesion_id, (datos["ts"], datos["ear"], datos["mar"], datos["iris_x"], datos["iris_y"]), kss
+
+_conn_bd = None
+
+def _conectar_bd(dsn):
+    """Inicializador de cada proceso del pool: una conexión propia (no se comparten entre procesos)"""
+    global _conn_bd
+    import psycopg
+
+    if dsn:
+        _conn_bd = psycopg.connect(dsn, autocommit=True)
+    else:
+        from config_db import DB_CONFIG
+        _conn_bd = psycopg.connect(**DB_CONFIG, autocommit=True)
+
+def _cargar_sesion_bd(sesion_id):
+    """Une los chunks guardados en senales_crudas (en orden de seq) y toma el KSS final"""
+    from senales import COLUMNAS_MOTOR, leer_senales_sesion
+
+    columnas = leer_senales_sesion(_conn_bd, sesion_id)
+    if columnas:
+        series = tuple(columnas[c].astype(np.float64) for c in COLUMNAS_MOTOR)
+    else:
+        series = tuple(np.empty(0) for _ in COLUMNAS_MOTOR)
+    fila = _conn_bd.execute("SELECT kss_final FROM sesiones WHERE id = %s", (sesion_id,)).fetchone()
+    return sesion_id, series, (fila[0] or 0) if fila else 0
+
+def _recalcular(entrada):
+    # int: sesión guardada en la BD; str: archivo local (.npz o .seye)
+    sesion_id, series, kss = _cargar_sesion_bd(entrada) if isinstance(entrada, int) else _cargar_npz(entrada)
+    return {"sesion_id": sesion_id, **calcular_metricas(*series, kss=kss)}
+
+def _cmd_rescore(args):
+    entradas = list(args.archivos) + list(args.sesion_id or [])
+    if not entradas:
+        sys.exit("Indicar archivos o al menos un --sesion-id")
+    opciones = {"initializer": _conectar_bd, "initargs": (args.dsn,)} if args.sesion_id else {}
+    inicio = time.perf_counter()
+    frames = 0
+    with ProcessPoolExecutor(max_workers=args.procesos, **opciones) as pool:
+        for resultado in pool.map(_recalcular, entradas, chunksize=args.chunksize):
+            frames += resultado["frames"]
+            sys.stdout.write(json.dumps(resultado) + "\n")
+    duracion = time.perf_counter() - inicio
+    print(
+        f"{len(entradas)} sesiones, {frames} frames en {duracion:.2f}s "
+        f"({frames / duracion:,.0f} frames/s)",
+        file=sys.stderr,
+    )
+
+def _cmd_bench(args):
+    series = serie_sintetica(args.frames, fps=args.fps)
+    calcular_metricas(*series)  # calentamiento
+    tiempos = []
+    for _ in range(args.repeticiones):
+        inicio = time.perf_counter()
+        calcular_metricas(*series)
+        tiempos.append(time.perf_counter() - inicio)
+    mejor = min(tiempos)
+    print(
+        f"{args.frames} frames ({args.frames / args.fps / 60:.0f} min a {args.fps:.0f} fps): "
+        f"mejor {mejor * 1000:.1f} ms, mediana {np.median(tiempos) * 1000:.1f} ms, "
+        f"{args.frames / mejor:,.0f} frames/s"
+    )
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Motor de métricas de fatiga visual")
+    sub = parser.add_subparsers(dest="comando", required=True)
+
+    p_rescore = sub.add_parser("rescore", help="Recalcula métricas de sesiones guardadas (.npz) en paralelo")
+    p_rescore.add_argument("archivos", nargs="*", help="archivos .npz con ts, ear, mar, iris_x, iris_y (o chunks binarios .seye)")
+    p_rescore.add_argument("--sesion-id", type=int, action="append",
+                           help="sesión cuyas señales se leen de senales_crudas (repetible)")
+    p_rescore.add_argument("--dsn", help="cadena de conexión para --sesion-id (por defecto config_db)")
+    p_rescore.add_argument("--procesos", type=int, default=os.cpu_count())
+    p_rescore.add_argument("--chunksize", type=int, default=4)
+    p_rescore.set_defaults(func=_cmd_rescore)
+
+    p_bench = sub.add_parser("bench", help="Mide el throughput del motor en frames por segundo")
+    p_bench.add_argument("--frames", type=int, default=108000)
+    p_bench.add_argument("--fps", type=float, default=30.0)
+    p_bench.add_argument("--repeticiones", type=int, default=5)
+    p_bench.set_defaults(func=_cmd_bench)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
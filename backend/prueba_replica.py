@@ -0,0 +1,147 @@
+"""
+Prueba del ruteo de lecturas primario/réplica con dos instancias locales de PostgreSQL.
+
+Levanta la app en el mismo proceso (con su pool al primario y a la réplica), escribe
+una sesión por la API y comprueba a qué pool va cada lectura:
+  1. justo después de escribir -> primario (escritura_reciente);
+  2. pasada la ventana de lectura propia -> réplica, con los datos ya replicados;
+  3. con --pausar-replay: réplica pausada y atrasada -> primario (retraso).
+Al terminar borra el usuario y las sesiones creadas.
+
+Réplica local (streaming replication) en el puerto 5433:
+    pg_basebackup -h 127.0.0.1 -p 5432 -U postgres -D /tmp/replica -R -X stream
+    pg_ctl -D /tmp/replica -o "-p 5433" -l /tmp/replica.log start
+
+Uso:
+    DB_REPLICA_HOST=127.0.0.1 DB_REPLICA_PORT=5433 python prueba_replica.py
+    DB_REPLICA_HOST=127.0.0.1 DB_REPLICA_PORT=5433 python prueba_replica.py --pausar-replay
+Sale con código 1 si alguna lectura fue al pool equivocado.
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+import psycopg
+
+from config_db import DB_CONFIG, DB_REPLICA_CONFIG
+
+def _crear_usuario(conn):
+    return conn.execute(
+        """
+        INSERT INTO usuarios (nombre, apellido, correo, contrasena, rol_id)
+        VALUES ('Prueba', 'Replica', 'replica-' || md5(random()::text) || '@prueba.test', 'x', 2)
+        RETURNING id
+        """
+    ).fetchone()[0]
+
+def _borrar(conn, usuario_id):
+    conn.execute("DELETE FROM sesiones WHERE usuario_id = %s", (usuario_id,))
+    conn.execute("DELETE FROM usuarios WHERE id = %s", (usuario_id,))
+
+def _snapshot(sesion_id, usuario_id, seq, t, kss=0):
+    return {
+        "sesion_id": sesion_id, "usuario_id": usuario_id, "actividad": "pdf", "sebr": t // 4,
+        "blink_rate_min": 15.0, "perclos": 12.5, "pct_incompletos": 10.0, "tiempo_cierre": 1.5,
+        "num_bostezos": 1, "velocidad_ocular": 0.05, "nivel_subjetivo": kss, "es_fatiga": kss >= 7,
+        "tiempo_total_seg": t, "max_sin_parpadeo": 6, "alertas": 0, "momentos_fatiga": [], "seq": seq,
+    }
+
+async def _probar(args, usuario_id):
+    import httpx
+    import backend
+
+    async def leer(cliente, ruta, cuerpo):
+        """Hace la lectura y devuelve (respuesta, (destino, motivo)) según la métrica de lecturas"""
+        antes = dict(backend.DB_LECTURAS.valores)
+        respuesta = await cliente.post(ruta, json=cuerpo)
+        cambios = [k for k, v in backend.DB_LECTURAS.valores.items() if v != antes.get(k, 0)]
+        return respuesta, cambios[0] if cambios else None
+
+    fallos = []
+
+    def comprobar(caso, obtenido, esperado):
+        estado = "OK" if obtenido == esperado else "FALLO"
+        print(f"{estado}: {caso}: {obtenido} (esperado {esperado})")
+        if obtenido != esperado:
+            fallos.append(caso)
+
+    await backend.startup()
+    try:
+        for _ in range(50):
+            if backend.app.state.replica_retraso <= backend.REPLICA_MAX_RETRASO_SEG:
+                break
+            await asyncio.sleep(0.1)
+        else:
+            print(f"FALLO: la réplica no responde o está atrasada ({backend.app.state.replica_retraso}s)")
+            return ["replica"]
+
+        transporte = httpx.ASGITransport(app=backend.app)
+        async with httpx.AsyncClient(transport=transporte, base_url="http://prueba") as cliente:
+            r = await cliente.post("/create-session", json={"usuario_id": usuario_id, "tipo_actividad": "pdf"})
+            sesion_id = r.json()["sesion_id"]
+            await cliente.post("/save-fatigue", json=_snapshot(sesion_id, usuario_id, 1, 60))
+            await cliente.post("/save-fatigue", json=_snapshot(sesion_id, usuario_id, 2, 120, kss=5))
+            await cliente.post(f"/end-session/{sesion_id}")
+
+            _, destino = await leer(cliente, "/get-session-details", {"sesion_id": sesion_id})
+            comprobar("detalle tras escribir", destino, ("primario", "escritura_reciente"))
+            _, destino = await leer(cliente, "/get-user-history", {"usuario_id": usuario_id})
+            comprobar("historial tras escribir", destino, ("primario", "escritura_reciente"))
+
+            await asyncio.sleep(backend.REPLICA_LECTURA_PROPIA_SEG + 0.5)
+            r, destino = await leer(cliente, "/get-session-details", {"sesion_id": sesion_id})
+            comprobar("detalle pasada la ventana", destino, ("replica", "al_dia"))
+            comprobar("muestras leídas de la réplica", len(r.json().get("muestras", [])), 2)
+            r, destino = await leer(cliente, "/get-user-history", {"usuario_id": usuario_id})
+            comprobar("historial pasada la ventana", destino, ("replica", "al_dia"))
+            comprobar("sesión en el historial de la réplica",
+                      [s["sesion_id"] for s in r.json().get("historial", [])], [sesion_id])
+
+            if args.pausar_replay:
+                with psycopg.connect(**DB_REPLICA_CONFIG, autocommit=True) as replica:
+                    replica.execute("SELECT pg_wal_replay_pause()")
+                    try:
+                        # Una escritura que la réplica recibe pero no aplica: el retraso crece
+                        await cliente.post("/create-session", json={"usuario_id": usuario_id, "tipo_actividad": "pdf"})
+                        await asyncio.sleep(backend.REPLICA_MAX_RETRASO_SEG + 2 * backend.REPLICA_CHEQUEO_SEG + 0.5)
+                        _, destino = await leer(cliente, "/get-session-details", {"sesion_id": sesion_id})
+                        comprobar("detalle con la réplica pausada", destino, ("primario", "retraso"))
+                    finally:
+                        replica.execute("SELECT pg_wal_replay_resume()")
+    finally:
+        await backend.shutdown()
+    return fallos
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lectura-propia-seg", type=float, default=1, help="ventana de lectura propia a probar")
+    parser.add_argument("--retraso-max-seg", type=float, default=2, help="retraso máximo tolerado de la réplica")
+    parser.add_argument("--pausar-replay", action="store_true",
+                        help="pausar el replay de la réplica (requiere superusuario) y comprobar el fallback")
+    args = parser.parse_args(argv)
+
+    if not DB_REPLICA_CONFIG:
+        sys.exit("Definir DB_REPLICA_HOST (y DB_REPLICA_PORT) con la réplica a probar")
+
+    # Antes de importar backend: la app lee su configuración al cargarse
+    os.environ.update({
+        "REPLICA_LECTURA_PROPIA_SEG": str(args.lectura_propia_seg),
+        "REPLICA_MAX_RETRASO_SEG": str(args.retraso_max_seg),
+        "REPLICA_CHEQUEO_SEG": "0.5",
+        "N8N_WEBHOOK_URL": "",
+    })
+
+    with psycopg.connect(**DB_CONFIG, autocommit=True) as conn:
+        usuario_id = _crear_usuario(conn)
+        try:
+            fallos = asyncio.run(_probar(args, usuario_id))
+        finally:
+            _borrar(conn, usuario_id)
+
+    if fallos:
+        sys.exit(1)
+    print("OK: lecturas ruteadas al pool esperado")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Prueba de chunks de señales crudas mal formados (senales.py).
+
+Arma un chunk válido con crear_chunk() y lo corrompe de distintas formas: cabecera
+corta, magic/versión/flags inválidos, columnas truncadas, nombre de columna no ascii,
+dtype desconocido y bytes sobrantes. Cada caso debe fallar con senales.FormatoInvalido
+(que /save-fatigue-raw responde con 400) y no con otra excepción (que sería un 500).
+No necesita la BD.
+
+Uso:
+    python prueba_senales.py
+Sale con código 1 si algún chunk mal formado no da FormatoInvalido.
+"""
+import argparse
+import sys
+
+import numpy as np
+
+import senales
+
+def _chunk_valido():
+    return senales.crear_chunk(
+        {"ts": np.arange(4, dtype=np.float32), "ear": np.full(4, 0.3, dtype=np.float16)},
+        comprimir=False,
+    )
+
+def _con_nombre(nombre_b):
+    """Chunk sin comprimir de una columna float32 con el nombre en bytes crudos"""
+    valores = np.zeros(2, dtype="<f4").tobytes()
+    cuerpo = bytes([len(nombre_b)]) + nombre_b + senales.COLUMNA.pack(2, len(valores)) + valores
+    return senales.CABECERA.pack(senales.MAGIC, senales.VERSION, 0, 1, 0, 2) + cuerpo
+
+def _casos():
+    valido = _chunk_valido()
+    cabecera = senales.CABECERA.size
+    ts = _con_nombre(b"ts")
+    dtype = cabecera + 1 + len(b"ts")  # byte del dtype de la primera columna
+    return {
+        "cabecera corta": valido[:cabecera - 1],
+        "magic inválido": b"XXXX" + valido[4:],
+        "versión no soportada": valido[:4] + bytes([senales.VERSION + 1]) + valido[5:],
+        "flags desconocidos": valido[:5] + bytes([0x80]) + valido[6:],
+        "columnas truncadas": valido[:cabecera + 3],
+        "nombre no ascii": _con_nombre("oído".encode("utf-8")),
+        "dtype desconocido": ts[:dtype] + bytes([9]) + ts[dtype + 1:],
+        "bytes sobrantes": valido + b"\x00",
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.parse_args(argv)
+
+    fallos = []
+    if senales.validar_y_comprimir(_chunk_valido())[1] != 4:
+        fallos.append("el chunk válido no se aceptó")
+    for caso, datos in _casos().items():
+        try:
+            senales.validar_y_comprimir(datos)
+        except senales.FormatoInvalido as e:
+            print(f"{caso}: FormatoInvalido ({e})")
+        except Exception as e:
+            fallos.append(f"{caso}: {type(e).__name__}: {e}")
+        else:
+            fallos.append(f"{caso}: se aceptó")
+
+    for fallo in fallos:
+        print(f"FALLO: {fallo}")
+    if fallos:
+        sys.exit(1)
+    print("OK: todos los chunks mal formados dan FormatoInvalido")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Prueba de un snapshot atrasado que llega a un proceso recién iniciado.
+
+Un worker (proceso) guarda el snapshot seq=2 de una sesión; después otro proceso nuevo,
+sin el high-water mark en memoria del primero, recibe el seq=1 de la misma sesión
+(p. ej. un reintento que tardó). Solo queda el guarda de la BD (sesion_resumen.ultimo_seq)
+y se comprueba que el snapshot atrasado no toca:
+  - muestras (no se inserta su t);
+  - sesiones.total_segundos / alertas / kss_final / es_fatiga;
+  - sesion_resumen.fecha_fin.
+Al terminar borra el usuario y la sesión creados.
+
+Uso:
+    python prueba_seq_atrasado.py
+Sale con código 1 si el snapshot atrasado modificó algo.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sys
+import time
+
+import psycopg
+
+from config_db import DB_CONFIG
+
+def _crear_sesion(conn):
+    usuario_id = conn.execute(
+        """
+        INSERT INTO usuarios (nombre, apellido, correo, contrasena, rol_id)
+        VALUES ('Prueba', 'SeqAtrasado', 'seq-atrasado-' || md5(random()::text) || '@prueba.test', 'x', 2)
+        RETURNING id
+        """
+    ).fetchone()[0]
+    sesion_id = conn.execute(
+        "INSERT INTO sesiones (usuario_id, tipo_actividad, fuente) VALUES (%s, 'pdf', 'prueba') RETURNING id",
+        (usuario_id,),
+    ).fetchone()[0]
+    return usuario_id, sesion_id
+
+def _borrar(conn, usuario_id):
+    conn.execute("DELETE FROM sesiones WHERE usuario_id = %s", (usuario_id,))
+    conn.execute("DELETE FROM usuarios WHERE id = %s", (usuario_id,))
+
+def _snapshot(sesion_id, usuario_id, seq, t, alertas, es_fatiga):
+    return {
+        "sesion_id": sesion_id, "usuario_id": usuario_id, "actividad": "pdf", "sebr": t // 4,
+        "blink_rate_min": 15.0, "perclos": 20.0 if es_fatiga else 5.0, "pct_incompletos": 10.0,
+        "tiempo_cierre": 1.5, "num_bostezos": 1, "velocidad_ocular": 0.05, "nivel_subjetivo": 0,
+        "es_fatiga": es_fatiga, "tiempo_total_seg": t, "max_sin_parpadeo": 6, "alertas": alertas,
+        "momentos_fatiga": [], "seq": seq,
+    }
+
+def _proceso(snapshot, resultado):
+    """Un 'worker' recién iniciado: app propia, sin seq en memoria; envía un snapshot"""
+    # Sin buffer ni cola: el snapshot se escribe dentro del request
+    os.environ.update({"SNAPSHOTS_FLUSH_SEG": "0", "N8N_WEBHOOK_URL": "", "VIVO_NOTIFY": "0"})
+    import httpx
+    import backend
+
+    async def enviar():
+        await backend.startup()
+        try:
+            transporte = httpx.ASGITransport(app=backend.app)
+            async with httpx.AsyncClient(transport=transporte, base_url="http://prueba") as cliente:
+                r = await cliente.post("/save-fatigue", json=snapshot)
+                return r.status_code
+        finally:
+            await backend.shutdown()
+
+    resultado.put(asyncio.run(enviar()))
+
+def _enviar_en_proceso_nuevo(snapshot):
+    contexto = multiprocessing.get_context("spawn")
+    resultado = contexto.Queue()
+    proceso = contexto.Process(target=_proceso, args=(snapshot, resultado))
+    proceso.start()
+    proceso.join()
+    return resultado.get() if proceso.exitcode == 0 else None
+
+def _estado(conn, sesion_id):
+    sesion = conn.execute(
+        "SELECT total_segundos, alertas, kss_final, es_fatiga FROM sesiones WHERE id = %s", (sesion_id,)
+    ).fetchone()
+    fecha_fin, = conn.execute("SELECT fecha_fin FROM sesion_resumen WHERE sesion_id = %s", (sesion_id,)).fetchone()
+    ts = [f[0] for f in conn.execute("SELECT t FROM muestras WHERE sesion_id = %s ORDER BY t", (sesion_id,))]
+    return {"sesiones": sesion, "fecha_fin": fecha_fin, "muestras": ts}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.parse_args(argv)
+
+    fallos = []
+    with psycopg.connect(**DB_CONFIG, autocommit=True) as conn:
+        usuario_id, sesion_id = _crear_sesion(conn)
+        try:
+            status = _enviar_en_proceso_nuevo(_snapshot(sesion_id, usuario_id, seq=2, t=120, alertas=3, es_fatiga=True))
+            if status != 200:
+                sys.exit(f"FALLO: el snapshot seq=2 no se guardó (status {status})")
+            antes = _estado(conn, sesion_id)
+            print(f"Después de seq=2: {antes}")
+
+            time.sleep(1.1)  # fecha_fin = NOW(): que un cambio indebido sea visible
+            status = _enviar_en_proceso_nuevo(_snapshot(sesion_id, usuario_id, seq=1, t=60, alertas=0, es_fatiga=False))
+            if status != 200:
+                fallos.append(f"el snapshot atrasado respondió {status}")
+            despues = _estado(conn, sesion_id)
+            print(f"Después de seq=1 (atrasado, proceso nuevo): {despues}")
+
+            for campo in ("sesiones", "fecha_fin", "muestras"):
+                if despues[campo] != antes[campo]:
+                    fallos.append(f"{campo}: {antes[campo]} -> {despues[campo]}")
+        finally:
+            _borrar(conn, usuario_id)
+
+    for fallo in fallos:
+        print(f"FALLO: {fallo}")
+    if fallos:
+        sys.exit(1)
+    print("OK: el snapshot atrasado no modificó la sesión")
+
+if __name__ == "__main__":
+    main()
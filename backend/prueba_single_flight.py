@@ -0,0 +1,143 @@
+"""
+Prueba de carga del single-flight de /get-or-create-diagnosis.
+
+Crea sesiones cerradas sin diagnóstico y lanza, desde varios procesos (cada uno con
+su propia app y su propio pool, como workers de uvicorn), muchas peticiones
+concurrentes por sesión. Cuenta cuántas veces se generó el diagnóstico: debe ser
+exactamente una por sesión. Al terminar borra las sesiones creadas.
+
+Uso:
+    python prueba_single_flight.py                            # 4 procesos, 10 sesiones, 25 peticiones
+    python prueba_single_flight.py --procesos 8 --sesiones 50 --concurrencia 100
+Sale con código 1 si alguna sesión se generó más de una vez o alguna petición falló.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sys
+import time
+from collections import Counter
+
+import psycopg
+
+from config_db import DB_CONFIG
+
+def _crear_sesiones(conn, n):
+    usuario_id = conn.execute(
+        """
+        INSERT INTO usuarios (nombre, apellido, correo, contrasena, rol_id)
+        VALUES ('Prueba', 'SingleFlight', 'single-flight-' || md5(random()::text) || '@prueba.test', 'x', 2)
+        RETURNING id
+        """
+    ).fetchone()[0]
+    filas = conn.execute(
+        """
+        WITH s AS (
+            INSERT INTO sesiones (usuario_id, tipo_actividad, fuente, fecha_inicio, fecha_fin, cerrada_en)
+            SELECT %s, 'pdf', 'prueba', NOW() - INTERVAL '10 minutes', NOW(), NOW()
+            FROM generate_series(1, %s)
+            RETURNING id, usuario_id, tipo_actividad, fecha_inicio, fecha_fin, cerrada_en
+        )
+        INSERT INTO sesion_resumen (
+            sesion_id, usuario_id, tipo_actividad, fecha_inicio, fecha_fin, cerrada_en, t, perclos, parpadeos,
+            pct_incompletos, tiempo_cierre, num_bostezos, velocidad_ocular, nivel_subjetivo, alertas, es_fatiga
+        )
+        SELECT id, usuario_id, tipo_actividad, fecha_inicio, fecha_fin, cerrada_en, 600, 30, 4, 25, 0.5, 2, 0.01, 8, 3, true
+        FROM s
+        RETURNING sesion_id
+        """,
+        (usuario_id, n),
+    ).fetchall()
+    return usuario_id, [f[0] for f in filas]
+
+def _borrar(conn, usuario_id):
+    conn.execute("DELETE FROM sesiones WHERE usuario_id = %s", (usuario_id,))
+    conn.execute("DELETE FROM usuarios WHERE id = %s", (usuario_id,))
+
+def _proceso(sesion_ids, concurrencia, barrera, resultados):
+    """Un 'worker': app propia con su pool; dispara las peticiones al pasar la barrera"""
+    os.environ["N8N_WEBHOOK_URL"] = ""  # sin cola: el diagnóstico se genera en el request
+    import httpx
+    import backend
+
+    # Cada generación termina en exactamente un _guardar_diagnostico
+    generados = Counter()
+    guardar = backend._guardar_diagnostico
+
+    async def guardar_y_contar(cur, sesion_id, *args):
+        generados[sesion_id] += 1
+        await guardar(cur, sesion_id, *args)
+
+    backend._guardar_diagnostico = guardar_y_contar
+
+    async def correr():
+        await backend.startup()
+        try:
+            transporte = httpx.ASGITransport(app=backend.app)
+            async with httpx.AsyncClient(transport=transporte, base_url="http://prueba") as cliente:
+                barrera.wait()
+                respuestas = await asyncio.gather(*(
+                    cliente.post("/get-or-create-diagnosis", json={"sesion_id": sid})
+                    for _ in range(concurrencia) for sid in sesion_ids
+                ))
+        finally:
+            await backend.shutdown()
+        return Counter(r.status_code for r in respuestas)
+
+    estados = asyncio.run(correr())
+    resultados.put((dict(generados), dict(estados)))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--procesos", type=int, default=4, help="procesos (workers) simultáneos")
+    parser.add_argument("--sesiones", type=int, default=10, help="sesiones a diagnosticar")
+    parser.add_argument("--concurrencia", type=int, default=25, help="peticiones por sesión en cada proceso")
+    args = parser.parse_args(argv)
+
+    with psycopg.connect(**DB_CONFIG, autocommit=True) as conn:
+        usuario_id, sesion_ids = _crear_sesiones(conn, args.sesiones)
+        try:
+            contexto = multiprocessing.get_context("spawn")
+            barrera = contexto.Barrier(args.procesos)
+            resultados = contexto.Queue()
+            procesos = [
+                contexto.Process(target=_proceso, args=(sesion_ids, args.concurrencia, barrera, resultados))
+                for _ in range(args.procesos)
+            ]
+            inicio = time.perf_counter()
+            for p in procesos:
+                p.start()
+            generados, estados = Counter(), Counter()
+            for _ in procesos:
+                g, e = resultados.get()
+                generados.update(g)
+                estados.update(e)
+            for p in procesos:
+                p.join()
+            duracion = time.perf_counter() - inicio
+        finally:
+            _borrar(conn, usuario_id)
+
+    peticiones = args.procesos * args.sesiones * args.concurrencia
+    repetidas = {sid: n for sid, n in generados.items() if n > 1}
+    sin_generar = [sid for sid in sesion_ids if sid not in generados]
+    print(f"{peticiones} peticiones en {duracion:.2f}s; estados: {dict(estados)}")
+    print(f"Generaciones: {sum(generados.values())} para {len(sesion_ids)} sesiones")
+
+    fallo = False
+    if repetidas:
+        print(f"FALLO: sesiones generadas más de una vez: {repetidas}")
+        fallo = True
+    if sin_generar:
+        print(f"FALLO: sesiones sin diagnóstico: {sin_generar}")
+        fallo = True
+    if set(estados) != {200}:
+        print("FALLO: hubo respuestas distintas de 200")
+        fallo = True
+    if fallo:
+        sys.exit(1)
+    print("OK: una generación por sesión")
+
+if __name__ == "__main__":
+    main()
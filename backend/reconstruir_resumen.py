@@ -0,0 +1,128 @@
+"""
+Reconstruye la proyección sesion_resumen desde las tablas fuente
+(sesiones, muestras, alertas, diagnosticos_ia) y, a partir de ella, el acumulado
+por usuario usuario_resumen.
+
+Uso:
+    python reconstruir_resumen.py                 # todas las sesiones, por lotes de id
+    python reconstruir_resumen.py --sesion 42     # una sola sesión
+    python reconstruir_resumen.py --lote 2000
+
+Cada lote es una transacción corta, así que puede correr con el backend activo.
+Las sesiones sin muestras (migradas desde mediciones) conservan sus métricas.
+"""
+import argparse
+import sys
+import time
+
+import psycopg
+
+from config_db import DB_CONFIG
+
+METRICAS = (
+    "t", "perclos", "parpadeos", "blink_rate_min", "pct_incompletos", "tiempo_cierre",
+    "num_bostezos", "velocidad_ocular", "max_sin_parpadeo", "alertas", "nivel_subjetivo", "es_fatiga",
+)
+
+RECONSTRUIR_SQL = f"""
+    INSERT INTO sesion_resumen AS r (
+        sesion_id, usuario_id, tipo_actividad, fecha_inicio, fecha_fin, cerrada_en,
+        {", ".join(METRICAS)}, ultimo_momento_t, momentos, diagnostico_json, actualizado_en
+    )
+    SELECT
+        s.id, s.usuario_id, s.tipo_actividad, s.fecha_inicio, s.fecha_fin, s.cerrada_en,
+        {", ".join("m." + c for c in METRICAS)},
+        a.ultimo_momento_t, COALESCE(a.momentos, '[]'::jsonb), d.diagnostico_json, NOW()
+    FROM sesiones s
+    LEFT JOIN LATERAL (
+        -- muestra más reciente, cruda o (si su partición fue retenida) del último minuto
+        SELECT {", ".join(METRICAS)} FROM muestras WHERE sesion_id = s.id AND sesion_inicio = s.fecha_inicio
+        UNION ALL
+        SELECT {", ".join(METRICAS)} FROM muestras_minuto WHERE sesion_id = s.id
+        ORDER BY t DESC LIMIT 1
+    ) m ON true
+    LEFT JOIN LATERAL (
+        SELECT MAX(momento_seg) AS ultimo_momento_t,
+               jsonb_agg(jsonb_build_object('t', momento_seg, 'reason', motivo) ORDER BY momento_seg) AS momentos
+        FROM alertas WHERE sesion_id = s.id
+    ) a ON true
+    LEFT JOIN diagnosticos_ia d ON d.sesion_id = s.id
+    WHERE s.id BETWEEN %s AND %s
+    ON CONFLICT (sesion_id) DO UPDATE SET
+        usuario_id = EXCLUDED.usuario_id,
+        tipo_actividad = EXCLUDED.tipo_actividad,
+        fecha_inicio = EXCLUDED.fecha_inicio,
+        fecha_fin = EXCLUDED.fecha_fin,
+        cerrada_en = EXCLUDED.cerrada_en,{",".join(f'''
+        {c} = CASE WHEN EXCLUDED.t IS NULL THEN r.{c} ELSE EXCLUDED.{c} END''' for c in METRICAS)},
+        ultimo_momento_t = COALESCE(EXCLUDED.ultimo_momento_t, r.ultimo_momento_t),
+        momentos = EXCLUDED.momentos,
+        diagnostico_json = EXCLUDED.diagnostico_json,
+        actualizado_en = NOW()
+"""
+
+# Recalcula el acumulado desde cero: fija el aporte de cada sesión cerrada y suma por usuario
+RECONSTRUIR_USUARIOS_SQL = """
+    WITH aportes AS (
+        UPDATE sesion_resumen
+        SET rollup_segundos = COALESCE(t, 0),
+            rollup_alertas = COALESCE(alertas, 0),
+            rollup_perclos = perclos
+        WHERE cerrada_en IS NOT NULL AND usuario_id IS NOT NULL
+          AND (%(usuario_id)s::integer IS NULL OR usuario_id = %(usuario_id)s::integer)
+        RETURNING usuario_id, rollup_segundos, rollup_alertas, rollup_perclos
+    )
+    INSERT INTO usuario_resumen AS u (
+        usuario_id, sesiones, segundos_total, alertas_total, perclos_suma, perclos_n, actualizado_en
+    )
+    SELECT usuario_id, COUNT(*), SUM(rollup_segundos), SUM(rollup_alertas),
+           COALESCE(SUM(rollup_perclos), 0), COUNT(rollup_perclos), NOW()
+    FROM aportes
+    GROUP BY usuario_id
+    ON CONFLICT (usuario_id) DO UPDATE SET
+        sesiones = EXCLUDED.sesiones,
+        segundos_total = EXCLUDED.segundos_total,
+        alertas_total = EXCLUDED.alertas_total,
+        perclos_suma = EXCLUDED.perclos_suma,
+        perclos_n = EXCLUDED.perclos_n,
+        actualizado_en = NOW()
+"""
+
+def reconstruir(conn, desde, hasta):
+    """Reconstruye las sesiones con id en [desde, hasta]. Devuelve las filas escritas."""
+    with conn.transaction():
+        return conn.execute(RECONSTRUIR_SQL, (desde, hasta)).rowcount
+
+def reconstruir_usuarios(conn, usuario_id=None):
+    """Recalcula usuario_resumen (de un usuario o de todos). Devuelve los usuarios escritos."""
+    with conn.transaction():
+        return conn.execute(RECONSTRUIR_USUARIOS_SQL, {"usuario_id": usuario_id}).rowcount
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sesion", type=int, help="reconstruir solo esta sesión")
+    parser.add_argument("--lote", type=int, default=5000, help="sesiones por transacción")
+    args = parser.parse_args(argv)
+
+    inicio = time.perf_counter()
+    total = 0
+    with psycopg.connect(**DB_CONFIG, autocommit=True) as conn:
+        if args.sesion is not None:
+            total = reconstruir(conn, args.sesion, args.sesion)
+            fila = conn.execute("SELECT usuario_id FROM sesiones WHERE id = %s", (args.sesion,)).fetchone()
+            if fila and fila[0] is not None:
+                reconstruir_usuarios(conn, fila[0])
+        else:
+            minimo, maximo = conn.execute("SELECT MIN(id), MAX(id) FROM sesiones").fetchone()
+            if minimo is not None:
+                for desde in range(minimo, maximo + 1, args.lote):
+                    total += reconstruir(conn, desde, desde + args.lote - 1)
+                    print(f"  ... hasta sesión {min(desde + args.lote - 1, maximo)}: {total} filas", file=sys.stderr)
+            usuarios = reconstruir_usuarios(conn)
+            print(f"{usuarios} usuarios acumulados", file=sys.stderr)
+
+    duracion = time.perf_counter() - inicio
+    print(f"{total} sesiones reconstruidas en {duracion:.2f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+"""
+Re-diagnóstico masivo con las reglas de umbrales actuales (reglas_fatiga).
+
+Recorre con un cursor del lado del servidor las sesiones con mediciones que no
+tienen diagnóstico o cuyo diagnóstico local se generó con una versión de reglas
+anterior, las puntúa por lotes con NumPy y guarda cada lote con un upsert
+multi-fila (diagnosticos_ia y la copia en sesion_resumen). Los diagnósticos de
+N8N (reglas_version NULL) no se tocan, salvo con --incluir-sin-version.
+
+Uso:
+    python rediagnosticar.py                        # pendientes de la versión actual
+    python rediagnosticar.py --lote 5000
+    python rediagnosticar.py --incluir-sin-version  # también los anteriores a 0004
+    python rediagnosticar.py --simular              # solo puntúa, no escribe
+
+Cada lote se confirma por separado, así que puede correr con el backend activo
+(la caché de respuestas de cada worker vence a los CACHE_TTL_SEG).
+"""
+import argparse
+import json
+import sys
+import time
+
+import numpy as np
+import psycopg
+
+import reglas_fatiga
+from config_db import DB_CONFIG
+
+SELECCION_SQL = """
+    SELECT r.sesion_id, r.perclos, r.parpadeos AS sebr, r.blink_rate_min, r.pct_incompletos,
+           r.tiempo_cierre, r.num_bostezos, r.velocidad_ocular, r.max_sin_parpadeo,
+           r.nivel_subjetivo, r.alertas
+    FROM sesion_resumen r
+    LEFT JOIN diagnosticos_ia d ON d.sesion_id = r.sesion_id
+    WHERE r.t IS NOT NULL
+      AND (d.sesion_id IS NULL
+           OR d.reglas_version < %(version)s
+           OR (%(incluir_sin_version)s AND d.reglas_version IS NULL))
+"""
+
+# Mismo par de escrituras que _guardar_diagnostico en backend.py, para todo el lote.
+# El WHERE del ON CONFLICT repite el filtro: si mientras tanto llegó un diagnóstico
+# de N8N o uno ya actualizado, no se pisa.
+GUARDAR_SQL = """
+    WITH d AS (
+        INSERT INTO diagnosticos_ia AS d (sesion_id, diagnostico_json, reglas_version)
+        SELECT v.sesion_id, v.diagnostico::jsonb, %(version)s
+        FROM unnest(%(ids)s::integer[], %(diagnosticos)s::text[]) AS v(sesion_id, diagnostico)
+        ON CONFLICT (sesion_id) DO UPDATE SET
+            diagnostico_json = EXCLUDED.diagnostico_json,
+            reglas_version = EXCLUDED.reglas_version
+        WHERE d.reglas_version < EXCLUDED.reglas_version
+           OR (%(incluir_sin_version)s AND d.reglas_version IS NULL)
+        RETURNING sesion_id, diagnostico_json
+    )
+    UPDATE sesion_resumen r SET diagnostico_json = d.diagnostico_json FROM d WHERE r.sesion_id = d.sesion_id
+"""
+
+def puntuar_filas(reglas, nombres, filas):
+    """filas: tuplas con las columnas `nombres` (la primera, sesion_id) -> (ids, scores)"""
+    columnas = dict(zip(nombres, zip(*filas)))
+    ids = list(columnas["sesion_id"])
+    # None -> NaN al convertir a float; el puntaje compilado los cuenta como 0
+    datos = {campo: np.array(columnas[campo], dtype=np.float64) for campo in reglas.puntaje_diagnostico.campos}
+    return ids, reglas.puntaje_diagnostico.lote(datos)
+
+def diagnosticos_json(reglas, scores):
+    """JSON de cada score; hay pocos scores distintos, así que se serializa uno por valor"""
+    por_score = {
+        int(s): json.dumps(reglas.diagnostico(int(s)), ensure_ascii=False)
+        for s in np.unique(scores)
+    }
+    return [por_score[int(s)] for s in scores]
+
+def rediagnosticar(lectura, escritura, lote=2000, incluir_sin_version=False, simular=False, salida=sys.stderr):
+    """Devuelve (versión de reglas, sesiones puntuadas, filas escritas)"""
+    reglas = reglas_fatiga.cargar()
+    version = reglas.version
+    parametros = {"version": version, "incluir_sin_version": incluir_sin_version}
+    puntuadas = escritas = 0
+    with lectura.transaction():
+        # Cursor con nombre: el servidor entrega las filas de a `lote`, sin cargar todo en memoria
+        with lectura.cursor(name="rediagnostico") as cur:
+            cur.itersize = lote
+            cur.execute(SELECCION_SQL, parametros)
+            while filas := cur.fetchmany(lote):
+                nombres = [c.name for c in cur.description]
+                ids, scores = puntuar_filas(reglas, nombres, filas)
+                puntuadas += len(ids)
+                if not simular:
+                    with escritura.transaction():
+                        escritas += escritura.execute(
+                            GUARDAR_SQL,
+                            {**parametros, "ids": ids, "diagnosticos": diagnosticos_json(reglas, scores)},
+                        ).rowcount
+                print(f"  ... {puntuadas} sesiones puntuadas", file=salida)
+    return version, puntuadas, escritas
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lote", type=int, default=2000, help="sesiones por lote (fetch y transacción)")
+    parser.add_argument("--incluir-sin-version", action="store_true",
+                        help="recalcular también los diagnósticos sin versión (N8N o anteriores a 0004)")
+    parser.add_argument("--simular", action="store_true", help="puntuar sin escribir")
+    args = parser.parse_args(argv)
+
+    inicio = time.perf_counter()
+    with psycopg.connect(**DB_CONFIG) as lectura, psycopg.connect(**DB_CONFIG, autocommit=True) as escritura:
+        version, puntuadas, escritas = rediagnosticar(
+            lectura, escritura, args.lote, args.incluir_sin_version, args.simular
+        )
+    duracion = time.perf_counter() - inicio
+    tasa = puntuadas / duracion if duracion > 0 else 0.0
+    print(
+        f"Reglas v{version}: {puntuadas} sesiones puntuadas, "
+        f"{escritas} escritas en {duracion:.2f}s ({tasa:.0f} sesiones/s)"
+    )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Reglas de fatiga versionadas, compartidas por todos los caminos de puntuación.
+
+La definición declarativa vive en reglas_fatiga.json (o en REGLAS_FATIGA_PATH):
+  - nivel_fatiga: puntaje en tiempo real (monitoreo.js, motor_fatiga.py) con los
+    umbrales de alerta y de fatiga severa;
+  - es_fatiga: condiciones de las que basta una para marcar la sesión con fatiga;
+  - diagnostico: puntaje, escala de severidad y recomendaciones del diagnóstico
+    local (/get-or-create-diagnosis, rediagnosticar.py).
+
+Cada puntaje se compila una sola vez a una expresión de Python que sirve igual
+para un registro (escalares) que para columnas NumPy de muchas sesiones o frames.
+El backend sirve la definición en /reglas-fatiga para que el navegador use las
+mismas reglas. Al cambiar un umbral hay que subir "version": los diagnósticos
+guardados con una versión anterior se recalculan con rediagnosticar.py.
+"""
+import json
+import keyword
+import logging
+import os
+import re
+import time
+
+import numpy as np
+
+RUTA_REGLAS = os.getenv(
+    "REGLAS_FATIGA_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "reglas_fatiga.json")
+)
+RECARGA_SEG = 5.0  # cada cuánto actuales() revisa si el archivo cambió
+
+OPERADORES = {">=", "<=", ">", "<", "==", "!="}
+
+log = logging.getLogger("securityeye")
+
+class ReglasInvalidas(ValueError):
+    pass
+
+def _numero(valor, donde):
+    if isinstance(valor, bool) or not isinstance(valor, (int, float)):
+        raise ReglasInvalidas(f"{donde}: se esperaba un número, no {valor!r}")
+    return valor
+
+def _condicion(definicion, campos):
+    """Fuente de Python de una comparación; registra el campo usado"""
+    campo, op = definicion.get("campo"), definicion.get("op")
+    if not isinstance(campo, str) or not re.fullmatch(r"[a-z_][a-z0-9_]*", campo) or keyword.iskeyword(campo):
+        raise ReglasInvalidas(f"Campo inválido: {campo!r}")
+    if op not in OPERADORES:
+        raise ReglasInvalidas(f"Operador inválido en {campo}: {op!r}")
+    campos.add(campo)
+    return f"({campo} {op} {_numero(definicion.get('umbral'), campo)!r})"
+
+class Puntaje:
+    """Expresión compilada sobre campos numéricos; un campo nulo (None/NaN) cuenta como 0"""
+
+    def __init__(self, fuente, campos):
+        self.campos = tuple(sorted(campos))
+        self.fuente = fuente
+        self._funcion = eval(compile(f"lambda {', '.join(self.campos)}: {fuente}", "<reglas_fatiga>", "eval"))
+
+    @classmethod
+    def suma(cls, reglas):
+        """Suma de puntos de las reglas que se cumplen (cada regla puede exigir condiciones 'y')"""
+        campos, terminos = set(), []
+        for regla in reglas:
+            condiciones = [_condicion(regla, campos)] + [_condicion(c, campos) for c in regla.get("y", [])]
+            puntos = _numero(regla.get("puntos"), regla.get("campo"))
+            terminos.append(f"{puntos!r} * ({' & '.join(condiciones)})")
+        return cls(" + ".join(["0"] + terminos), campos)
+
+    @classmethod
+    def cualquiera(cls, condiciones):
+        campos = set()
+        partes = [_condicion(c, campos) for c in condiciones]
+        return cls(" | ".join(partes) if partes else "False", campos)
+
+    def __call__(self, registro):
+        return self._funcion(**{c: float(registro.get(c) or 0) for c in self.campos})
+
+    def lote(self, columnas):
+        """columnas: {campo: array}; devuelve un array con el resultado de cada fila"""
+        valores = {
+            c: np.nan_to_num(np.asarray(columnas[c], dtype=np.float64), nan=0.0) for c in self.campos
+        }
+        n = len(next(iter(columnas.values())))
+        return np.broadcast_to(self._funcion(**valores), (n,)) if valores else np.full(n, self._funcion())
+
+class Reglas:
+    def __init__(self, definicion):
+        try:
+            self.version = int(definicion["version"])
+            nivel = definicion["nivel_fatiga"]
+            self.nivel_fatiga = Puntaje.suma(nivel["reglas"])
+            self.umbral_alerta = _numero(nivel["alerta"], "nivel_fatiga.alerta")
+            self.umbral_severa = _numero(nivel["severa"], "nivel_fatiga.severa")
+            self.es_fatiga = Puntaje.cualquiera(definicion["es_fatiga"]["cualquiera"])
+            diagnostico = definicion["diagnostico"]
+            self.puntaje_diagnostico = Puntaje.suma(diagnostico["reglas"])
+            self.umbral_diagnostico_fatiga = _numero(diagnostico["fatiga"], "diagnostico.fatiga")
+            self.severidades = sorted(
+                ((_numero(s["desde"], "severidades.desde"), str(s["nivel"])) for s in diagnostico["severidades"]),
+                reverse=True,
+            )
+            self.recomendaciones = [str(r) for r in diagnostico.get("recomendaciones", [])]
+        except (KeyError, TypeError) as e:
+            raise ReglasInvalidas(f"Definición de reglas incompleta: {e!r}") from e
+        if not self.severidades or self.severidades[-1][0] > 0:
+            raise ReglasInvalidas("La escala de severidades debe empezar en 0")
+        self.definicion = definicion
+
+    def severidad(self, score):
+        return next(nombre for desde, nombre in self.severidades if score >= desde)
+
+    def diagnostico(self, score):
+        return {
+            "diagnostico_general": "Fatiga detectada" if score >= self.umbral_diagnostico_fatiga else "Estado normal",
+            "severidad_fatiga_final": self.severidad(score),
+            "recomendaciones_generales": list(self.recomendaciones),
+            "reglas_version": self.version,
+        }
+
+def cargar(ruta=RUTA_REGLAS):
+    with open(ruta, encoding="utf-8") as f:
+        return Reglas(json.load(f))
+
+_actuales = {"reglas": None, "mtime": None, "revisado": 0.0}
+
+def actuales(ruta=RUTA_REGLAS):
+    """
+    Reglas compiladas vigentes. Si el archivo cambió se recompila (a lo sumo una
+    revisión cada RECARGA_SEG); si la nueva definición es inválida se conservan las anteriores.
+    """
+    ahora = time.monotonic()
+    if _actuales["reglas"] is not None and ahora - _actuales["revisado"] < RECARGA_SEG:
+        return _actuales["reglas"]
+    _actuales["revisado"] = ahora
+    try:
+        mtime = os.stat(ruta).st_mtime
+        if mtime == _actuales["mtime"]:
+            return _actuales["reglas"]
+        _actuales["mtime"] = mtime
+        _actuales["reglas"] = cargar(ruta)
+        log.info(f"Reglas de fatiga v{_actuales['reglas'].version} cargadas desde {ruta}")
+    except (OSError, ValueError) as e:
+        # Archivo ausente o ilegible (p. ej. a mitad de un despliegue) o definición inválida
+        if _actuales["reglas"] is None:
+            raise
+        log.error(f"Reglas de fatiga inválidas en {ruta}, se mantienen las anteriores: {e}")
+    return _actuales["reglas"]
@@ -0,0 +1,33 @@
+"""
+Mantenimiento de las particiones mensuales de muestras (para cron; el backend
+hace lo mismo cada MANTENIMIENTO_SEG).
+
+Uso:
+    python retencion_muestras.py                     # solo crea particiones adelantadas
+    python retencion_muestras.py --retener-meses 6   # además agrega por minuto y elimina
+                                                     # las particiones de meses completos
+                                                     # con más de 6 meses
+"""
+import argparse
+
+import psycopg
+
+from config_db import DB_CONFIG
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--meses-adelante", type=int, default=2, help="particiones futuras a crear")
+    parser.add_argument("--retener-meses", type=int, default=0, help="edad de retención en meses (0 = no retener)")
+    args = parser.parse_args(argv)
+
+    with psycopg.connect(**DB_CONFIG) as conn:
+        conn.execute("SELECT crear_particiones_muestras(%s)", (args.meses_adelante,))
+        retenidas = 0
+        if args.retener_meses > 0:
+            retenidas = conn.execute(
+                "SELECT retener_muestras(make_interval(months => %s))", (args.retener_meses,)
+            ).fetchone()[0]
+    print(f"Particiones aseguradas ({args.meses_adelante} meses adelante); retenidas: {retenidas}")
+
+if __name__ == "__main__":
+    main()
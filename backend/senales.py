@@ -0,0 +1,135 @@
+"""
+Formato binario compacto para las señales crudas por frame (EAR, MAR, iris, ...).
+
+Un chunk es una cabecera fija de 12 bytes seguida del bloque de columnas, que puede
+ir comprimido con zlib (el navegador lo genera con CompressionStream('deflate')):
+
+    cabecera  <4s B B B B I   magic b"SEYE", versión, flags, n_columnas, reservado, n_frames
+    columna   <B {n}s B I     largo del nombre, nombre ascii, dtype, n_bytes, datos (LE)
+
+dtype: 1 = float16, 2 = float32. En el camino caliente el backend solo lee la
+cabecera y el índice de columnas (nunca decodifica valores) y guarda el chunk
+comprimido tal cual en senales_crudas. Para análisis, leer_chunk() devuelve vistas
+NumPy sobre el buffer descomprimido, sin copiar los datos.
+"""
+import struct
+import zlib
+
+import numpy as np
+
+MAGIC = b"SEYE"
+VERSION = 1
+FLAG_ZLIB = 0x01
+
+CABECERA = struct.Struct("<4sBBBBI")
+COLUMNA = struct.Struct("<BI")  # dtype, n_bytes (después del nombre)
+
+DTYPES = {1: np.dtype("<f2"), 2: np.dtype("<f4")}
+CODIGOS_DTYPE = {dt: codigo for codigo, dt in DTYPES.items()}
+
+COLUMNAS_MOTOR = ("ts", "ear", "mar", "iris_x", "iris_y")
+
+class FormatoInvalido(ValueError):
+    pass
+
+def leer_cabecera(datos):
+    """Valida la cabecera y devuelve (n_columnas, n_frames, comprimido)"""
+    if len(datos) < CABECERA.size:
+        raise FormatoInvalido("Chunk demasiado corto")
+    magic, version, flags, n_columnas, _, n_frames = CABECERA.unpack_from(datos)
+    if magic != MAGIC:
+        raise FormatoInvalido("Magic inválido")
+    if version != VERSION:
+        raise FormatoInvalido(f"Versión no soportada: {version}")
+    if flags & ~FLAG_ZLIB:
+        raise FormatoInvalido(f"Flags desconocidos: {flags}")
+    return n_columnas, n_frames, bool(flags & FLAG_ZLIB)
+
+def _indice_columnas(cuerpo, n_columnas, n_frames):
+    """Recorre las cabeceras de columna sin tocar los valores: [(nombre, dtype, offset)]"""
+    vista = memoryview(cuerpo)
+    pos = 0
+    columnas = []
+    for _ in range(n_columnas):
+        if pos >= len(vista):
+            raise FormatoInvalido("Columnas truncadas")
+        largo_nombre = vista[pos]
+        pos += 1
+        try:
+            nombre = bytes(vista[pos:pos + largo_nombre]).decode("ascii")
+        except UnicodeDecodeError:
+            raise FormatoInvalido("Nombre de columna no ascii") from None
+        pos += largo_nombre
+        if pos + COLUMNA.size > len(vista):
+            raise FormatoInvalido("Columnas truncadas")
+        codigo, n_bytes = COLUMNA.unpack_from(vista, pos)
+        pos += COLUMNA.size
+        dtype = DTYPES.get(codigo)
+        if dtype is None:
+            raise FormatoInvalido(f"dtype desconocido en columna {nombre}: {codigo}")
+        if n_bytes != n_frames * dtype.itemsize or pos + n_bytes > len(vista):
+            raise FormatoInvalido(f"Largo inválido en columna {nombre}")
+        columnas.append((nombre, dtype, pos))
+        pos += n_bytes
+    if pos != len(vista):
+        raise FormatoInvalido("Bytes sobrantes al final del chunk")
+    return columnas
+
+def validar_y_comprimir(datos, nivel=1):
+    """
+    Valida un chunk recibido y lo devuelve listo para guardar (comprimido) junto con n_frames.
+    Si ya viene comprimido solo se valida la cabecera: descomprimir para validar
+    costaría más que el propio guardado y leer_chunk() lo detecta al analizar.
+    """
+    n_columnas, n_frames, comprimido = leer_cabecera(datos)
+    if comprimido:
+        return bytes(datos), n_frames
+    cuerpo = memoryview(datos)[CABECERA.size:]
+    _indice_columnas(cuerpo, n_columnas, n_frames)
+    cabecera = CABECERA.pack(MAGIC, VERSION, FLAG_ZLIB, n_columnas, 0, n_frames)
+    return cabecera + zlib.compress(cuerpo, nivel), n_frames
+
+def leer_chunk(datos):
+    """Decodifica un chunk a {columna: np.ndarray}; los arrays son vistas del buffer (sin copia)"""
+    n_columnas, n_frames, comprimido = leer_cabecera(datos)
+    cuerpo = zlib.decompress(memoryview(datos)[CABECERA.size:]) if comprimido else memoryview(datos)[CABECERA.size:]
+    return {
+        nombre: np.frombuffer(cuerpo, dtype=dtype, count=n_frames, offset=offset)
+        for nombre, dtype, offset in _indice_columnas(cuerpo, n_columnas, n_frames)
+    }
+
+def unir_chunks(chunks):
+    """Concatena los chunks (en orden de seq) de una sesión en un array por columna"""
+    decodificados = [leer_chunk(c) for c in chunks]
+    if not decodificados:
+        return {}
+    return {
+        nombre: np.concatenate([d[nombre] for d in decodificados])
+        for nombre in decodificados[0]
+    }
+
+def crear_chunk(columnas, comprimir=True, nivel=1):
+    """Arma un chunk a partir de {nombre: array float16/float32} (útil para clientes y pruebas)"""
+    arrays = {nombre: np.ascontiguousarray(valores) for nombre, valores in columnas.items()}
+    n_frames = len(next(iter(arrays.values()))) if arrays else 0
+    partes = []
+    for nombre, valores in arrays.items():
+        dtype = valores.dtype.newbyteorder("<")
+        codigo = CODIGOS_DTYPE.get(dtype)
+        if codigo is None or len(valores) != n_frames:
+            raise FormatoInvalido(f"Columna {nombre} inválida")
+        nombre_b = nombre.encode("ascii")
+        partes += [bytes([len(nombre_b)]), nombre_b, COLUMNA.pack(codigo, valores.nbytes), valores.astype(dtype, copy=False).tobytes()]
+    cuerpo = b"".join(partes)
+    flags = FLAG_ZLIB if comprimir else 0
+    if comprimir:
+        cuerpo = zlib.compress(cuerpo, nivel)
+    return CABECERA.pack(MAGIC, VERSION, flags, len(arrays), 0, n_frames) + cuerpo
+
+def leer_senales_sesion(conn, sesion_id):
+    """Lee y une todos los chunks de una sesión con una conexión psycopg síncrona"""
+    filas = conn.execute(
+        "SELECT datos FROM senales_crudas WHERE sesion_id = %s ORDER BY seq",
+        (sesion_id,),
+    ).fetchall()
+    return unir_chunks([fila[0] for fila in filas])
@@ -0,0 +1,227 @@
+"""
+Regresión de planes de las consultas calientes.
+
+Crea una base temporal (<DB_NAME>_planes), aplica SQL/migrations, carga un dataset
+sintético y corre cada consulta de los endpoints con EXPLAIN (ANALYZE, FORMAT JSON).
+Una consulta falla si:
+  - hace Seq Scan sobre alguna de las tablas grandes, o
+  - lee más filas que su presupuesto (filas devueltas + descartadas por filtro, por loop).
+
+Uso:
+    python verificar_planes.py                  # 20000 sesiones, 200 usuarios
+    python verificar_planes.py --sesiones 100000 --mantener
+Sale con código 1 si alguna consulta falla. Las consultas se importan de backend.py
+(constantes CONSULTA_*), así que se necesitan sus dependencias instaladas.
+"""
+import argparse
+import sys
+import time
+from datetime import timedelta
+
+import psycopg
+from psycopg import sql
+
+import backend
+import migrate
+import reconstruir_resumen
+from config_db import DB_CONFIG
+
+TABLAS_GRANDES = {
+    "sesiones", "alertas", "sesion_resumen", "usuarios", "diagnosticos_ia", "diagnosticos_cola", "muestras_minuto",
+}
+
+def _es_grande(relacion):
+    # Las particiones mensuales se llaman muestras_AAAAMM (más muestras_default)
+    return relacion in TABLAS_GRANDES or relacion.startswith("muestras_2") or relacion in ("muestras", "muestras_default")
+
+def _consultas(p):
+    """nombre -> (consulta, parámetros, presupuesto de filas leídas), con el SQL de backend.py"""
+    admin = lambda where: backend.CONSULTA_ADMIN_SESIONES.format(where=where)
+    cerradas, _ = backend._filtros_sesiones(None, None, None, None, None, None)
+    por_fecha, params_fecha = backend._filtros_sesiones(p["desde"], p["hasta"], None, None, None, None)
+    por_estudiante, params_estudiante = backend._filtros_sesiones(None, None, None, p["estudiante"], None, None)
+    cursor = (p["cursor_fecha"], p["cursor_id"])
+    return {
+        "sesiones/{id}": (backend.CONSULTA_DETALLE_SESION, (p["sesion_id"],), 1),
+        "save-fatigue: sesión abierta del usuario": (backend.CONSULTA_SESION_ABIERTA, (p["usuario_id"],), 1),
+        "get-user-history: acumulado": (backend.CONSULTA_ACUMULADO_USUARIO, (p["usuario_id"],), 1),
+        "get-user-history: primera página": (
+            backend.CONSULTA_HISTORIAL.format(filtro_cursor=""), (p["usuario_id"], 21), 21),
+        "get-user-history: página con cursor": (
+            backend.CONSULTA_HISTORIAL.format(filtro_cursor="AND " + backend.FILTRO_CURSOR),
+            (p["usuario_id"], *cursor, 21), 21),
+        "admin/all-sessions: primera página": (admin(cerradas), (51,), 102),
+        "admin/all-sessions: página con cursor": (
+            admin(f"{cerradas} AND {backend.FILTRO_CURSOR}"), (*cursor, 51), 102),
+        "admin/all-sessions: desde/hasta": (admin(por_fecha), (*params_fecha, 51), 102),
+        # El filtro por nombre no tiene índice: recorre el índice por fecha hasta juntar la
+        # página, así que el presupuesto depende de cuántos usuarios coinciden (~la mitad)
+        "admin/all-sessions: estudiante": (admin(por_estudiante), (*params_estudiante, 51), 400),
+        "get-session-details": (backend.CONSULTA_MUESTRAS_SESION, {"sesion_id": p["sesion_id"]}, 200),
+        "get-or-create-diagnosis: cola": (backend.CONSULTA_ESTADO_COLA, (p["sesion_id"],), 1),
+        "worker: reclamar trabajo": (backend.CONSULTA_TOMAR_TRABAJO, (), 200),
+        "guardar momentos": (backend.CONSULTA_MOMENTOS, (p["ids"], p["ts"], ["Fatiga"] * len(p["ids"])), 100),
+    }
+
+def _cargar_dataset(conn, usuarios, sesiones, muestras_por_sesion):
+    """Dataset sintético con la forma de producción (generate_series, sin ida y vuelta por fila)"""
+    paso = 5
+    conn.execute(f"""
+        INSERT INTO usuarios (nombre, apellido, correo, contrasena, rol_id)
+        SELECT 'Usuario', 'N' || g, 'u' || g || '@planes.test', 'x', 2
+        FROM generate_series(1, {int(usuarios)}) g
+    """)
+    # ~2% de sesiones quedan abiertas; el resto cerradas con duración según sus muestras.
+    # Las fechas cubren varios meses, así que las muestras se reparten en varias particiones.
+    conn.execute(f"""
+        INSERT INTO sesiones (usuario_id, tipo_actividad, fuente, fecha_inicio, fecha_fin,
+                              cerrada_en, total_segundos, alertas, kss_final, es_fatiga)
+        SELECT u.id,
+               CASE WHEN g % 2 = 0 THEN 'pdf' ELSE 'video' END,
+               'sintetico',
+               TIMESTAMP '2025-01-01' + g * INTERVAL '7 minutes',
+               CASE WHEN g % 50 = 0 THEN NULL
+                    ELSE TIMESTAMP '2025-01-01' + g * INTERVAL '7 minutes' + INTERVAL '5 minutes' END,
+               CASE WHEN g % 50 = 0 THEN NULL
+                    ELSE TIMESTAMP '2025-01-01' + g * INTERVAL '7 minutes' + INTERVAL '5 minutes' END,
+               {int(muestras_por_sesion) * paso}, g % 4, g % 9 + 1, g % 3 = 0
+        FROM generate_series(1, {int(sesiones)}) g
+        JOIN LATERAL (
+            SELECT id FROM usuarios ORDER BY id OFFSET (g % {int(usuarios)}) LIMIT 1
+        ) u ON true
+    """)
+    for (mes,) in conn.execute(
+        "SELECT DISTINCT date_trunc('month', fecha_inicio)::date FROM sesiones"
+    ).fetchall():
+        conn.execute("SELECT crear_particion_muestras(%s)", (mes,))
+    conn.execute(f"""
+        INSERT INTO muestras (sesion_id, t, sesion_inicio, perclos, parpadeos, blink_rate_min, pct_incompletos,
+                              tiempo_cierre, num_bostezos, velocidad_ocular, max_sin_parpadeo,
+                              alertas, nivel_subjetivo, es_fatiga)
+        SELECT s.id, k * {paso}, s.fecha_inicio, (s.id * 7 + k) % 40, k * 3, 15 + k % 5, (s.id + k) % 25,
+               k * 0.1, k / 4, 0.02 + (k % 3) * 0.01, 4 + k % 6,
+               s.alertas, s.kss_final, s.es_fatiga
+        FROM sesiones s
+        CROSS JOIN generate_series(1, {int(muestras_por_sesion)}) k
+    """)
+    conn.execute("""
+        INSERT INTO alertas (sesion_id, momento_seg, motivo)
+        SELECT s.id, k * 17, CASE WHEN k = 1 THEN 'Fatiga moderada' ELSE 'Fatiga severa' END
+        FROM sesiones s CROSS JOIN generate_series(1, s.alertas) k
+    """)
+    conn.execute("""
+        INSERT INTO diagnosticos_ia (sesion_id, diagnostico_json)
+        SELECT id, jsonb_build_object('diagnostico_general', 'Estado normal', 'severidad_fatiga_final', 'NORMAL')
+        FROM sesiones WHERE id % 2 = 0
+    """)
+    # La cola real es chica: unos pocos pendientes y el resto errores finales
+    conn.execute("""
+        INSERT INTO diagnosticos_cola (sesion_id, payload, estado, intentos, disponible_en)
+        SELECT id, '{}'::jsonb,
+               CASE WHEN id % 100 = 0 THEN 'pendiente' ELSE 'error' END,
+               5, NOW() + INTERVAL '1 hour'
+        FROM sesiones WHERE id % 5 = 0
+    """)
+    minimo, maximo = conn.execute("SELECT MIN(id), MAX(id) FROM sesiones").fetchone()
+    reconstruir_resumen.reconstruir(conn, minimo, maximo)
+    reconstruir_resumen.reconstruir_usuarios(conn)
+    conn.execute("ANALYZE")
+
+def _parametros(conn):
+    """Valores reales del dataset para las consultas parametrizadas"""
+    usuario_id, = conn.execute(
+        "SELECT usuario_id FROM sesiones GROUP BY usuario_id ORDER BY COUNT(*) DESC LIMIT 1"
+    ).fetchone()
+    sesion_id, = conn.execute(
+        "SELECT id FROM sesiones WHERE usuario_id = %s ORDER BY id DESC LIMIT 1", (usuario_id,)
+    ).fetchone()
+    cursor_fecha, cursor_id = conn.execute(
+        "SELECT fecha_inicio, sesion_id FROM sesion_resumen WHERE cerrada_en IS NOT NULL "
+        "ORDER BY fecha_inicio DESC, sesion_id DESC OFFSET 500 LIMIT 1"
+    ).fetchone()
+    ids = [r[0] for r in conn.execute("SELECT id FROM sesiones ORDER BY random() LIMIT 25").fetchall()]
+    return {
+        "usuario_id": usuario_id,
+        "sesion_id": sesion_id,
+        "cursor_fecha": cursor_fecha,
+        "cursor_id": cursor_id,
+        # Una semana que termina en la página del cursor; "Usuario N1" coincide con ~la mitad
+        "desde": cursor_fecha.date() - timedelta(days=7),
+        "hasta": cursor_fecha.date(),
+        "estudiante": "Usuario N1",
+        "ids": ids,
+        "ts": [100] * len(ids),
+    }
+
+def _nodos(plan):
+    yield plan
+    for hijo in plan.get("Plans", []):
+        yield from _nodos(hijo)
+
+def revisar_plan(plan, presupuesto):
+    """Devuelve (errores, filas_leidas, resumen de nodos de scan)"""
+    errores = []
+    filas_leidas = 0
+    scans = []
+    for nodo in _nodos(plan):
+        tipo = nodo["Node Type"]
+        relacion = nodo.get("Relation Name")
+        if relacion is None:
+            continue
+        loops = nodo.get("Actual Loops", 1)
+        filas_leidas += (nodo.get("Actual Rows", 0) + nodo.get("Rows Removed by Filter", 0)) * loops
+        scans.append(f"{tipo} {nodo.get('Index Name') or relacion}")
+        if tipo == "Seq Scan" and _es_grande(relacion):
+            errores.append(f"Seq Scan sobre {relacion}")
+    if filas_leidas > presupuesto:
+        errores.append(f"lee {filas_leidas:.0f} filas (presupuesto {presupuesto})")
+    return errores, filas_leidas, scans
+
+def verificar(conn, parametros, salida=sys.stdout):
+    fallas = 0
+    for nombre, (consulta, valores, presupuesto) in _consultas(parametros).items():
+        # Cada EXPLAIN ANALYZE corre en una transacción que se descarta (hay UPDATEs e INSERTs)
+        with conn.transaction(force_rollback=True):
+            fila = conn.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + consulta, valores).fetchone()
+        plan = fila[0][0]["Plan"]
+        errores, filas_leidas, scans = revisar_plan(plan, presupuesto)
+        estado = "FALLA" if errores else "OK   "
+        print(f"{estado} {nombre}: {filas_leidas:.0f}/{presupuesto} filas; {', '.join(scans)}", file=salida)
+        for error in errores:
+            print(f"        - {error}", file=salida)
+        fallas += bool(errores)
+    return fallas
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--usuarios", type=int, default=200)
+    parser.add_argument("--sesiones", type=int, default=20000)
+    parser.add_argument("--muestras", type=int, default=12, help="muestras por sesión")
+    parser.add_argument("--mantener", action="store_true", help="no borrar la base temporal al terminar")
+    args = parser.parse_args(argv)
+
+    nombre_bd = f"{DB_CONFIG['dbname']}_planes"
+    admin = {**DB_CONFIG, "dbname": "postgres"}
+    with psycopg.connect(**admin, autocommit=True) as conn:
+        conn.execute(sql.SQL("DROP DATABASE IF EXISTS {}").format(sql.Identifier(nombre_bd)))
+        conn.execute(sql.SQL("CREATE DATABASE {}").format(sql.Identifier(nombre_bd)))
+
+    try:
+        with psycopg.connect(**{**DB_CONFIG, "dbname": nombre_bd}, autocommit=True) as conn:
+            migrate.aplicar(conn)
+            inicio = time.perf_counter()
+            _cargar_dataset(conn, args.usuarios, args.sesiones, args.muestras)
+            print(f"Dataset sintético cargado en {time.perf_counter() - inicio:.1f}s "
+                  f"({args.sesiones} sesiones, {args.sesiones * args.muestras} muestras)")
+            fallas = verificar(conn, _parametros(conn))
+    finally:
+        if not args.mantener:
+            with psycopg.connect(**admin, autocommit=True) as conn:
+                conn.execute(sql.SQL("DROP DATABASE IF EXISTS {}").format(sql.Identifier(nombre_bd)))
+
+    if fallas:
+        print(f"{fallas} consulta(s) fuera de presupuesto", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
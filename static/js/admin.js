@@ -11,72 +11,203 @@ const tabla = document.getElementById("tablaUsuarios");
 const totalEstudiantesEl = document.getElementById("totalEstudiantes");
 const fatigaInicialPromEl = document.getElementById("fatigaInicialProm");
 const reduccionPromEl = document.getElementById("reduccionProm");
+const totalSesionesEl = document.getElementById("totalSesiones");
+const btnCargarMas = document.getElementById("btnCargarMas");
+const formFiltros = document.getElementById("filtrosSesiones");
 
 // NOTA: Sistema actualizado a monitoreo CONTINUO (no inicial/final)
 
+const ADMIN_API = "http://localhost:8000/admin/all-sessions";
+const EXPORT_API = "http://localhost:8000/admin/export";
+const LIVE_API = "http://localhost:8000/admin/live";
+const LIMITE_PAGINA = 50;
+
 let graficoFatiga = null;
 let graficoReduccion = null;
 
+// Estado de paginación: sesiones ya cargadas y cursor de la siguiente página
+let sesionesCargadas = [];
+let siguienteCursor = null;
+
+// Sesiones en curso: sesion_id -> {estado combinado, fila de la tabla}
+const sesionesVivo = new Map();
+
 // ========================================================
-//  Cargar sesiones globales del backend
+//  Cargar sesiones globales del backend (paginadas)
 // ========================================================
-document.addEventListener("DOMContentLoaded", async () => {
+document.addEventListener("DOMContentLoaded", () => {
+    formFiltros.addEventListener("submit", (ev) => {
+        ev.preventDefault();
+        cargarSesiones(true);
+    });
+    btnCargarMas.addEventListener("click", () => cargarSesiones(false));
+    document.querySelectorAll("[data-exportar]").forEach(btn =>
+        btn.addEventListener("click", () => exportar(btn.dataset.exportar))
+    );
+    cargarSesiones(true);
+    conectarVivo();
+});
+
+function leerFiltros() {
+    const params = new URLSearchParams({ limite: LIMITE_PAGINA });
+    const filtros = {
+        desde: document.getElementById("filtroDesde").value,
+        hasta: document.getElementById("filtroHasta").value,
+        estudiante: document.getElementById("filtroEstudiante").value.trim(),
+        tipo_actividad: document.getElementById("filtroActividad").value,
+        es_fatiga: document.getElementById("filtroFatiga").value
+    };
+    for (const [clave, valor] of Object.entries(filtros)) {
+        if (valor) params.set(clave, valor);
+    }
+    return params;
+}
+
+// Descarga en streaming desde el backend con los mismos filtros de la tabla
+function exportar(recurso) {
+    const params = leerFiltros();
+    params.delete("limite");
+    params.set("formato", "csv");
+    window.location.href = `${EXPORT_API}/${recurso}?${params}`;
+}
+
+async function cargarSesiones(reiniciar) {
+    const params = leerFiltros();
+    if (!reiniciar && siguienteCursor) params.set("cursor", siguienteCursor);
+
+    btnCargarMas.disabled = true;
     try {
-        const resp = await fetch("http://localhost:8000/admin/all-sessions");
+        const resp = await fetch(`${ADMIN_API}?${params}`);
         const data = await resp.json();
 
         if (!data.ok) {
-            console.error(data.error);
+            console.error(data.error || data.detail);
             alert("No se pudieron cargar los datos.");
             return;
         }
 
-        console.log("Sesiones recibidas:", data);
-        llenarTabla(data.sesiones);
-        llenarMetricas(data.sesiones);
-        generarGraficos(data.sesiones);
+        if (reiniciar) {
+            sesionesCargadas = [];
+            tabla.replaceChildren();
+            if (data.total_estimado !== null) {
+                totalSesionesEl.textContent = `Aprox. ${data.total_estimado} sesiones`;
+            }
+        }
+
+        agregarFilas(data.sesiones, sesionesCargadas.length);
+        sesionesCargadas = sesionesCargadas.concat(data.sesiones);
+        siguienteCursor = data.siguiente_cursor;
+        btnCargarMas.classList.toggle("d-none", !siguienteCursor);
+
+        llenarMetricas(sesionesCargadas);
+        generarGraficos(sesionesCargadas);
 
     } catch (err) {
         console.error(err);
         alert("Error al conectar con el servidor.");
+    } finally {
+        btnCargarMas.disabled = false;
     }
-});
+}
 
 // ========================================================
 //  Llenar tabla de usuarios (CONTINUO)
 // ========================================================
-function llenarTabla(sesiones) {
-    tabla.innerHTML = "";
+function celda(fila, contenido) {
+    const td = document.createElement("td");
+    if (contenido instanceof Node) td.appendChild(contenido);
+    else td.textContent = contenido;
+    fila.appendChild(td);
+}
+
+function badge(clase, texto) {
+    const span = document.createElement("span");
+    span.className = `badge ${clase}`;
+    span.textContent = texto;
+    return span;
+}
+
+// Agrega una página de filas de una sola vez (sin reparsear la tabla con innerHTML +=)
+function agregarFilas(sesiones, offset) {
+    const fragmento = document.createDocumentFragment();
 
     sesiones.forEach((s, idx) => {
-        const fatigaStatus = s.es_fatiga 
-            ? '<span class="badge bg-danger">Fatiga</span>' 
-            : '<span class="badge bg-success">Normal</span>';
-        
-        const duracionMin = Math.floor(s.total_segundos / 60);
-        const duracionSeg = s.total_segundos % 60;
+        const totalSeg = s.total_segundos || 0;
+        const duracionMin = Math.floor(totalSeg / 60);
+        const duracionSeg = totalSeg % 60;
         const duracion = `${String(duracionMin).padStart(2, '0')}:${String(duracionSeg).padStart(2, '0')}`;
 
-        tabla.innerHTML += `
-            <tr>
-                <td>${idx + 1}</td>
-                <td>${s.estudiante}</td>
-                <td>${s.fecha}</td>
-                <td>${s.tipo_actividad === 'pdf' ? 'PDF' : 'Video'}</td>
-                <td>${duracion}</td>
-                <td><span class="badge bg-warning text-dark">${s.alertas || 0}</span></td>
-                <td>${fatigaStatus}</td>
-                <td>
-                    <button class="btn btn-outline-primary btn-sm"
-                        onclick="verDetalle(${s.sesion_id})">
-                        <i class="bi bi-eye"></i> Ver
-                    </button>
-                </td>
-            </tr>
-        `;
+        const fila = document.createElement("tr");
+        celda(fila, offset + idx + 1);
+        celda(fila, s.estudiante);
+        celda(fila, s.fecha);
+        celda(fila, s.tipo_actividad === 'pdf' ? 'PDF' : 'Video');
+        celda(fila, duracion);
+        celda(fila, badge("bg-warning text-dark", s.alertas || 0));
+        celda(fila, s.es_fatiga ? badge("bg-danger", "Fatiga") : badge("bg-success", "Normal"));
+
+        const boton = document.createElement("button");
+        boton.className = "btn btn-outline-primary btn-sm";
+        boton.innerHTML = '<i class="bi bi-eye"></i> Ver';
+        boton.addEventListener("click", () => verDetalle(s.sesion_id));
+        celda(fila, boton);
+
+        fragmento.appendChild(fila);
+    });
+
+    tabla.appendChild(fragmento);
+}
+
+// ========================================================
+//  Sesiones en curso (SSE: el backend empuja solo los cambios)
+// ========================================================
+function conectarVivo() {
+    const estadoEl = document.getElementById("estadoVivo");
+    const fuente = new EventSource(LIVE_API);
+
+    fuente.onopen = () => {
+        estadoEl.className = "badge bg-success";
+        estadoEl.textContent = "En vivo";
+    };
+    // EventSource reconecta solo; al reconectar el backend reenvía el estado completo
+    fuente.onerror = () => {
+        estadoEl.className = "badge bg-secondary";
+        estadoEl.textContent = "Reconectando...";
+    };
+    fuente.addEventListener("sesiones", (ev) => {
+        JSON.parse(ev.data).forEach(aplicarDeltaVivo);
+        document.getElementById("vivoVacio").classList.toggle("d-none", sesionesVivo.size > 0);
     });
 }
 
+function aplicarDeltaVivo(delta) {
+    const actual = sesionesVivo.get(delta.sesion_id);
+    if (delta.fin) {
+        if (actual) actual.fila.remove();
+        sesionesVivo.delete(delta.sesion_id);
+        return;
+    }
+
+    const entrada = actual || { datos: {}, fila: document.createElement("tr") };
+    Object.assign(entrada.datos, delta);
+    if (!actual) {
+        sesionesVivo.set(delta.sesion_id, entrada);
+        document.getElementById("tablaVivo").appendChild(entrada.fila);
+    }
+
+    const d = entrada.datos;
+    const t = d.t || 0;
+    const tiempo = `${String(Math.floor(t / 60)).padStart(2, '0')}:${String(t % 60).padStart(2, '0')}`;
+    entrada.fila.replaceChildren();
+    celda(entrada.fila, d.sesion_id);
+    celda(entrada.fila, `#${d.usuario_id}`);
+    celda(entrada.fila, d.actividad === 'pdf' ? 'PDF' : 'Video');
+    celda(entrada.fila, tiempo);
+    celda(entrada.fila, d.perclos !== undefined ? `${d.perclos.toFixed(1)}%` : '-');
+    celda(entrada.fila, badge("bg-warning text-dark", d.alertas || 0));
+    celda(entrada.fila, d.es_fatiga ? badge("bg-danger", "Fatiga") : badge("bg-success", "Normal"));
+}
+
 // ========================================================
 //  Acción para ver detalle
 // ========================================================
@@ -8,6 +8,9 @@
 
 let historialData = [];
 let usuarioData = null;
+let promediosData = null;
+let siguienteCursor = null;
+const HISTORIAL_LIMITE = 20;
 
 // ==========================================
 // 2. CARGAR DATOS AL INICIAR
@@ -25,6 +28,14 @@ document.addEventListener('DOMContentLoaded', async () => {
     document.getElementById('userName').textContent = 
         `${usuarioData.nombre} ${usuarioData.apellido}`;
 
+    document.getElementById('btnCargarMas').addEventListener('click', async () => {
+        try {
+            await cargarHistorial(siguienteCursor);
+        } catch (e) {
+            alert('Error al cargar más sesiones');
+        }
+    });
+
     try {
         await cargarHistorial();
         calcularEstadisticas();
@@ -38,12 +49,13 @@ document.addEventListener('DOMContentLoaded', async () => {
 // 3. CARGAR HISTORIAL DE SESIONES
 // ==========================================
 
-async function cargarHistorial() {
+// Carga una página de sesiones (la primera si no hay cursor)
+async function cargarHistorial(cursor = null) {
     try {
         const response = await fetch('http://localhost:8000/get-user-history', {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ usuario_id: usuarioData.id })
+            body: JSON.stringify({ usuario_id: usuarioData.id, limite: HISTORIAL_LIMITE, cursor })
         });
 
         if (!response.ok) throw new Error('Error en servidor');
@@ -56,11 +68,15 @@ async function cargarHistorial() {
             return;
         }
 
-        historialData = data.historial;
+        const offset = cursor ? historialData.length : 0;
+        historialData = cursor ? historialData.concat(data.historial) : data.historial;
+        promediosData = data.promedios;
+        siguienteCursor = data.siguiente_cursor;
         document.getElementById('emptyState').classList.add('d-none');
         document.getElementById('sessionsContent').classList.remove('d-none');
+        document.getElementById('btnCargarMas').classList.toggle('d-none', !siguienteCursor);
 
-        llenarTabla();
+        llenarTabla(data.historial, offset);
 
     } catch (e) {
         console.error('Error:', e);
@@ -72,11 +88,13 @@ async function cargarHistorial() {
 // 4. LLENAR TABLA DE SESIONES
 // ==========================================
 
-function llenarTabla() {
+// Agrega una página de filas (offset = filas ya mostradas)
+function llenarTabla(sesiones, offset) {
     const tbody = document.getElementById('sessionsList');
-    tbody.innerHTML = '';
+    if (offset === 0) tbody.innerHTML = '';
+    const filas = [];
 
-    historialData.forEach((sesion, index) => {
+    sesiones.forEach((sesion, index) => {
         // `sesion.fecha` ya viene formateada desde el backend (TO_CHAR)
         const fecha = sesion.fecha || '-';
         const actividad = sesion.tipo_actividad === 'pdf' ? 'PDF' : 'Video';
@@ -100,7 +118,7 @@ function llenarTabla() {
 
         const row = `
             <tr>
-                <td>${index + 1}</td>
+                <td>${offset + index + 1}</td>
                 <td>${fecha}</td>
                 <td>${actividad}</td>
                 <td>${duracion}</td>
@@ -110,26 +128,26 @@ function llenarTabla() {
             </tr>
         `;
 
-        tbody.innerHTML += row;
+        filas.push(row);
     });
+
+    tbody.insertAdjacentHTML('beforeend', filas.join(''));
 }
 
 // ==========================================
 // 5. CALCULAR ESTADÍSTICAS
 // ==========================================
 
+// Totales del usuario: vienen precalculados del backend (usuario_resumen),
+// no dependen de cuántas páginas de sesiones se hayan cargado
 function calcularEstadisticas() {
-    if (!historialData || historialData.length === 0) return;
+    if (!promediosData) return;
 
     // Total de sesiones
-    document.getElementById('totalSessions').textContent = historialData.length;
+    document.getElementById('totalSessions').textContent = promediosData.sesiones_total;
 
     // Tiempo total
-    let tiempoTotal = 0;
-    historialData.forEach(s => {
-        tiempoTotal += s.total_segundos || 0;
-    });
-
+    const tiempoTotal = Math.round(promediosData.tiempo_total_min * 60);
     const horas = Math.floor(tiempoTotal / 3600);
     const minutos = Math.floor((tiempoTotal % 3600) / 60);
     const tiempoFormato = horas > 0 
@@ -138,23 +156,10 @@ function calcularEstadisticas() {
     document.getElementById('totalTime').textContent = tiempoFormato;
 
     // Fatiga promedio
-    let sumFatiga = 0;
-    let contFatiga = 0;
-    historialData.forEach(s => {
-        if (s.perclos !== null && s.perclos !== undefined) {
-            sumFatiga += parseFloat(s.perclos);
-            contFatiga++;
-        }
-    });
-    const fatigaPromedio = contFatiga > 0 ? (sumFatiga / contFatiga).toFixed(1) : '0.0';
-    document.getElementById('avgFatigue').textContent = fatigaPromedio + '%';
+    document.getElementById('avgFatigue').textContent = Number(promediosData.perclos_avg).toFixed(1) + '%';
 
     // Alertas totales
-    let totalAlertas = 0;
-    historialData.forEach(s => {
-        totalAlertas += s.alertas || 0;
-    });
-    document.getElementById('totalAlerts').textContent = totalAlertas;
+    document.getElementById('totalAlerts').textContent = promediosData.alertas_total;
 }
 
 // ==========================================
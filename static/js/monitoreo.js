@@ -69,12 +69,39 @@ let totalIrisDistance = 0;
 let frameCount = 0;
 const LEFT_IRIS_CENTER = 468;
 
+// Reglas de fatiga compiladas (ver reglas_fatiga.js); se cargan al abrir la página y,
+// si fallaron, se vuelven a pedir al iniciar la cámara
+let reglasFatiga = null;
+let cargaReglas = null;
+
 // Seguimiento de alertas
 let lastAlertTime = 0;
 let momentosFatiga = [];
 let alertasCount = 0;
 let maxSinParpadeo = 0;
 
+// Stream de métricas (WebSocket)
+const WS_BASE = API_BASE.replace(/^http/, 'ws');
+const STREAM_INTERVAL = 5;
+const STREAM_MAX_PENDIENTES = 120;
+let streamSocket = null;
+let streamCerrado = true;
+let streamReintentos = 0;
+let streamPendientes = [];   // frames completos que el backend aún no confirmó como guardados
+let streamAlCerrar = null;
+let ultimoFrame = {};
+let momentosEnviados = 0;
+let ultimoEnvioStream = 0;
+
+// Señales crudas por frame (chunks binarios SEYE, ver backend/senales.py). Se guardan
+// desde el inicio de la calibración: motor_fatiga.py toma los primeros 10s como baseline
+const SENALES_CHUNK_SEG = 60;
+const SENALES_COLUMNAS = ['ts', 'ear', 'mar', 'iris_x', 'iris_y'];
+let senalesBuffer = SENALES_COLUMNAS.map(() => []);
+let senalesSeq = 0;
+let ultimoEnvioSenales = 0;
+let inicioSenales = 0;
+
 // ==========================================
 // 2. FUNCIONES MATEMÁTICAS
 // ==========================================
@@ -156,6 +183,7 @@ faceMesh.onResults((results) => {
 
             calibrationEARs.push(currentEAR);
             calibrationMARs.push(currentMAR);
+            registrarSenales(now, currentEAR, currentMAR, currentIrisPos);
 
             if (elapsed >= CALIBRATION_DURATION) {
                 baselineEAR = calibrationEARs.reduce((a, b) => a + b, 0) / calibrationEARs.length;
@@ -179,6 +207,9 @@ faceMesh.onResults((results) => {
                 frameCount = 0;
                 alertasCount = 0;
                 momentosFatiga = [];
+
+                abrirStreamMetricas();
+                ultimoEnvioStream = now;
             }
 
         } else if (appState === 'MONITORING') {
@@ -188,6 +219,8 @@ faceMesh.onResults((results) => {
             const seconds = Math.floor(elapsed % 60);
             timerEl.textContent = `${String(minutes).padStart(2, '0')}:${String(seconds).padStart(2, '0')}`;
 
+            registrarSenales(now, currentEAR, currentMAR, currentIrisPos);
+
             measureFramesTotal++;
 
             // -------------------------
@@ -277,17 +310,19 @@ faceMesh.onResults((results) => {
                 ? parseFloat(((totalIrisDistance / frameCount) * 100).toFixed(4))
                 : 0;
 
-            let nivelFatiga = 0;
-            if (perclos >= 28) nivelFatiga += 3;
-            if (blinkCounter <= 5 && measureFramesTotal > 60) nivelFatiga += 3;
-            if (pctIncompletos >= 20) nivelFatiga += 2;
-            if (yawnCounter >= 1) nivelFatiga += 1;
-            if (avgVelocity < 0.02) nivelFatiga += 1;
-            if (accumulatedClosureTime >= 3) nivelFatiga += 1;
-            if (maxSinParpadeo >= 10) nivelFatiga += 2;
+            const nivelFatiga = reglasFatiga.nivelFatiga({
+                perclos,
+                sebr: blinkCounter,
+                frames: measureFramesTotal,
+                pct_incompletos: pctIncompletos,
+                num_bostezos: yawnCounter,
+                velocidad_ocular: avgVelocity,
+                tiempo_cierre: accumulatedClosureTime,
+                max_sin_parpadeo: maxSinParpadeo
+            });
 
             // Mostrar alerta de fatiga (con cooldown)
-            if (nivelFatiga >= 3 && (now - lastAlertTime) > ALERT_COOLDOWN) {
+            if (nivelFatiga >= reglasFatiga.umbralAlerta && (now - lastAlertTime) > ALERT_COOLDOWN) {
                 mostrarAlertaFatiga();
                 alertasCount++;
                 alertsCountEl.textContent = alertasCount;
@@ -296,7 +331,7 @@ faceMesh.onResults((results) => {
                 // Guardar momento de fatiga
                 momentosFatiga.push({
                     t: Math.round(elapsed),
-                    reason: nivelFatiga >= 5 ? 'Fatiga severa' : 'Fatiga moderada'
+                    reason: nivelFatiga >= reglasFatiga.umbralSevera ? 'Fatiga severa' : 'Fatiga moderada'
                 });
 
                 // Abrir modal para actividad de descanso
@@ -306,6 +341,22 @@ faceMesh.onResults((results) => {
             // -------------------------
             // GUARDAR MÉTRICAS CADA 5 SEGUNDOS
             // -------------------------
+            if (now - ultimoEnvioStream >= STREAM_INTERVAL) {
+                ultimoEnvioStream = now;
+                enviarMetricasStream({
+                    tiempo_total_seg: Math.round(elapsed),
+                    perclos: parseFloat(perclos.toFixed(2)),
+                    sebr: blinkCounter,
+                    blink_rate_min: blinkCounter > 0 ? parseFloat((blinkCounter / (elapsed / 60)).toFixed(2)) : 0,
+                    pct_incompletos: parseFloat(pctIncompletos.toFixed(2)),
+                    num_bostezos: yawnCounter,
+                    tiempo_cierre: parseFloat(accumulatedClosureTime.toFixed(2)),
+                    velocidad_ocular: avgVelocity,
+                    max_sin_parpadeo: Math.round(maxSinParpadeo),
+                    alertas: alertasCount,
+                    es_fatiga: reglasFatiga.esFatiga({ perclos, alertas: alertasCount })
+                });
+            }
         }
     }
 
@@ -316,7 +367,31 @@ faceMesh.onResults((results) => {
 // 4. CONTROL DE CÁMARA
 // ==========================================
 
-function startCamera() {
+// Una sola carga en curso a la vez; si falla, la siguiente llamada reintenta
+function asegurarReglasFatiga() {
+    if (reglasFatiga) return Promise.resolve(reglasFatiga);
+    if (!cargaReglas) {
+        cargaReglas = cargarReglasFatiga(API_BASE)
+            .then(reglas => {
+                reglasFatiga = reglas;
+                console.log('Reglas de fatiga cargadas, versión', reglas.version);
+                return reglas;
+            })
+            .finally(() => { cargaReglas = null; });
+    }
+    return cargaReglas;
+}
+
+async function startCamera() {
+    if (!reglasFatiga) {
+        try {
+            await asegurarReglasFatiga();
+        } catch (e) {
+            console.error('Error cargando reglas de fatiga:', e);
+            alert('Las reglas de fatiga aún no están disponibles. Intenta de nuevo.');
+            return;
+        }
+    }
     if (!camera) {
         camera = new Camera(videoElement, {
             onFrame: async () => {
@@ -338,6 +413,10 @@ function startCamera() {
 
         calibrationEARs = [];
         calibrationMARs = [];
+        senalesBuffer = SENALES_COLUMNAS.map(() => []);
+        senalesSeq = 0;
+        inicioSenales = startTime;
+        ultimoEnvioSenales = startTime;
 
         crearSesion();
     });
@@ -366,6 +445,32 @@ async function crearSesion() {
     console.log('Usando sesión existente con ID:', sesionId);
 }
 
+// Número de secuencia del snapshot dentro de la sesión: el backend descarta los
+// repetidos o atrasados, así que reenviar el mismo payload es seguro
+function siguienteSeqSnapshot() {
+    const clave = `seq:${sesionId}`;
+    const seq = parseInt(sessionStorage.getItem(clave) || '0', 10) + 1;
+    sessionStorage.setItem(clave, String(seq));
+    return seq;
+}
+
+// POST a /save-fatigue reintentando (mismo payload, mismo seq) ante fallos de red o 5xx
+async function enviarSnapshot(payload, intentos = 3) {
+    for (let intento = 1; ; intento++) {
+        try {
+            const response = await fetch(`${API_BASE}/save-fatigue`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify(payload)
+            });
+            if (response.status < 500 || intento >= intentos) return response;
+        } catch (e) {
+            if (intento >= intentos) throw e;
+        }
+        await new Promise(r => setTimeout(r, 500 * 2 ** (intento - 1)));
+    }
+}
+
 async function guardarMetricasContinuas(tiempoTranscurrido, perclos, blinkRate, velocidadOcular) {
     if (!sesionId) return;
 
@@ -376,7 +481,7 @@ async function guardarMetricasContinuas(tiempoTranscurrido, perclos, blinkRate,
     const pctIncompletos = blinkRate > 0 ? (incompleteBlinks / blinkRate) * 100 : 0;
     
     // Detectar fatiga (basado en PERCLOS y alertas)
-    const esFatiga = perclos >= 15 || alertasCount >= 2;
+    const esFatiga = reglasFatiga.esFatiga({ perclos, alertas: alertasCount });
 
     const payload = {
         sesion_id: sesionId,
@@ -394,15 +499,12 @@ async function guardarMetricasContinuas(tiempoTranscurrido, perclos, blinkRate,
         alertas: alertasCount,
         momentos_fatiga: momentosFatiga,
         nivel_subjetivo: 0, // Se establecerá al final con KSS
-        es_fatiga: esFatiga
+        es_fatiga: esFatiga,
+        seq: siguienteSeqSnapshot()
     };
 
     try {
-        const response = await fetch('http://localhost:8000/save-fatigue', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify(payload)
-        });
+        const response = await enviarSnapshot(payload);
 
         if (!response.ok) {
             console.warn('Error guardando métricas:', response.status);
@@ -412,10 +514,176 @@ async function guardarMetricasContinuas(tiempoTranscurrido, perclos, blinkRate,
     }
 }
 
+// Abre el stream de la sesión; el backend guarda los frames por lotes. Si la conexión
+// se corta se reconecta con backoff: la sesión sigue abierta hasta enviar 'fin'
+function abrirStreamMetricas() {
+    if (!sesionId || streamSocket) return;
+
+    streamCerrado = false;
+    streamReintentos = 0;
+    streamPendientes = [];
+    conectarStream();
+}
+
+function conectarStream() {
+    const ws = new WebSocket(`${WS_BASE}/ws/sesiones/${sesionId}`);
+    streamSocket = ws;
+    ws.onopen = () => {
+        streamReintentos = 0;
+        // Conexión nueva: el backend arranca sin estado, así que se reenvía completo lo
+        // no confirmado (descarta por seq lo que ya guardó) y el próximo frame va entero
+        ultimoFrame = {};
+        momentosEnviados = 0;
+        streamPendientes.forEach((frame, i) => {
+            ws.send(JSON.stringify(i === 0 ? { ...frame, momentos: momentosFatiga } : frame));
+            ultimoFrame = { ...frame };
+            delete ultimoFrame.seq;
+            momentosEnviados = momentosFatiga.length;
+        });
+    };
+    ws.onmessage = (ev) => {
+        const msg = JSON.parse(ev.data);
+        if (msg.tipo === 'guardado') {
+            streamPendientes = streamPendientes.filter(f => f.seq > msg.seq);
+        } else if (msg.tipo === 'fin' && streamAlCerrar) {
+            streamAlCerrar();
+        }
+    };
+    ws.onclose = (ev) => {
+        if (streamSocket === ws) streamSocket = null;
+        if (ev.code === 4404) streamCerrado = true;
+        if (streamCerrado) return;
+        const espera = Math.min(30000, 1000 * 2 ** streamReintentos++);
+        console.warn(`Stream de métricas cortado, reconectando en ${espera / 1000}s`);
+        setTimeout(() => {
+            if (!streamCerrado && !streamSocket) conectarStream();
+        }, espera);
+    };
+    ws.onerror = (e) => console.warn('Error en stream de métricas:', e);
+}
+
+// Envía solo los campos que cambiaron desde el último frame y los momentos nuevos.
+// El seq es el de los snapshots de la sesión y se conserva entre reconexiones
+function enviarMetricasStream(metricas) {
+    if (!sesionId || streamCerrado) return;
+
+    const seq = siguienteSeqSnapshot();
+    streamPendientes.push({ seq, ...metricas });
+    if (streamPendientes.length > STREAM_MAX_PENDIENTES) streamPendientes.shift();
+    if (!streamSocket || streamSocket.readyState !== WebSocket.OPEN) return;
+
+    const frame = { seq };
+    for (const [campo, valor] of Object.entries(metricas)) {
+        if (ultimoFrame[campo] !== valor) {
+            frame[campo] = valor;
+            ultimoFrame[campo] = valor;
+        }
+    }
+    if (momentosFatiga.length > momentosEnviados) {
+        frame.momentos = momentosFatiga.slice(momentosEnviados);
+        momentosEnviados = momentosFatiga.length;
+    }
+    streamSocket.send(JSON.stringify(frame));
+}
+
+// Pide al backend volcar lo pendiente y terminar la sesión; espera su confirmación (máx. 3s)
+function cerrarStreamMetricas() {
+    return new Promise(resolve => {
+        streamCerrado = true;
+        if (!streamSocket || streamSocket.readyState !== WebSocket.OPEN) {
+            streamPendientes = [];
+            resolve();
+            return;
+        }
+        const terminar = () => {
+            clearTimeout(timeout);
+            streamAlCerrar = null;
+            streamPendientes = [];
+            resolve();
+        };
+        const timeout = setTimeout(terminar, 3000);
+        streamAlCerrar = terminar;
+        streamSocket.send(JSON.stringify({ tipo: 'fin' }));
+    });
+}
+
+// Agrega el frame al buffer de señales (ts desde el inicio de la calibración)
+// y sube un chunk cada SENALES_CHUNK_SEG
+function registrarSenales(now, ear, mar, iris) {
+    [now - inicioSenales, ear, mar, iris.x, iris.y].forEach((valor, i) => senalesBuffer[i].push(valor));
+    if (now - ultimoEnvioSenales >= SENALES_CHUNK_SEG) {
+        ultimoEnvioSenales = now;
+        enviarSenalesCrudas();
+    }
+}
+
+// Arma un chunk SEYE (cabecera de 12 bytes + columnas float32 con prefijo de largo)
+function armarChunkSenales(columnas) {
+    const nFrames = columnas[0].length;
+    const nombres = SENALES_COLUMNAS.map(n => new TextEncoder().encode(n));
+    const total = nombres.reduce((acc, n) => acc + 1 + n.length + 5 + nFrames * 4, 0);
+    const cuerpo = new Uint8Array(total);
+    const vista = new DataView(cuerpo.buffer);
+    let pos = 0;
+    columnas.forEach((valores, i) => {
+        cuerpo[pos++] = nombres[i].length;
+        cuerpo.set(nombres[i], pos);
+        pos += nombres[i].length;
+        vista.setUint8(pos, 2);                       // dtype 2 = float32
+        vista.setUint32(pos + 1, nFrames * 4, true);
+        pos += 5;
+        for (const v of valores) {
+            vista.setFloat32(pos, v, true);
+            pos += 4;
+        }
+    });
+    return { cuerpo, nFrames };
+}
+
+// Sube las señales acumuladas como un chunk binario comprimido (si el navegador lo permite)
+async function enviarSenalesCrudas() {
+    if (!sesionId || senalesBuffer[0].length === 0) return;
+
+    const columnas = senalesBuffer;
+    const seq = senalesSeq++;
+    senalesBuffer = SENALES_COLUMNAS.map(() => []);
+
+    try {
+        let { cuerpo, nFrames } = armarChunkSenales(columnas);
+        let flags = 0;
+        if (typeof CompressionStream !== 'undefined') {
+            const stream = new Blob([cuerpo]).stream().pipeThrough(new CompressionStream('deflate'));
+            cuerpo = new Uint8Array(await new Response(stream).arrayBuffer());
+            flags = 1;
+        }
+        const cabecera = new Uint8Array(12);
+        const vista = new DataView(cabecera.buffer);
+        cabecera.set(new TextEncoder().encode('SEYE'), 0);
+        vista.setUint8(4, 1);                         // versión
+        vista.setUint8(5, flags);
+        vista.setUint8(6, SENALES_COLUMNAS.length);
+        vista.setUint32(8, nFrames, true);
+
+        await fetch(`${API_BASE}/save-fatigue/raw/${sesionId}?seq=${seq}`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/octet-stream' },
+            body: new Blob([cabecera, cuerpo])
+        });
+    } catch (error) {
+        console.warn('Error subiendo señales crudas:', error);
+    }
+}
+
 async function finalizarSesion() {
     stopCamera();
     endSessionBtn.disabled = true;
 
+    // Subir las señales que quedaron en el buffer
+    await enviarSenalesCrudas();
+
+    // Cerrar el stream antes del guardado final para que no lo sobrescriba
+    await cerrarStreamMetricas();
+
     // Obtener KSS subjetivo
     mostrarModalKSS();
 }
@@ -448,7 +716,11 @@ function mostrarModalKSS() {
                 : 0;
 
             // Detectar fatiga basado en umbrales
-            const esFatiga = perclos >= 15 || alertasCount >= 2 || parseInt(kssValue) >= 7;
+            const esFatiga = reglasFatiga.esFatiga({
+                perclos,
+                alertas: alertasCount,
+                nivel_subjetivo: parseInt(kssValue)
+            });
 
             const payload = {
                 sesion_id: sesionId,
@@ -466,17 +738,14 @@ function mostrarModalKSS() {
                 nivel_subjetivo: parseInt(kssValue),
                 alertas: alertasCount,
                 momentos_fatiga: momentosFatiga,
-                es_fatiga: esFatiga
+                es_fatiga: esFatiga,
+                seq: siguienteSeqSnapshot()
             };
 
             console.log('Payload final:', payload);
 
             try {
-                const response = await fetch('http://localhost:8000/save-fatigue', {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify(payload)
-                });
+                const response = await enviarSnapshot(payload);
 
                 if (response.ok) {
                     // Redirigir a resumen (ruta estática)
@@ -571,7 +840,7 @@ document.getElementById('breakBtn3')?.addEventListener('click', () => abrirModal
 // 7. INICIALIZACIÓN AL CARGAR
 // ==========================================
 
-document.addEventListener('DOMContentLoaded', () => {
+document.addEventListener('DOMContentLoaded', async () => {
     // Protección de ruta
     const usuario = localStorage.getItem('usuario');
     if (!usuario) {
@@ -605,6 +874,13 @@ document.addEventListener('DOMContentLoaded', () => {
 
     // Cargar contenido en el panel
     cargarContenido(currentActivityType, currentResourceUrl, currentResourceName);
+
+    // Reglas de fatiga vigentes del backend (las mismas con que se diagnostica)
+    try {
+        await asegurarReglasFatiga();
+    } catch (e) {
+        console.error('Error cargando reglas de fatiga:', e);
+    }
 });
 
 // ==========================================
@@ -0,0 +1,60 @@
+// ==========================================
+// REGLAS DE FATIGA - SecurityEye
+// Definición servida por el backend (GET /reglas-fatiga, backend/reglas_fatiga.json)
+// y compilada una vez a funciones; así el navegador puntúa igual que el servidor.
+// ==========================================
+
+const COMPARADORES = {
+    '>=': (a, b) => a >= b,
+    '<=': (a, b) => a <= b,
+    '>': (a, b) => a > b,
+    '<': (a, b) => a < b,
+    '==': (a, b) => a === b,
+    '!=': (a, b) => a !== b
+};
+
+function compilarCondicion({ campo, op, umbral }) {
+    const comparar = COMPARADORES[op];
+    if (!comparar) throw new Error(`Operador inválido en ${campo}: ${op}`);
+    // Un campo nulo o ausente cuenta como 0, igual que en backend/reglas_fatiga.py
+    return registro => comparar(Number(registro[campo]) || 0, umbral);
+}
+
+function compilarSuma(reglas) {
+    const compiladas = reglas.map(regla => {
+        const condiciones = [regla, ...(regla.y || [])].map(compilarCondicion);
+        return { condiciones, puntos: regla.puntos };
+    });
+    return registro => compiladas.reduce(
+        (total, r) => r.condiciones.every(c => c(registro)) ? total + r.puntos : total,
+        0
+    );
+}
+
+function compilarCualquiera(condiciones) {
+    const compiladas = condiciones.map(compilarCondicion);
+    return registro => compiladas.some(c => c(registro));
+}
+
+// Reintenta con backoff (1s, 2s, 4s...) ante fallos de red o respuestas no OK
+async function cargarReglasFatiga(apiBase, intentos = 4) {
+    let definicion;
+    for (let intento = 1; ; intento++) {
+        try {
+            const response = await fetch(`${apiBase}/reglas-fatiga`);
+            if (!response.ok) throw new Error(`No se pudieron cargar las reglas de fatiga (${response.status})`);
+            definicion = await response.json();
+            break;
+        } catch (e) {
+            if (intento >= intentos) throw e;
+            await new Promise(r => setTimeout(r, 1000 * 2 ** (intento - 1)));
+        }
+    }
+    return {
+        version: definicion.version,
+        nivelFatiga: compilarSuma(definicion.nivel_fatiga.reglas),
+        umbralAlerta: definicion.nivel_fatiga.alerta,
+        umbralSevera: definicion.nivel_fatiga.severa,
+        esFatiga: compilarCualquiera(definicion.es_fatiga.cualquiera)
+    };
+}
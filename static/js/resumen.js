@@ -117,19 +117,49 @@ async function cargarDatosSesion() {
 // 4. GENERAR DIAGNÓSTICO IA
 // ==========================================
 
+const DIAGNOSIS_POLL_MS = 2000;
+const DIAGNOSIS_MAX_POLLS = 30;
+
 async function generarDiagnosticoIA() {
     try {
-        const response = await fetch('http://localhost:8000/get-or-create-diagnosis', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ sesion_id: sesionId })
-        });
-
-        if (!response.ok) {
-            throw new Error('Error en diagnóstico IA');
+        // El diagnóstico IA se genera en segundo plano: mientras el backend
+        // responda 'pendiente' se vuelve a consultar cada pocos segundos
+        for (let intento = 0; intento < DIAGNOSIS_MAX_POLLS; intento++) {
+            // Diagnóstico ya visto: revalidar con su ETag (304 = usar la copia guardada)
+            const claveCache = `diagnostico:${sesionId}`;
+            const guardado = JSON.parse(sessionStorage.getItem(claveCache) || 'null');
+            const headers = { 'Content-Type': 'application/json' };
+            if (guardado) headers['If-None-Match'] = guardado.etag;
+
+            const response = await fetch('http://localhost:8000/get-or-create-diagnosis', {
+                method: 'POST',
+                headers,
+                body: JSON.stringify({ sesion_id: sesionId })
+            });
+
+            if (response.status === 304 && guardado) {
+                diagnosisData = guardado.datos;
+                break;
+            }
+            if (!response.ok) {
+                throw new Error('Error en diagnóstico IA');
+            }
+
+            diagnosisData = await response.json();
+            const etag = response.headers.get('ETag');
+            if (etag) {
+                sessionStorage.setItem(claveCache, JSON.stringify({ etag, datos: diagnosisData }));
+            }
+            if (diagnosisData.estado !== 'pendiente') break;
+
+            document.getElementById('diagnosisContent').innerHTML =
+                '<p class="text-muted"><span class="spinner-border spinner-border-sm"></span> Generando diagnóstico IA...</p>';
+            await new Promise(resolve => setTimeout(resolve, DIAGNOSIS_POLL_MS));
         }
 
-        diagnosisData = await response.json();
+        if (diagnosisData.estado === 'pendiente') {
+            throw new Error('Diagnóstico IA aún en proceso');
+        }
 
         // Mostrar diagnóstico general
         const diagnosisContent = document.getElementById('diagnosisContent');